@@ -0,0 +1,397 @@
+"""End-to-end benchmark of the server, offline, with a local video origin.
+
+Run as::
+
+    python benchmarks/bench_e2e.py [-n JOBS] [-c CONCURRENCY] [-o FILE]
+
+Starts a local HTTP origin serving synthetic videos of `--size` bytes, and
+registers a stub extractor with youtube_dl for urls of the form
+``http://bench.invalid/{{id}}``. The APP is then driven in-process, through
+its WSGI interface, by `CONCURRENCY` client threads:
+
+* "submit": `JOBS` requests to "/bench/submit", each for a different video
+* "completion": the time from each submission until the job is finished
+  (by the download threads of the server)
+* "list": requests for the JSON list of the downloaded files
+* "result": requests for the downloaded files, reading the full body
+
+For each phase, the results contain the throughput and the p50 and p99
+latencies in seconds. The peak resident memory and open file descriptors of
+the process are sampled throughout. Results are written as JSON (to stdout,
+or to `FILE`), for comparing them across commits.
+"""
+import argparse
+import http.server
+import importlib.util
+import io
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import Event, Thread
+from urllib.parse import urlencode
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def load_server(workdir, workers):
+    """Import youtube-dl-server.py, with all its files inside `workdir`."""
+    os.environ['YDL_USERS'] = 'bench:bench:%s' % (workdir / 'out')
+    os.environ['YDL_LOGFILE'] = str(workdir / 'server.log')
+    os.environ['YDL_DL_LOGFILE'] = str(workdir / 'youtube-dl.log')
+    os.environ['YDL_JOBS_DB'] = str(workdir / 'jobs.db')
+    os.environ['YDL_LOGLEVEL'] = 'WARNING'
+    os.environ['YDL_WORKERS'] = str(workers)
+    os.environ['YDL_MAX_ACTIVE_PER_USER'] = '0'
+    os.environ['YDL_UPDATE_INTERVAL'] = '0'
+    os.environ['YDL_UPDATE_FILE'] = str(workdir / 'update.json')
+    os.environ['YDL_RETRIES'] = '0'
+    spec = importlib.util.spec_from_file_location(
+        'youtube_dl_server', str(ROOT / 'youtube-dl-server.py')
+    )
+    server = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(server)
+    return server
+
+
+def start_origin(size):
+    """Serve synthetic videos of `size` bytes on a local port.
+
+    Returns the port. Range requests are supported, so that youtube-dl can
+    resume downloads.
+    """
+    chunk = b'\0' * 65536
+
+    class OriginHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            start = 0
+            match = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+            if match:
+                start = int(match.group(1))
+                self.send_response(206)
+                content_range = 'bytes %d-%d/%d' % (start, size - 1, size)
+                self.send_header('Content-Range', content_range)
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', 'video/mp4')
+            self.send_header('Content-Length', str(size - start))
+            self.end_headers()
+            remaining = size - start
+            while remaining > 0:
+                n = min(remaining, len(chunk))
+                self.wfile.write(chunk[:n])
+                remaining -= n
+
+    origin = http.server.ThreadingHTTPServer(('127.0.0.1', 0), OriginHandler)
+    origin.daemon_threads = True
+    Thread(target=origin.serve_forever, daemon=True).start()
+    return origin.server_port
+
+
+def register_extractor(youtube_dl, port, size):
+    """Register a stub extractor for "http://bench.invalid/{{id}}" urls,
+    pointing to the origin on `port`."""
+    from youtube_dl.extractor.common import InfoExtractor
+
+    class BenchIE(InfoExtractor):
+        _VALID_URL = r'http://bench\.invalid/(?P<id>\w+)'
+        IE_NAME = 'bench'
+
+        def _real_extract(self, url):
+            video_id = self._match_id(url)
+            return {
+                'id': video_id,
+                'title': 'Bench video %s' % video_id,
+                'url': 'http://127.0.0.1:%d/%s.mp4' % (port, video_id),
+                'ext': 'mp4',
+                'height': 720,
+                'filesize': size,
+            }
+
+    youtube_dl.extractor._ALL_CLASSES.insert(0, BenchIE)
+    youtube_dl.extractor.BenchIE = BenchIE
+
+
+def call(app, path, params=None, method='GET'):
+    """Call the WSGI `app`, return the status and the response body."""
+    query = urlencode(params or {})
+    body = query.encode('ascii') if method == 'POST' else b''
+    environ = {
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'QUERY_STRING': '' if method == 'POST' else query,
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '8080',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'REMOTE_ADDR': '127.0.0.1',
+        'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+    }
+    status = []
+    response = app(environ, lambda s, h, e=None: status.append(s))
+    try:
+        body = b''.join(response)
+    finally:
+        if hasattr(response, 'close'):
+            response.close()
+    return status[0], body
+
+
+def percentile(values, p):
+    """The `p`-th percentile of `values` (nearest rank), or None."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(0, int(round(p / 100 * len(values) + 0.5)) - 1)
+    return values[min(rank, len(values) - 1)]
+
+
+def summary(latencies, elapsed, **extra):
+    """Result of a phase with the given request `latencies`, which took
+    `elapsed` seconds overall."""
+    result = {
+        "requests": len(latencies),
+        "seconds": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed else None,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+    }
+    result.update(extra)
+    return result
+
+
+def run_requests(app, requests, concurrency):
+    """Send `requests` (list of `call` arguments) with `concurrency` client
+    threads.
+
+    Returns the list of (latency, status, body) and the elapsed seconds.
+    """
+
+    def timed(args):
+        start = time.perf_counter()
+        status, body = call(app, *args)
+        return time.perf_counter() - start, status, body
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as clients:
+        results = list(clients.map(timed, requests))
+    return results, time.perf_counter() - start
+
+
+def errors(responses):
+    """Number of `responses` of :func:`run_requests` that failed."""
+    return sum(1 for (_, status, _) in responses if not status.startswith('2'))
+
+
+class ProcessSampler:
+    """Sample the resident memory and open file descriptors of the process
+    (via :func:`process_stats` of the `server`) every `interval` seconds,
+    keeping the peak values."""
+
+    def __init__(self, server, interval=0.05):
+        self.server = server
+        self.interval = interval
+        self.peak_rss_bytes = 0
+        self.peak_open_fds = 0
+        self._stop = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while True:
+            stats = self.server.process_stats()
+            self.peak_rss_bytes = max(
+                self.peak_rss_bytes, stats['rss_bytes'] or 0
+            )
+            self.peak_open_fds = max(
+                self.peak_open_fds, stats['open_fds'] or 0
+            )
+            if self._stop.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def wait_for_jobs(server, submitted, timeout):
+    """Wait until all jobs in `submitted` (job id => submission time) are
+    done, or for at most `timeout` seconds.
+
+    Returns a dict job id => completion time (for the jobs that are done).
+    """
+    completed = {}
+    version = server.JOBS.version
+    deadline = time.perf_counter() + timeout
+    while len(completed) < len(submitted):
+        for job_id in submitted:
+            if job_id not in completed:
+                if server.JOBS.get(job_id).done.is_set():
+                    completed[job_id] = time.perf_counter()
+        remaining = deadline - time.perf_counter()
+        if len(completed) == len(submitted) or remaining <= 0:
+            break
+        version = server.JOBS.wait(version, timeout=min(remaining, 1))
+    return completed
+
+
+def git_commit():
+    """The current commit of the repository, or None."""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=str(ROOT),
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(server, args):
+    app = server.APP
+    params = {'token': 'bench'}
+    results = {"commit": git_commit(), "params": vars(args)}
+    dl_threads = [
+        Thread(target=server.dl_worker, name='dl_worker-%d' % i)
+        for i in range(server.YDL_WORKERS)
+    ]
+    for dl_thread in dl_threads:
+        dl_thread.start()
+    try:
+        with ProcessSampler(server) as sampler:
+            start = time.perf_counter()
+            submitted = {}  # job id => submission time
+            rejected = []
+
+            def submit(i):
+                data = dict(params, url='http://bench.invalid/v%05d' % i)
+                t0 = time.perf_counter()
+                status, body = call(app, '/bench/submit', data, 'POST')
+                job_id = json.loads(body.decode('utf-8')).get('job')
+                if job_id is None:
+                    rejected.append(i)
+                else:
+                    submitted[job_id] = t0
+                return time.perf_counter() - t0
+
+            with ThreadPoolExecutor(max_workers=args.c) as clients:
+                latencies = list(clients.map(submit, range(args.n)))
+            results["submit"] = summary(
+                latencies, time.perf_counter() - start, errors=len(rejected)
+            )
+
+            completed = wait_for_jobs(server, submitted, args.timeout)
+            states = {}
+            for job_id in submitted:
+                state = server.JOBS.get(job_id).state
+                states[state] = states.get(state, 0) + 1
+            elapsed = time.perf_counter() - start
+            finished = states.get('finished', 0)
+            results["completion"] = summary(
+                [completed[j] - submitted[j] for j in completed],
+                elapsed,
+                states=states,
+                bytes_per_second=finished * args.size / elapsed,
+            )
+
+            list_params = dict(params, return_json='true')
+            responses, elapsed = run_requests(
+                app,
+                [('/bench/list', list_params)] * args.requests,
+                args.c,
+            )
+            results["list"] = summary(
+                [r[0] for r in responses], elapsed, errors=errors(responses)
+            )
+
+            outfiles = [
+                server.JOBS.get(job_id).outfile
+                for job_id in completed
+                if server.JOBS.get(job_id).state == 'finished'
+            ]
+            if outfiles:
+                requests = [
+                    ('/bench/result/%s' % outfiles[i % len(outfiles)],)
+                    for i in range(args.requests)
+                ]
+                responses, elapsed = run_requests(app, requests, args.c)
+                n_bytes = sum(len(r[2]) for r in responses)
+                results["result"] = summary(
+                    [r[0] for r in responses],
+                    elapsed,
+                    errors=errors(responses),
+                    bytes_per_second=n_bytes / elapsed,
+                )
+        results["process"] = {
+            "peak_rss_bytes": max(
+                sampler.peak_rss_bytes,
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            ),
+            "peak_open_fds": sampler.peak_open_fds,
+        }
+    finally:
+        server.EXTRACTOR.shutdown(wait=True)
+        server.DL_Q.close()
+        for dl_thread in dl_threads:
+            dl_thread.join()
+        server.POSTPROCESSOR.shutdown(wait=True)
+        server.JOBS.store.close()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', type=int, default=50, help="submitted jobs")
+    parser.add_argument('-c', type=int, default=8, help="client threads")
+    parser.add_argument(
+        '-w', '--workers', type=int, default=2, help="download threads"
+    )
+    parser.add_argument(
+        '--size', type=int, default=1000000, help="bytes per video"
+    )
+    parser.add_argument(
+        '--requests',
+        type=int,
+        default=200,
+        help="requests for the list and result phases",
+    )
+    parser.add_argument(
+        '--timeout', type=float, default=300, help="max. seconds for jobs"
+    )
+    parser.add_argument('-o', '--output', help="file for the JSON results")
+    args = parser.parse_args(argv)
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = Path(workdir)
+        server = load_server(workdir, args.workers)
+        port = start_origin(args.size)
+        register_extractor(server.youtube_dl, port, args.size)
+        results = benchmark(server, args)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""Benchmark the memory and file descriptors used by queued downloads.
+
+Run as::
+
+    python benchmarks/bench_queue.py [-n JOBS]
+
+Places `JOBS` entries on a download queue (without any download threads
+processing them) and reports the memory allocated for them (via
+:mod:`tracemalloc`) and the number of file descriptors they hold open. For
+comparison, the "legacy" numbers are obtained with queue entries the way
+earlier versions of the server built them: a YoutubeDL instance and a
+registered per-video logger with its own log file, created at submission
+time and held until a download thread reaches the entry.
+"""
+import argparse
+import gc
+import importlib.util
+import logging
+import os
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def load_server(workdir):
+    """Import youtube-dl-server.py, with all its files inside `workdir`."""
+    os.environ['YDL_USERS'] = 'bench:bench:%s' % (workdir / 'out')
+    os.environ['YDL_LOGFILE'] = str(workdir / 'server.log')
+    os.environ['YDL_DL_LOGFILE'] = str(workdir / 'youtube-dl.log')
+    os.environ['YDL_JOBS_DB'] = ':memory:'
+    os.environ['YDL_LOGLEVEL'] = 'WARNING'
+    spec = importlib.util.spec_from_file_location(
+        'youtube_dl_server', str(ROOT / 'youtube-dl-server.py')
+    )
+    server = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(server)
+    return server
+
+
+def make_job(server, i):
+    job = server.Job('bench', 'http://example.com/%d' % i, 'normalmp4')
+    job.outfile = 'video %d.mp4' % i
+    job.extractor = 'Generic'
+    job.video_id = str(i)
+    return job
+
+
+def legacy_logger(name, logfile, level):
+    """Registered logger writing to an eagerly opened `logfile` and to
+    stdout, as set up by earlier versions of the server (the current
+    :func:`configure_logging` opens log files lazily)."""
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    formatter = logging.Formatter(
+        "%(asctime)s %(name)s [%(levelname)s]  %(message)s",
+        "%Y-%m-%d %H:%M:%S",
+    )
+    for handler in [logging.FileHandler(logfile), logging.StreamHandler()]:
+        handler.setLevel(logging.DEBUG)
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    return logger
+
+
+def legacy_entry(server, job):
+    """Queue entry as built by earlier versions of the server."""
+    outpath = str(Path(server.OUTDIRS['bench']) / job.outfile)
+    ydl = server.youtube_dl.YoutubeDL(
+        {
+            'format': job.format,
+            'noplaylist': True,
+            'postprocessors': server.POSTPROCESSORS[job.preset],
+            'outtmpl': outpath,
+            'progress_hooks': [],
+            'quiet': True,
+            'no_warnings': True,
+        }
+    )
+    dl_logger = legacy_logger(
+        'youtubedl.%s' % job.video_id,
+        Path(outpath).with_suffix('.log'),
+        server.YDL_LOGLEVEL,
+    )
+    ydl.params['logger'] = dl_logger
+    reporter = server.ProgressReporter(job, dl_logger)
+    ydl.add_progress_hook(reporter)
+    return (ydl, reporter, job)
+
+
+def compact_entry(server, job):
+    """Queue entry as built by the current server."""
+    return job
+
+
+def measure(server, make_entry, n):
+    """Return the memory (bytes) and fds used by `n` queued entries."""
+    queue = server.FairQueue()
+    gc.collect()
+    fds = server.process_stats()['open_fds']
+    tracemalloc.start()
+    for i in range(n):
+        queue.put('bench', make_entry(server, make_job(server, i)))
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    fds = server.process_stats()['open_fds'] - fds
+    queue.close(cancel=True)
+    return size, fds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', type=int, default=500, help="queued jobs")
+    args = parser.parse_args(argv)
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = Path(workdir)
+        server = load_server(workdir)
+        print("%-8s %14s %14s %10s" % ("entries", "memory", "per job", "fds"))
+        for label, make_entry in [
+            ('legacy', legacy_entry),
+            ('compact', compact_entry),
+        ]:
+            size, fds = measure(server, make_entry, args.n)
+            print(
+                "%-8s %12.1fkB %12.1fkB %10s"
+                % (label, size / 1024, size / 1024 / args.n, fds)
+            )
+
+
+if __name__ == '__main__':
+    main()
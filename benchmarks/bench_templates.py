@@ -0,0 +1,102 @@
+"""Benchmark the HTML routes with and without the template cache.
+
+Run as::
+
+    python benchmarks/bench_templates.py [-n REQUESTS]
+
+The routes are called in-process through the WSGI interface of the APP, so
+the numbers reflect the cost of the request handling, not of the network.
+For comparison, the "uncached" numbers are obtained by rendering templates
+the way earlier versions of the server did: reading the template file on
+every request and passing its source to :func:`bottle.template`.
+"""
+import argparse
+import importlib.util
+import io
+import os
+import sys
+import tempfile
+import time
+from functools import partial
+from pathlib import Path
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def load_server(workdir):
+    """Import youtube-dl-server.py, with all its files inside `workdir`."""
+    os.environ['YDL_USERS'] = 'bench:bench:%s' % (workdir / 'out')
+    os.environ['YDL_LOGFILE'] = str(workdir / 'server.log')
+    os.environ['YDL_DL_LOGFILE'] = str(workdir / 'youtube-dl.log')
+    os.environ['YDL_JOBS_DB'] = ':memory:'
+    os.environ['YDL_LOGLEVEL'] = 'WARNING'
+    spec = importlib.util.spec_from_file_location(
+        'youtube_dl_server', str(ROOT / 'youtube-dl-server.py')
+    )
+    server = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(server)
+    return server
+
+
+def call(app, path, query=''):
+    """Call the WSGI `app` for a GET request, return the response body."""
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '8080',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'REMOTE_ADDR': '127.0.0.1',
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+    }
+    status = []
+    body = b''.join(app(environ, lambda s, h, e=None: status.append(s)))
+    assert status[0].startswith('200'), status[0]
+    return body
+
+
+def requests_per_second(app, path, query, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        call(app, path, query)
+    return n / (time.perf_counter() - start)
+
+
+def render_uncached(server, name, **kwargs):
+    """Render template `name` without the TEMPLATE_CACHE."""
+    source = (server.TEMPLATES / name).read_text()
+    return server.bottle.template(source, **kwargs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', type=int, default=2000, help="requests/route")
+    args = parser.parse_args(argv)
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = Path(workdir)
+        server = load_server(workdir)
+        for i in range(100):
+            (workdir / 'out' / ('video %03d.mp4' % i)).write_bytes(b'')
+        routes = [
+            ('/bench', 'token=bench'),
+            ('/bench/list', 'token=bench&limit=50'),
+            ('/bench/result/video 001.mp4', 'download=false'),
+        ]
+        print("%-30s %12s %12s %8s" % ("route", "uncached", "cached", "gain"))
+        for path, query in routes:
+            server.TEMPLATE_CACHE.render = partial(render_uncached, server)
+            uncached = requests_per_second(server.APP, path, query, args.n)
+            del server.TEMPLATE_CACHE.render
+            cached = requests_per_second(server.APP, path, query, args.n)
+            print(
+                "%-30s %10.0f/s %10.0f/s %7.2fx"
+                % (path, uncached, cached, cached / uncached)
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Fixtures for testing youtube-dl-server.py."""
+import importlib.util
+import io
+from pathlib import Path
+from urllib.parse import urlencode
+
+import pytest
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture
+def load_server(tmp_path, monkeypatch):
+    """Factory importing a fresh copy of youtube-dl-server.py.
+
+    All files of the server are inside `tmp_path`, which is also the working
+    directory. Environment variables for the configuration are given as
+    keyword arguments; `YDL_USERS` defaults to users "alice" and "bob" with
+    output directories in `tmp_path`.
+    """
+    servers = []
+
+    def load(**env):
+        monkeypatch.chdir(tmp_path)
+        env.setdefault('YDL_USERS', 'alice:a:./alice;bob:b:./bob')
+        env.setdefault('YDL_LOGFILE', str(tmp_path / 'server.log'))
+        env.setdefault('YDL_DL_LOGFILE', str(tmp_path / 'youtube-dl.log'))
+        env.setdefault('YDL_JOBS_DB', ':memory:')
+        env.setdefault('YDL_UPDATE_INTERVAL', '0')
+        env.setdefault('YDL_LOGLEVEL', 'WARNING')
+        for name, value in env.items():
+            monkeypatch.setenv(name, value)
+        spec = importlib.util.spec_from_file_location(
+            'youtube_dl_server', str(ROOT / 'youtube-dl-server.py')
+        )
+        server = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(server)
+        servers.append(server)
+        return server
+
+    yield load
+    for server in servers:
+        server.STOPPING.set()
+        server.JOBS.notify()
+        server.EXTRACTOR.shutdown(wait=False)
+        server.POSTPROCESSOR.shutdown(wait=False)
+
+
+def call(app, path, params=None, method='GET', environ=None):
+    """Call the WSGI `app` for `path`, with the given query (or form)
+    `params`, and return the status, the headers, and the body."""
+    query = urlencode(params or {})
+    body = query.encode() if method == 'POST' else b''
+    env = {
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'QUERY_STRING': '' if method == 'POST' else query,
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '8080',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'REMOTE_ADDR': '127.0.0.1',
+        'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': io.StringIO(),
+    }
+    env.update(environ or {})
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = status
+        response['headers'] = dict(headers)
+
+    body = b''.join(app(env, start_response))
+    return response['status'], response['headers'], body
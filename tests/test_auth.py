@@ -0,0 +1,75 @@
+"""Tests for the throttling of failed authorization attempts."""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from conftest import call
+
+
+@pytest.fixture
+def server(load_server, monkeypatch):
+    server = load_server(YDL_TRUSTED_PROXIES='10.0.0.1')
+    throttle = server.AuthThrottle(delay=0.2, max_delay=1)
+    monkeypatch.setattr(server, 'AUTH_THROTTLE', throttle)
+    return server
+
+
+def get_jobs(server, token, **environ):
+    start = time.monotonic()
+    status, headers, _ = call(
+        server.APP, '/alice/jobs', {'token': token}, environ=environ
+    )
+    return status, headers, time.monotonic() - start
+
+
+def test_failures_are_rejected_right_away(server):
+    status, _, elapsed = get_jobs(server, 'wrong')
+    assert status == '401 Unauthorized'
+    assert elapsed < 0.1
+    status, headers, elapsed = get_jobs(server, 'wrong')
+    assert status == '429 Too Many Requests'
+    assert headers['Retry-After'] == '1'
+    assert elapsed < 0.1
+    assert server.AUTH_THROTTLE._failures['127.0.0.1'][0] == 2
+    time.sleep(0.45)  # the second failure blocks for 0.4 seconds
+    status, _, _ = get_jobs(server, 'wrong')
+    assert status == '401 Unauthorized'
+
+
+def test_correct_token_while_blocked_is_accepted(server):
+    get_jobs(server, 'wrong')
+    assert server.AUTH_THROTTLE.retry_after('127.0.0.1') > 0
+    status, _, elapsed = get_jobs(server, 'a')
+    assert status == '200 OK'
+    assert elapsed < 0.1
+
+
+def test_forwarded_for_is_ignored_without_trusted_proxy(server):
+    for i in range(2):
+        get_jobs(server, 'wrong', HTTP_X_FORWARDED_FOR='192.0.2.%d' % i)
+    assert server.AUTH_THROTTLE._failures.keys() == {'127.0.0.1'}
+    assert server.AUTH_THROTTLE._failures['127.0.0.1'][0] == 2
+
+
+def test_forwarded_for_from_trusted_proxy(server):
+    get_jobs(
+        server,
+        'wrong',
+        REMOTE_ADDR='10.0.0.1',
+        HTTP_X_FORWARDED_FOR='203.0.113.7, 192.0.2.1, 10.0.0.1',
+    )
+    assert server.AUTH_THROTTLE._failures.keys() == {'192.0.2.1'}
+
+
+def test_parallel_failures_do_not_wait(server):
+    with ThreadPoolExecutor(8) as executor:
+        results = list(
+            executor.map(lambda _: get_jobs(server, 'wrong'), range(16))
+        )
+    statuses = sorted(status for (status, _, _) in results)
+    assert statuses.count('401 Unauthorized') >= 1
+    assert statuses.count('429 Too Many Requests') >= 8
+    assert max(elapsed for (_, _, elapsed) in results) < 0.5
+    status, _, _ = get_jobs(server, 'a')
+    assert status == '200 OK'
@@ -0,0 +1,104 @@
+"""Tests for the division of the download bandwidth."""
+import time
+
+import pytest
+
+INF = float('inf')
+
+
+@pytest.fixture
+def server(load_server):
+    return load_server()
+
+
+@pytest.mark.parametrize(
+    'demands, budget, allocation',
+    [
+        ({}, 100, {}),
+        ({'a': INF, 'b': INF}, 100, {'a': 50, 'b': 50}),
+        ({'a': 10, 'b': INF, 'c': INF}, 100, {'a': 10, 'b': 45, 'c': 45}),
+        ({'a': 10, 'b': 20, 'c': INF}, 100, {'a': 10, 'b': 20, 'c': 70}),
+        ({'a': 10, 'b': 20}, 100, {'a': 10, 'b': 20}),
+        ({'a': 40, 'b': 40, 'c': 40}, 90, {'a': 30, 'b': 30, 'c': 30}),
+        ({'a': 20, 'b': 50, 'c': 50}, 90, {'a': 20, 'b': 35, 'c': 35}),
+    ],
+)
+def test_divide(server, demands, budget, allocation):
+    assert server.BandwidthManager._divide(demands, budget) == allocation
+
+
+def job_for(server, username):
+    return server.Job(username, 'http://example.com/%s' % username, 'mp4')
+
+
+@pytest.mark.parametrize(
+    'limit, user_limits, users, rates',
+    [
+        # no limits at all
+        (0, {}, ['alice', 'bob'], [None, None]),
+        # equal shares of the total
+        (900, {}, ['alice', 'bob', 'bob'], [300, 300, 300]),
+        # alice is capped below her share, bob gets the remainder
+        (900, {'alice': 100}, ['alice', 'bob', 'bob'], [100, 400, 400]),
+        # alice's cap is divided among her downloads
+        (900, {'alice': 100}, ['alice', 'alice', 'bob'], [50, 50, 800]),
+        # only a per-user cap
+        (0, {'alice': 100}, ['alice', 'alice', 'bob'], [50, 50, None]),
+    ],
+)
+def test_rates(server, limit, user_limits, users, rates):
+    bandwidth = server.BandwidthManager(limit=limit, user_limits=user_limits)
+    jobs = [job_for(server, username) for username in users]
+    params = [{} for _ in jobs]
+    for job, ydl_params in zip(jobs, params):
+        bandwidth.add(job, ydl_params)
+    assert [job.rate_limit for job in jobs] == rates
+    assert [ydl_params.get('ratelimit') for ydl_params in params] == rates
+
+
+def test_rates_change_when_downloads_end(server):
+    bandwidth = server.BandwidthManager(limit=900)
+    first, second = job_for(server, 'alice'), job_for(server, 'bob')
+    bandwidth.add(first, {})
+    assert first.rate_limit == 900
+    bandwidth.add(second, {})
+    assert first.rate_limit == 450
+    bandwidth.remove(second)
+    assert first.rate_limit == 900
+    assert second.rate_limit is None
+
+
+def local_time(hours, minutes):
+    return time.mktime((2026, 1, 15, hours, minutes, 0, 0, 0, -1))
+
+
+@pytest.mark.parametrize(
+    'window, hours, minutes, inside',
+    [
+        ('01:00-06:00', 3, 0, True),
+        ('01:00-06:00', 6, 0, False),
+        ('22:00-06:00', 23, 30, True),
+        ('22:00-06:00', 5, 59, True),
+        ('22:00-06:00', 12, 0, False),
+        ('', 12, 0, True),
+    ],
+)
+def test_offpeak_window(server, window, hours, minutes, inside):
+    window = server.parse_window(window)
+    assert server.in_window(window, local_time(hours, minutes)) == inside
+
+
+def test_low_priority_jobs_wait_for_offpeak(server, monkeypatch):
+    window = server.parse_window('01:00-02:00')
+    monkeypatch.setattr(server, 'OFFPEAK_WINDOW', window)
+    monkeypatch.setattr(server, 'in_window', lambda window: False)
+    queue = server.FairQueue(ready=server.job_is_ready)
+    low = job_for(server, 'alice')
+    low.priority = 'low'
+    normal = job_for(server, 'alice')
+    queue.put('alice', low)
+    queue.put('alice', normal)
+    assert queue.get() == ('alice', normal)
+    assert queue._pop() is None
+    monkeypatch.setattr(server, 'in_window', lambda window: True)
+    assert queue.get() == ('alice', low)
@@ -0,0 +1,169 @@
+"""Tests for batch submissions and the expansion of playlists."""
+import io
+import json
+
+import pytest
+
+from conftest import call
+
+
+def reference(url):
+    return {'_type': 'url', 'url': url, 'ie_key': 'Test'}
+
+
+def video(url):
+    return {'id': url.rsplit('/', 1)[-1], 'title': url, 'webpage_url': url}
+
+
+RESULTS = {
+    'http://t/video': video('http://t/video'),
+    'http://t/list': {
+        '_type': 'playlist',
+        'entries': iter(
+            [
+                reference('http://t/v1'),
+                reference('http://t/nested'),
+                {'_type': 'url_transparent', 'url': 'http://t/deep'},
+                video('http://t/v5'),
+            ]
+        ),
+    },
+    'http://t/v1': video('http://t/v1'),
+    'http://t/nested': {
+        '_type': 'playlist',
+        'entries': [reference('http://t/v2'), reference('http://t/v3')],
+    },
+    'http://t/v2': video('http://t/v2'),
+    'http://t/v3': video('http://t/v3'),
+    'http://t/deep': reference('http://t/nested2'),
+    'http://t/nested2': {
+        '_type': 'playlist',
+        'entries': [reference('http://t/v4'), reference('http://t/broken')],
+    },
+    'http://t/v4': video('http://t/v4'),
+}
+
+
+class FakeYoutubeDL:
+    """YoutubeDL that looks up the urls in RESULTS."""
+
+    log = []
+
+    def __init__(self, params):
+        self.params = params
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def extract_info(self, url, download=True, process=True):
+        assert not download and not process
+        self.log.append(('lookup', url))
+        if url not in RESULTS:
+            raise ValueError("Unsupported URL: %s" % url)
+        return RESULTS[url]
+
+    def process_ie_result(self, ie_result, download=True):
+        return dict(ie_result, processed=True)
+
+
+@pytest.fixture
+def server(load_server, monkeypatch):
+    server = load_server()
+    FakeYoutubeDL.log = []
+    monkeypatch.setattr(server.youtube_dl, 'YoutubeDL', FakeYoutubeDL)
+
+    def submit_download(username, url, preset, priority='normal', block=0):
+        FakeYoutubeDL.log.append(('submit', url))
+        job = server.Job(username, url, preset, priority=priority)
+        server.JOBS.add(job)
+        return {"success": True, "job": job.id}
+
+    monkeypatch.setattr(server, 'submit_download', submit_download)
+    return server
+
+
+def test_expand_nested_playlists(server):
+    batch = server.Batch('alice', ['http://t/list', 'http://t/video'], 'mp4')
+    server.expand_batch(batch)
+    assert [job.url for job in batch.jobs] == [
+        'http://t/v1',
+        'http://t/v2',
+        'http://t/v3',
+        'http://t/v4',
+        'http://t/v5',
+        'http://t/video',
+    ]
+    assert batch.errors == [
+        ('http://t/broken', "Unsupported URL: http://t/broken")
+    ]
+    assert not batch.expanding
+    # entries are looked up as they are reached
+    log = FakeYoutubeDL.log
+    assert log.index(('submit', 'http://t/v1')) < log.index(
+        ('lookup', 'http://t/nested')
+    )
+    # videos are looked up only once
+    info = server.INFO_CACHE.peek('http://t/v2', 'mp4')
+    assert info['processed'] and info['id'] == 'v2'
+    assert server.INFO_CACHE.peek('http://t/v5', 'mp4') is None
+
+
+def test_expansion_depth_is_limited(server):
+    batch = server.Batch('alice', ['http://t/loop'], 'mp4')
+    RESULTS['http://t/loop'] = {
+        '_type': 'playlist',
+        'entries': [reference('http://t/loop')],
+    }
+    try:
+        server.expand_batch(batch)
+    finally:
+        del RESULTS['http://t/loop']
+    assert [job.url for job in batch.jobs] == ['http://t/loop']
+
+
+def post_json(server, body):
+    data = body.encode()
+    return call(
+        server.APP,
+        '/alice/batch',
+        method='POST',
+        environ={
+            'CONTENT_TYPE': 'application/json',
+            'CONTENT_LENGTH': str(len(data)),
+            'wsgi.input': io.BytesIO(data),
+        },
+    )
+
+
+@pytest.mark.parametrize(
+    'body, error',
+    [
+        ('{"urls": [', "invalid JSON body"),
+        ('["http://t/video"]', "invalid JSON body"),
+        ('{"token": "a", "urls": "http://t/video"}', "'urls' must be a list"),
+        ('{"token": "a", "urls": [1]}', "'urls' must be a list"),
+        (
+            '{"token": "a", "urls": ["http://t/video"], "preset": 1}',
+            "invalid 'preset'",
+        ),
+    ],
+)
+def test_invalid_json_body(server, body, error):
+    status, headers, response = post_json(server, body)
+    assert status == '400 Bad Request'
+    assert headers['Content-Type'] == 'application/json'
+    result = json.loads(response)
+    assert not result['success']
+    assert result['error'].startswith(error)
+
+
+def test_json_body(server, monkeypatch):
+    monkeypatch.setattr(server, 'submit_batch', lambda *args, **kw: None)
+    status, _, response = post_json(
+        server, '{"token": "a", "urls": ["http://t/video"]}'
+    )
+    assert status == '200 OK'
+    assert json.loads(response)['error'] == "server is shutting down"
@@ -0,0 +1,72 @@
+"""Tests for the deduplication of downloads of the same video."""
+import pytest
+
+
+@pytest.fixture
+def server(load_server):
+    return load_server()
+
+
+def make_job(server, username, outfile='Video-abc.mp4'):
+    job = server.Job(username, 'http://example.com/abc', 'mp4')
+    job.extractor = 'Example'
+    job.video_id = 'abc'
+    job.outfile = outfile
+    server.JOBS.add(job)
+    return job
+
+
+def test_claim_and_release(server):
+    dedup = server.Deduplicator()
+    primary = make_job(server, 'alice')
+    follower = make_job(server, 'bob')
+    other = make_job(server, 'bob')
+    other.video_id = 'xyz'
+    assert dedup.claim(primary) is None
+    assert dedup.claim(follower) is primary
+    assert dedup.claim(other) is None
+    assert dedup.release(primary) == [follower]
+    assert dedup.release(primary) == []
+    assert dedup.claim(follower) is None  # the key is free again
+
+
+def test_followers_receive_the_file(server, tmp_path):
+    primary = make_job(server, 'alice')
+    follower = make_job(server, 'bob')
+    assert server.DEDUP.claim(primary) is None
+    assert server.DEDUP.claim(follower) is primary
+    for username in ('alice', 'bob'):
+        (tmp_path / username).mkdir(exist_ok=True)
+    outpath = tmp_path / 'alice' / 'Video-abc.mp4'
+    outpath.write_bytes(b'video')
+    server.complete_job(primary, str(outpath))
+    assert primary.state == 'finished'
+    assert follower.state == 'finished'
+    assert (tmp_path / 'bob' / 'Video-abc.mp4').read_bytes() == b'video'
+
+
+def test_followers_fail_with_the_primary(server):
+    primary = make_job(server, 'alice')
+    follower = make_job(server, 'bob')
+    server.DEDUP.claim(primary)
+    server.DEDUP.claim(follower)
+    server.retry_or_fail(primary, "gone", 'permanent', 'download')
+    assert primary.state == 'failed'
+    assert follower.state == 'failed'
+    assert follower.error == "gone"
+    assert server.DEDUP.claim(make_job(server, 'bob')) is None
+
+
+def test_followers_are_retried_with_the_primary(server, monkeypatch):
+    scheduled = []
+    monkeypatch.setattr(server.RETRIES, 'schedule', scheduled.append)
+    primary = make_job(server, 'alice')
+    follower = make_job(server, 'bob')
+    server.DEDUP.claim(primary)
+    server.DEDUP.claim(follower)
+    server.retry_or_fail(primary, "timed out", 'network', 'download')
+    assert scheduled == [primary, follower]
+    assert follower.state == 'retrying'
+    assert follower.attempts == 1
+    # the retried jobs claim the key again when they are extracted anew
+    assert server.DEDUP.claim(follower) is None
@@ -0,0 +1,39 @@
+"""Tests for deriving files from existing files of a higher-quality preset."""
+import os
+
+import pytest
+
+
+def derive(server, tmp_path, username, source):
+    job = server.Job(username, 'http://example.com/x', 'normalmp4')
+    job.outfile = 'Video [x].mp4'
+    job.extractor = 'Generic'
+    job.video_id = 'x'
+    server.JOBS.add(job)
+    server.derive_job(job, source, 720)
+    assert job.state == 'finished'
+    return tmp_path / username / job.outfile
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="chown requires root")
+def test_link_across_users_keeps_owner_of_source(load_server, tmp_path):
+    server = load_server(
+        YDL_USERS='alice:a:./alice:1001:1001;bob:b:./bob:1002:1002'
+    )
+    source = tmp_path / 'alice' / 'Video [x].mp4'
+    source.write_bytes(b'video' * 1000)
+    os.chown(str(source), 1001, 1001)
+    outpath = derive(server, tmp_path, 'bob', source)
+    src_stat, out_stat = source.stat(), outpath.stat()
+    assert (src_stat.st_uid, src_stat.st_gid) == (1001, 1001)
+    assert src_stat.st_nlink == 1
+    assert (out_stat.st_uid, out_stat.st_gid) == (1002, 1002)
+    assert outpath.read_bytes() == source.read_bytes()
+
+
+def test_link_for_same_owner_is_hardlink(load_server, tmp_path):
+    server = load_server()
+    source = tmp_path / 'alice' / 'Video [x].mp4'
+    source.write_bytes(b'video' * 1000)
+    outpath = derive(server, tmp_path, 'bob', source)
+    assert os.path.samefile(str(source), str(outpath))
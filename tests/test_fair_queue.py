@@ -0,0 +1,76 @@
+"""Tests for the round-robin download queue."""
+from threading import Thread
+
+import pytest
+
+
+@pytest.fixture
+def server(load_server):
+    return load_server()
+
+
+def test_round_robin_between_users(server):
+    queue = server.FairQueue()
+    for i in range(3):
+        queue.put('alice', 'a%d' % i)
+    queue.put('bob', 'b0')
+    queue.put('carol', 'c0')
+    queue.put('bob', 'b1')
+    order = [queue.get() for _ in range(6)]
+    assert order == [
+        ('alice', 'a0'),
+        ('bob', 'b0'),
+        ('carol', 'c0'),
+        ('alice', 'a1'),
+        ('bob', 'b1'),
+        ('alice', 'a2'),
+    ]
+    assert queue.active() == {'alice': 3, 'bob': 2, 'carol': 1}
+
+
+def test_max_active_per_user(server):
+    queue = server.FairQueue(max_per_user=1)
+    queue.put('alice', 'a0')
+    queue.put('alice', 'a1')
+    queue.put('bob', 'b0')
+    assert queue.get() == ('alice', 'a0')
+    assert queue.get() == ('bob', 'b0')
+    got = []
+    waiting = Thread(target=lambda: got.append(queue.get()), daemon=True)
+    waiting.start()
+    waiting.join(0.2)
+    assert waiting.is_alive()  # alice is at the limit
+    queue.task_done('alice')
+    waiting.join(5)
+    assert got == [('alice', 'a1')]
+    assert queue.active() == {'alice': 1, 'bob': 1}
+
+
+def test_max_active(server):
+    queue = server.FairQueue(max_active=1)
+    queue.put('alice', 'a0')
+    queue.put('bob', 'b0')
+    assert queue.get() == ('alice', 'a0')
+    assert queue._pop() is None
+    queue.task_done('alice')
+    assert queue.get() == ('bob', 'b0')
+
+
+def test_task_done_when_download_raises(server, monkeypatch):
+    def download(ydl, job):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(server, 'download', download)
+    monkeypatch.setattr(server, 'DL_Q', server.FairQueue(max_per_user=1))
+    job = server.Job('alice', 'http://example.com/v', 'mp4')
+    job.outfile = 'v.mp4'
+    server.JOBS.add(job)
+    server.DL_Q.put('alice', job)
+    server.DL_Q.close()
+    worker = Thread(target=server.dl_worker, daemon=True)
+    worker.start()
+    worker.join(10)
+    assert not worker.is_alive()
+    assert server.DL_Q.active() == {}
+    assert server.DL_Q._unfinished == 0
+    assert job.state in ('retrying', 'failed')
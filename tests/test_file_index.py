@@ -0,0 +1,89 @@
+"""Tests for the index of the downloaded files."""
+import os
+
+import pytest
+
+from conftest import call
+
+
+@pytest.fixture
+def server(load_server):
+    return load_server()
+
+
+@pytest.fixture
+def outdir(tmp_path):
+    outdir = tmp_path / 'alice'
+    outdir.mkdir(exist_ok=True)
+    for (i, name) in enumerate(['b.mp4', 'a.mp4', 'c.mp3', 'notes.txt']):
+        path = outdir / name
+        path.write_bytes(b'\0' * (300 - 100 * i))
+        os.utime(str(path), (1000 + i, 1000 + i))
+    return outdir
+
+
+def names(listing):
+    return [name for (name, *_) in listing[1]]
+
+
+def test_listing(server, outdir):
+    index = server.FileIndex(outdir)
+    assert index.listing(sort='name') == (
+        3,
+        [
+            ('a.mp4', 200, os.stat(outdir / 'a.mp4').st_ctime, 1001),
+            ('b.mp4', 300, os.stat(outdir / 'b.mp4').st_ctime, 1000),
+            ('c.mp3', 100, os.stat(outdir / 'c.mp3').st_ctime, 1002),
+        ],
+    )
+    assert names(index.listing(sort='size')) == ['c.mp3', 'a.mp4', 'b.mp4']
+    assert names(index.listing(sort='mtime')) == ['b.mp4', 'a.mp4', 'c.mp3']
+    assert index.listing(sort='name', offset=1, limit=1)[0] == 3
+    assert names(index.listing(sort='name', offset=1, limit=1)) == ['b.mp4']
+    assert names(index.listing(sort='size', prefix='b')) == ['b.mp4']
+    assert index.listing(sort='name', prefix='x') == (0, [])
+
+
+def test_refresh_on_directory_change(server, outdir):
+    index = server.FileIndex(outdir)
+    assert index.listing(sort='name')[0] == 3
+    (outdir / 'd.mp4').write_bytes(b'\0' * 50)
+    (outdir / 'a.mp4').unlink()
+    # the listing is only updated by the next refresh
+    assert names(index.listing(sort='name')) == ['a.mp4', 'b.mp4', 'c.mp3']
+    index.refresh()
+    assert names(index.listing(sort='name')) == ['b.mp4', 'c.mp3', 'd.mp4']
+
+
+def test_refresh_replaced_file(server, outdir):
+    index = server.FileIndex(outdir)
+    index.refresh()
+    replacement = outdir / 'b.mp4.tmp'
+    replacement.write_bytes(b'\0' * 10)
+    replacement.replace(outdir / 'b.mp4')
+    index.refresh()
+    assert index.listing(sort='name', prefix='b')[1][0][1] == 10
+    assert index.total == 310
+
+
+def test_add_and_remove(server, outdir):
+    index = server.FileIndex(outdir)
+    index.refresh()
+    (outdir / 'a.mp4').write_bytes(b'\0' * 20)  # same directory mtime
+    index.add('a.mp4')
+    index.remove('c.mp3')
+    index.add('notes.txt')  # not a video
+    assert index.listing(sort='size')[1][0][:2] == ('a.mp4', 20)
+    assert names(index.listing(sort='name')) == ['a.mp4', 'b.mp4']
+
+
+def test_list_route(server, outdir):
+    status, _, body = call(
+        server.APP,
+        '/alice/list',
+        {'token': 'a', 'return_json': 'true', 'sort': 'size', 'limit': 2},
+    )
+    assert status == '200 OK'
+    assert b'"total": 3' in body
+    assert body.index(b'c.mp3') < body.index(b'a.mp4')
+    assert b'b.mp4' not in body
@@ -0,0 +1,57 @@
+"""Tests for the cache of extracted video information."""
+import pytest
+
+
+@pytest.fixture
+def server(load_server):
+    return load_server()
+
+
+def test_lookup_by_normalized_url_and_preset(server):
+    cache = server.InfoCache(maxsize=4, ttl=60)
+    cache.put('HTTP://Example.com/watch?v=1&b=2#t=10', 'mp4', {'id': '1'})
+    assert cache.get('http://example.com/watch?b=2&v=1', 'mp4') == {'id': '1'}
+    assert cache.get('http://example.com/watch?b=2&v=1', 'mp3') is None
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_entries_expire(server, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(server.time, 'time', lambda: now[0])
+    cache = server.InfoCache(maxsize=4, ttl=60)
+    cache.put('http://a/1', 'mp4', {'id': '1'})
+    now[0] += 59
+    assert cache.get('http://a/1', 'mp4') == {'id': '1'}
+    now[0] += 2
+    assert cache.get('http://a/1', 'mp4') is None
+    assert cache.stats()['size'] == 0
+
+
+def test_least_recently_used_entry_is_evicted(server):
+    cache = server.InfoCache(maxsize=2, ttl=60)
+    cache.put('http://a/1', 'mp4', {'id': '1'})
+    cache.put('http://a/2', 'mp4', {'id': '2'})
+    assert cache.get('http://a/1', 'mp4') == {'id': '1'}
+    cache.put('http://a/3', 'mp4', {'id': '3'})
+    assert cache.peek('http://a/2', 'mp4') is None
+    assert cache.peek('http://a/1', 'mp4') == {'id': '1'}
+    assert cache.peek('http://a/3', 'mp4') == {'id': '3'}
+    assert cache.stats()['evictions'] == 1
+
+
+def test_disabled_cache(server):
+    cache = server.InfoCache(maxsize=0)
+    cache.put('http://a/1', 'mp4', {'id': '1'})
+    assert cache.get('http://a/1', 'mp4') is None
+
+
+def test_save_and_load(server, tmp_path):
+    cache = server.InfoCache(maxsize=4, ttl=60)
+    cache.put('http://a/1', 'mp4', {'id': '1'})
+    cache.put('http://a/2', 'mp4', {'id': '2', 'bad': object()})
+    cache.save(tmp_path / 'cache.json')
+    loaded = server.InfoCache(maxsize=4, ttl=60)
+    loaded.load(tmp_path / 'cache.json')
+    assert loaded.get('http://a/1', 'mp4') == {'id': '1'}
+    assert loaded.get('http://a/2', 'mp4') is None
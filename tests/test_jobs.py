@@ -0,0 +1,102 @@
+"""Tests for the registry and the persistent storage of jobs."""
+import time
+
+import pytest
+
+
+@pytest.fixture
+def server(load_server, tmp_path):
+    return load_server(YDL_JOBS_DB=str(tmp_path / 'jobs.db'))
+
+
+def make_job(server, registry, url, username='alice'):
+    job = server.Job(username, url, 'mp4')
+    registry.add(job)
+    return job
+
+
+def test_only_recent_finished_jobs_are_kept(server, tmp_path):
+    registry = server.JobRegistry(
+        server.JobStore(tmp_path / 'history.db'), history=2
+    )
+    jobs = [make_job(server, registry, 'http://a/%d' % i) for i in range(5)]
+    for i in (2, 0, 1, 3):
+        registry.update(jobs[i], 'finished')
+    # the two most recently finished jobs, and the unfinished one
+    assert list(registry._jobs) == [jobs[i].id for i in (1, 3, 4)]
+    assert registry.jobs_for('alice') == [jobs[1], jobs[3], jobs[4]]
+    # jobs dropped from memory are still in the store
+    assert registry.get(jobs[2].id).state == 'finished'
+
+
+def test_requeued_job_is_not_dropped(server, tmp_path):
+    registry = server.JobRegistry(
+        server.JobStore(tmp_path / 'history.db'), history=1
+    )
+    first = make_job(server, registry, 'http://a/0')
+    registry.update(first, 'failed', error="boom")
+    first.reset()
+    registry.update(first, 'pending')
+    second = make_job(server, registry, 'http://a/1')
+    registry.update(second, 'finished')
+    third = make_job(server, registry, 'http://a/2')
+    registry.update(third, 'finished')
+    assert list(registry._jobs) == [first.id, third.id]
+
+
+def test_compaction(server, tmp_path):
+    store = server.JobStore(tmp_path / 'compact.db', compact_every=2)
+    registry = server.JobRegistry(store)
+    old = make_job(server, registry, 'http://a/old')
+    registry.update(old, 'finished')
+    pending = make_job(server, registry, 'http://a/pending')
+    store._db.execute(
+        'UPDATE jobs SET updated = ?', (time.time() - 8 * 86400,)
+    )
+    recent = make_job(server, registry, 'http://a/recent')
+    registry.update(recent, 'finished')  # second finished job: compact
+    assert store.get(old.id) is None
+    assert store.get(pending.id) is not None
+    assert store.get(recent.id) is not None
+
+
+def test_resume_jobs(server, tmp_path, monkeypatch):
+    previous = server.JOBS
+    interrupted = make_job(server, previous, 'http://a/interrupted')
+    interrupted.attempts = 2
+    interrupted.error_class = 'network'
+    previous.update(interrupted, 'interrupted', error="shutdown")
+    pending = make_job(server, previous, 'http://a/pending')
+    retrying = make_job(server, previous, 'http://a/retrying')
+    retrying.attempts = 1
+    retrying.error_class = 'network'
+    retrying.retry_at = time.time() + 100
+    previous.update(retrying, 'retrying', error="timed out")
+    finished = make_job(server, previous, 'http://a/finished')
+    previous.update(finished, 'finished')
+    unknown = make_job(server, previous, 'http://a/unknown', 'mallory')
+
+    submitted = []
+
+    def submit_to_extractor(job):
+        submitted.append(job)
+        return True
+
+    monkeypatch.setattr(server, '_submit_to_extractor', submit_to_extractor)
+    retries = server.RetryScheduler(submit=lambda job: None)
+    monkeypatch.setattr(server, 'RETRIES', retries)
+    registry = server.JobRegistry(server.JobStore(tmp_path / 'jobs.db'))
+    monkeypatch.setattr(server, 'JOBS', registry)
+    server.resume_jobs()
+
+    assert [job.id for job in submitted] == [interrupted.id, pending.id]
+    assert all(job.state == 'pending' for job in submitted)
+    assert submitted[0].attempts == 2
+    assert submitted[0].error_class == 'network'
+    resumed = registry.get(retrying.id)
+    assert resumed.state == 'retrying'
+    assert resumed.attempts == 1
+    assert resumed.retry_at == pytest.approx(retrying.retry_at)
+    assert retries._heap[0][2] is resumed
+    assert registry.get(unknown.id).error == "unknown user"
+    assert registry.store.get(interrupted.id)['attempts'] == 2
@@ -0,0 +1,102 @@
+"""Tests for the disk quotas and the retention policy."""
+import types
+
+import pytest
+
+
+@pytest.fixture
+def free_space(monkeypatch):
+    """Function setting the free space reported for all file systems."""
+
+    def set_free_space(server, free):
+        usage = types.SimpleNamespace(total=10**12, used=0, free=free)
+        monkeypatch.setattr(server.shutil, 'disk_usage', lambda path: usage)
+
+    return set_free_space
+
+
+def make_files(tmp_path, username, *names, size=1000):
+    outdir = tmp_path / username
+    outdir.mkdir(exist_ok=True)
+    for name in names:
+        (outdir / name).write_bytes(b'\0' * size)
+    return outdir
+
+
+def test_default_config_never_removes_files(load_server, tmp_path, free_space):
+    server = load_server()
+    free_space(server, 1500)
+    alice = make_files(tmp_path, 'alice', 'alice video 0.mp4')
+    bob = make_files(tmp_path, 'bob', 'bob video 0.mp4')
+    assert not server.RETENTION.active
+    error = server.RETENTION.admit('bob', 2000, {})
+    assert error is not None and "full" in error
+    assert server.RETENTION.admit('bob', 1000, {}) is None
+    assert server.RETENTION.sweep({'./alice/': 10**6}) != []
+    assert (alice / 'alice video 0.mp4').is_file()
+    assert (bob / 'bob video 0.mp4').is_file()
+
+
+def test_admission_only_removes_own_files(load_server, tmp_path, free_space):
+    server = load_server(YDL_MIN_FREE='1000')
+    free_space(server, 2500)
+    alice = make_files(tmp_path, 'alice', 'a0.mp4', 'a1.mp4')
+    bob = make_files(tmp_path, 'bob', 'b0.mp4')
+    # room for 1500 bytes requires removing two files, but bob has only one
+    assert server.RETENTION.admit('bob', 3000, {}) is not None
+    assert sorted(p.name for p in alice.iterdir()) == ['a0.mp4', 'a1.mp4']
+    assert (bob / 'b0.mp4').is_file()
+    assert server.RETENTION.admit('bob', 2500, {}) is None
+    assert not (bob / 'b0.mp4').exists()
+    assert sorted(p.name for p in alice.iterdir()) == ['a0.mp4', 'a1.mp4']
+
+
+def test_evict_others(load_server, tmp_path, free_space):
+    server = load_server(YDL_MIN_FREE='1000', YDL_EVICT_OTHERS='true')
+    free_space(server, 2500)
+    alice = make_files(tmp_path, 'alice', 'a0.mp4', 'a1.mp4')
+    assert server.RETENTION.admit('bob', 2000, {}) is None
+    assert len(list(alice.iterdir())) == 1
+
+
+def test_quota_removes_least_recently_used_unpinned(
+    load_server, tmp_path, free_space
+):
+    server = load_server(YDL_USERS='alice:a:./alice::::3000;bob:b:./bob')
+    free_space(server, 10**9)
+    alice = make_files(tmp_path, 'alice', 'a0.mp4', 'a1.mp4', 'a2.mp4')
+    server.RETENTION.touch('alice', 'a0.mp4')
+    server.RETENTION.pin('alice', 'a1.mp4')
+    assert server.RETENTION.admit('alice', 1000, {}) is None
+    assert sorted(p.name for p in alice.iterdir()) == ['a0.mp4', 'a1.mp4']
+    assert server.RETENTION.admit('alice', 2500, {}) is not None
+    assert sorted(p.name for p in alice.iterdir()) == ['a0.mp4', 'a1.mp4']
+    # bob has no quota, and alice's quota does not apply to him
+    assert server.RETENTION.admit('bob', 10**6, {}) is None
+
+
+def test_admission_within_limits_uses_index_totals(
+    load_server, tmp_path, free_space, monkeypatch
+):
+    server = load_server(YDL_USERS='alice:a:./alice::::3000;bob:b:./bob')
+    free_space(server, 10**9)
+    make_files(tmp_path, 'alice', 'a0.mp4', 'a1.mp4')
+    index = server.FILE_INDEX['./alice/']
+    index.refresh()
+    assert index.total == 2000
+
+    def scan():
+        raise AssertionError("files were listed")
+
+    monkeypatch.setattr(server.RETENTION, '_scan', scan)
+    assert server.RETENTION.admit('alice', 1000, {}) is None
+    make_files(tmp_path, 'alice', 'a2.mp4', size=500)
+    index.add('a2.mp4')
+    assert index.total == 2500
+    index.remove('a0.mp4')
+    assert index.total == 1500
+    index.refresh()  # the directory has changed
+    assert index.total == 2500
+    del server.RETENTION._scan
+    assert server.RETENTION.admit('alice', 1000, {}) is None
+    assert index.total == 1500  # the least recently used file was removed
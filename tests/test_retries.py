@@ -0,0 +1,107 @@
+"""Tests for the classification of errors and the retries of jobs."""
+import json
+from urllib.error import HTTPError, URLError
+
+import pytest
+
+from conftest import call
+
+
+@pytest.fixture
+def server(load_server):
+    return load_server()
+
+
+def errors(utils):
+    """List of tuples (exception, error class) for the youtube_dl `utils`."""
+    url_error = URLError('timed out')
+    wrapped = (URLError, url_error, None)
+    return [
+        (url_error, 'network'),
+        (ConnectionResetError(), 'network'),
+        (utils.DownloadError('ERROR: timed out', wrapped), 'network'),
+        (utils.DownloadError('ERROR: giving up after 10 retries'), 'network'),
+        (utils.DownloadError('ERROR: This video is private'), 'permanent'),
+        (utils.ExtractorError('Unavailable', expected=True), 'permanent'),
+        (utils.ExtractorError('Unable to extract title'), 'extractor'),
+        (utils.ExtractorError('No data', cause=url_error), 'network'),
+        (HTTPError('http://a', 403, 'Forbidden', {}, None), 'extractor'),
+        (HTTPError('http://a', 429, 'Too Many Requests', {}, None), 'network'),
+        (HTTPError('http://a', 503, 'Unavailable', {}, None), 'network'),
+        (HTTPError('http://a', 400, 'Bad Request', {}, None), 'permanent'),
+        (utils.ContentTooShortError(10, 20), 'network'),
+        (ValueError('bad'), 'permanent'),
+    ]
+
+
+def test_classify_error(server):
+    for exc_info, error_class in errors(server.youtube_dl.utils):
+        assert server.classify_error(exc_info) == error_class, repr(exc_info)
+
+
+def test_classify_error_after_reload(server):
+    old_utils = server.youtube_dl.utils
+    server.reload_youtube_dl()
+    assert server.youtube_dl.utils is not old_utils
+    for exc_info, error_class in errors(old_utils):
+        assert server.classify_error(exc_info) == error_class, repr(exc_info)
+
+
+def test_backoff_schedule(server, monkeypatch):
+    monkeypatch.setattr(server.random, 'uniform', lambda low, high: high)
+    delays = [server.retry_delay(attempts) for attempts in range(9)]
+    assert delays == [30, 60, 120, 240, 480, 960, 1920, 3600, 3600]
+    monkeypatch.setattr(server.random, 'uniform', lambda low, high: low)
+    assert server.retry_delay(0) == 15  # jitter down to half the delay
+
+
+def failed_jobs(server):
+    _, _, body = call(server.APP, '/alice/failed', {'token': 'a'})
+    return json.loads(body)['jobs']
+
+
+def test_retries_then_dead_letter_list(server, monkeypatch):
+    scheduled = []
+    monkeypatch.setattr(server.RETRIES, 'schedule', scheduled.append)
+    job = server.Job('alice', 'http://example.com/v', 'mp4')
+    server.JOBS.add(job)
+    for attempt in range(1, server.YDL_RETRIES + 1):
+        server.retry_or_fail(job, "timed out", 'network', 'download')
+        assert job.state == 'retrying'
+        assert job.attempts == attempt
+        assert job.retry_at is not None
+        assert scheduled[-1] is job
+    assert failed_jobs(server) == []
+    server.retry_or_fail(job, "timed out", 'network', 'download')
+    assert job.state == 'failed'
+    assert len(scheduled) == server.YDL_RETRIES
+    [failed] = failed_jobs(server)
+    assert failed['job'] == job.id
+    assert failed['error_class'] == 'network'
+    assert failed['attempts'] == server.YDL_RETRIES
+
+
+def test_permanent_error_is_not_retried(server, monkeypatch):
+    submitted = []
+
+    def submit_to_extractor(job):
+        submitted.append(job)
+        return True
+
+    monkeypatch.setattr(server, '_submit_to_extractor', submit_to_extractor)
+    job = server.Job('alice', 'http://example.com/v', 'mp4')
+    server.JOBS.add(job)
+    server.retry_or_fail(job, "private video", 'permanent', 'extract')
+    assert job.state == 'failed'
+    assert [failed['job'] for failed in failed_jobs(server)] == [job.id]
+    status, _, body = call(
+        server.APP,
+        '/alice/job/%s/requeue' % job.id,
+        {'token': 'a'},
+        method='POST',
+    )
+    assert json.loads(body)['success']
+    assert submitted == [job]
+    assert job.state == 'pending'
+    assert job.attempts == 0
+    assert failed_jobs(server) == []
@@ -0,0 +1,87 @@
+"""Tests for serving downloaded files with byte ranges and ETags."""
+import pytest
+
+from conftest import call
+
+DATA = bytes(range(256)) * 4
+
+
+@pytest.fixture
+def server(load_server, tmp_path):
+    server = load_server()
+    (tmp_path / 'alice').mkdir(exist_ok=True)
+    (tmp_path / 'alice' / 'video.mp4').write_bytes(DATA)
+    return server
+
+
+def get(server, **environ):
+    return call(server.APP, '/alice/result/video.mp4', environ=environ)
+
+
+def test_full_file(server):
+    status, headers, body = get(server)
+    assert status == '200 OK'
+    assert body == DATA
+    assert headers['Content-Length'] == str(len(DATA))
+    assert headers['Content-Type'] == 'video/mp4'
+    assert headers['Accept-Ranges'] == 'bytes'
+    assert headers['Etag'].startswith('"')
+
+
+@pytest.mark.parametrize(
+    'byte_range, start, end',
+    [
+        ('bytes=0-9', 0, 10),
+        ('bytes=1000-', 1000, 1024),
+        ('bytes=-24', 1000, 1024),  # suffix range
+        ('bytes=1000-5000', 1000, 1024),
+    ],
+)
+def test_range(server, byte_range, start, end):
+    status, headers, body = get(server, HTTP_RANGE=byte_range)
+    assert status == '206 Partial Content'
+    assert body == DATA[start:end]
+    assert headers['Content-Length'] == str(end - start)
+    assert headers['Content-Range'] == 'bytes %d-%d/1024' % (start, end - 1)
+
+
+def test_unsatisfiable_range(server):
+    status, headers, body = get(server, HTTP_RANGE='bytes=2000-3000')
+    assert status == '416 Requested Range Not Satisfiable'
+    assert headers['Content-Range'] == 'bytes */1024'
+
+
+def test_not_modified(server):
+    etag = get(server)[1]['Etag']
+    status, _, body = get(server, HTTP_IF_NONE_MATCH=etag)
+    assert status == '304 Not Modified'
+    assert body == b''
+    status, _, _ = get(server, HTTP_IF_NONE_MATCH='"other"')
+    assert status == '200 OK'
+
+
+def test_if_range(server, tmp_path):
+    etag = get(server)[1]['Etag']
+    status, _, body = get(server, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag)
+    assert status == '206 Partial Content'
+    status, _, body = get(
+        server, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"'
+    )
+    assert status == '200 OK'
+    assert body == DATA
+
+
+def test_replaced_file(server, tmp_path):
+    etag = get(server)[1]['Etag']
+    replacement = tmp_path / 'alice' / 'video.tmp'
+    replacement.write_bytes(b'new')
+    replacement.replace(tmp_path / 'alice' / 'video.mp4')
+    status, headers, body = get(server, HTTP_IF_NONE_MATCH=etag)
+    assert status == '200 OK'
+    assert body == b'new'
+    assert headers['Content-Length'] == '3'
+
+
+def test_missing_file(server):
+    status, _, _ = call(server.APP, '/alice/result/missing.mp4')
+    assert status == '404 Not Found'
@@ -0,0 +1,70 @@
+"""Tests for the threaded server backend."""
+import socket
+import time
+from threading import Thread
+
+import bottle
+
+
+def start_server(server):
+    """Run the APP of `server` on a free port, in a background thread."""
+    adapter = bottle.WSGIRefServer(
+        host='127.0.0.1',
+        port=0,
+        handler_class=server.SendfileRequestHandler,
+        server_class=server.ThreadPoolWSGIServer,
+    )
+    thread = Thread(
+        target=server.APP.run,
+        kwargs=dict(server=adapter, quiet=True),
+        daemon=True,
+    )
+    thread.start()
+    while getattr(adapter, 'srv', None) is None:
+        time.sleep(0.01)
+    return adapter, thread
+
+
+def test_close_with_open_event_stream(load_server):
+    server = load_server()
+    adapter, thread = start_server(server)
+    stream = socket.create_connection(adapter.srv.server_address)
+    stream.sendall(b'GET /alice/events?token=a HTTP/1.0\r\n\r\n')
+    time.sleep(0.5)  # the request is waiting for the first event
+    # on Ctrl-C, bottle's WSGIRefServer calls server_close() right away
+    adapter.srv.shutdown()
+    thread.join(timeout=5)
+    closing = Thread(target=adapter.srv.server_close, daemon=True)
+    closing.start()
+    closing.join(timeout=5)
+    assert not closing.is_alive()
+    stream.close()
+
+
+def read_status(stream):
+    """Return the status code of the HTTP response on the socket `stream`."""
+    stream.settimeout(5)
+    return int(stream.recv(1024).split(b' ', 2)[1])
+
+
+def test_requests_answered_with_event_streams_at_cap(load_server):
+    server = load_server(YDL_SERVER_THREADS='2', YDL_MAX_EVENT_STREAMS='1')
+    adapter, thread = start_server(server)
+    address = adapter.srv.server_address
+    streams = []
+    try:
+        for expected in (200, 503, 503):
+            stream = socket.create_connection(address)
+            streams.append(stream)
+            stream.sendall(b'GET /alice/events?token=a HTTP/1.0\r\n\r\n')
+            assert read_status(stream) == expected
+        request = socket.create_connection(address)
+        streams.append(request)
+        request.sendall(b'GET /alice/jobs?token=a HTTP/1.0\r\n\r\n')
+        assert read_status(request) == 200
+    finally:
+        for stream in streams:
+            stream.close()
+        adapter.srv.shutdown()
+        adapter.srv.server_close()
+        thread.join(timeout=5)
@@ -0,0 +1,125 @@
+"""Tests for streaming files while they are downloaded."""
+import threading
+from pathlib import Path
+
+import pytest
+
+from conftest import call
+
+
+class FakeJob:
+    def __init__(self):
+        self.done = threading.Event()
+
+
+@pytest.fixture
+def server(load_server, tmp_path):
+    server = load_server(YDL_MAX_STREAMS='1')
+    (tmp_path / 'alice').mkdir(exist_ok=True)
+    return server
+
+
+@pytest.fixture
+def released():
+    return []
+
+
+def follow(server, tmp_path, job, released):
+    """Return the final path, the ".part" path and a stream of the file."""
+    path = tmp_path / 'alice' / 'video.mp4'
+    stream = server.follow_download(
+        job, path, lambda: released.append(True), chunk_size=4, poll=0
+    )
+    return path, Path(str(path) + '.part'), stream
+
+
+def test_part_file_then_final_file(server, tmp_path, released):
+    job = FakeJob()
+    path, part, stream = follow(server, tmp_path, job, released)
+    part.write_bytes(b'abcdef')
+    assert next(stream) == b'abcd'
+    assert next(stream) == b'ef'
+    with part.open('ab') as fh:
+        fh.write(b'gh')
+    assert next(stream) == b'gh'
+    # youtube-dl renames the complete ".part" file
+    with part.open('ab') as fh:
+        fh.write(b'ij')
+    part.rename(path)
+    assert next(stream) == b'ij'
+    assert list(stream) == []
+    assert released == [True]
+
+
+def test_final_file_after_done(server, tmp_path, released):
+    job = FakeJob()
+    path, part, stream = follow(server, tmp_path, job, released)
+    part.write_bytes(b'abc')
+    assert next(stream) == b'abc'
+    part.rename(path)
+    with path.open('ab') as fh:
+        fh.write(b'defg')
+    job.done.set()
+    assert b''.join(stream) == b'defg'
+    assert released == [True]
+
+
+def test_replaced_part_file(server, tmp_path, released):
+    job = FakeJob()
+    path, part, stream = follow(server, tmp_path, job, released)
+    part.write_bytes(b'abcd')
+    assert next(stream) == b'abcd'
+    # a retry starts over in a new ".part" file
+    part.unlink()
+    part.write_bytes(b'abcdefgh')
+    assert next(stream) == b'efgh'
+    stream.close()
+    assert released == [True]
+
+
+def test_stream_ends_when_job_fails(server, tmp_path, released):
+    job = FakeJob()
+    path, part, stream = follow(server, tmp_path, job, released)
+    part.write_bytes(b'abcd')
+    assert next(stream) == b'abcd'
+    part.unlink()
+    job.done.set()
+    assert list(stream) == []
+    assert not path.exists()
+    assert released == [True]
+
+
+def test_stream_route(server, tmp_path):
+    job = server.Job('alice', 'http://t/video', 'mp4')
+    job.outfile = 'video.mp4'
+    server.JOBS.add(job)
+    path = tmp_path / 'alice' / 'video.mp4'
+    part = Path(str(path) + '.part')
+    part.write_bytes(b'abcd')
+
+    def finish():
+        with part.open('ab') as fh:
+            fh.write(b'efgh')
+        part.rename(path)
+        job.done.set()
+
+    timer = threading.Timer(0.2, finish)
+    timer.start()
+    status, headers, body = call(
+        server.APP, '/alice/result/video.mp4', {'stream': 'true'}
+    )
+    timer.join()
+    assert status == '200 OK'
+    assert body == b'abcdefgh'
+    assert headers['Content-Type'] == 'video/mp4'
+    assert headers['Cache-Control'] == 'no-store'
+    assert 'Content-Length' not in headers
+    # the slot for the stream is released
+    assert server.STREAM_SLOTS.acquire(blocking=False)
+
+
+def test_stream_route_without_job(server):
+    status, _, _ = call(
+        server.APP, '/alice/result/video.mp4', {'stream': 'true'}
+    )
+    assert status == '404 Not Found'
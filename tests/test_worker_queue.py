@@ -0,0 +1,111 @@
+"""Tests for the download queue shared by worker processes."""
+import time
+from threading import Event
+
+import pytest
+
+
+@pytest.fixture
+def server(load_server):
+    return load_server()
+
+
+@pytest.fixture
+def store(server, tmp_path):
+    store = server.JobStore(tmp_path / 'jobs.db')
+    yield store
+    store.close()
+
+
+def queued_job(server, store, queue, username, url):
+    job = server.Job(username, url, 'mp4')
+    job.outfile = url.rsplit('/', 1)[-1] + '.mp4'
+    job.set_state('queued')
+    store.add(job)
+    queue.push(job.id)
+    return job
+
+
+def test_claim_is_fair_between_users(server, store, tmp_path):
+    queue = server.SQLiteQueue(tmp_path / 'jobs.db', max_per_user=2)
+    for i in range(3):
+        queued_job(server, store, queue, 'alice', 'http://a/%d' % i)
+    queued_job(server, store, queue, 'bob', 'http://b/0')
+    claimed = [queue.claim('w1') for _ in range(4)]
+    assert [record['url'] for record in claimed[:3]] == [
+        'http://a/0',
+        'http://b/0',
+        'http://a/1',
+    ]
+    assert claimed[3] is None  # alice is at max_per_user
+    assert all(record['worker'] == 'w1' for record in claimed[:3])
+    assert claimed[0]['state'] == 'downloading'
+    queue.close()
+
+
+def test_heartbeat_and_reclaim(server, store, tmp_path):
+    queue = server.SQLiteQueue(tmp_path / 'jobs.db', lease=0.2)
+    job = queued_job(server, store, queue, 'alice', 'http://a/0')
+    assert queue.claim('w1')['id'] == job.id
+    assert queue.claim('w2') is None
+    progress = {'downloaded_bytes': 10}
+    assert queue.heartbeat('w1', job.id, 'downloading', progress)
+    assert not queue.heartbeat('w2', job.id, 'downloading', progress)
+    assert queue.reclaim() == []  # lease was just renewed
+    time.sleep(0.3)
+    assert queue.reclaim() == [job.id]
+    assert store.get(job.id)['state'] == 'queued'
+    assert not queue.heartbeat('w1', job.id, 'downloading', progress)
+    assert queue.claim('w2')['id'] == job.id
+    assert not queue.complete('w1', job.id, 'finished')
+    assert queue.complete('w2', job.id, 'finished')
+    assert store.get(job.id)['state'] == 'finished'
+    queue.close()
+
+
+class UnreachableQueue:
+    """Queue whose server cannot be reached."""
+
+    def __init__(self):
+        self.reachable = False
+
+    def heartbeat(self, worker, job_id, state, progress):
+        if not self.reachable:
+            raise ConnectionRefusedError("server not reachable")
+        return True
+
+
+def test_worker_abandons_job_without_renewal(server, monkeypatch):
+    monkeypatch.setattr(server, 'YDL_LEASE', 0.2)
+    queue = UnreachableQueue()
+    job = server.Job('alice', 'http://a/0', 'mp4')
+    lost = Event()
+    active = {job.id: (job, lost, time.monotonic())}
+    renewed = {}
+    server.renew_leases(queue, 'w1', active, renewed)
+    assert not lost.is_set()
+    queue.reachable = True
+    time.sleep(0.15)
+    server.renew_leases(queue, 'w1', active, renewed)
+    assert job.id in renewed
+    queue.reachable = False
+    time.sleep(0.15)
+    server.renew_leases(queue, 'w1', active, renewed)
+    assert not lost.is_set()  # renewed 0.15 seconds ago
+    time.sleep(0.1)
+    server.renew_leases(queue, 'w1', active, renewed)
+    assert lost.is_set()
+    with pytest.raises(server.JobCancelled):
+        server.check_lease(lost, {'status': 'downloading'})
+
+
+def test_worker_abandons_reclaimed_job(server):
+    class ReclaimedQueue:
+        def heartbeat(self, worker, job_id, state, progress):
+            return False
+
+    job = server.Job('alice', 'http://a/0', 'mp4')
+    lost = Event()
+    active = {job.id: (job, lost, time.monotonic())}
+    server.renew_leases(ReclaimedQueue(), 'w1', active, {})
+    assert lost.is_set()
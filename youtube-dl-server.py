@@ -1,20 +1,52 @@
 """Web app wrapping around youtube-dl."""
+import atexit
+import copy
+import fcntl
+import heapq
+import http.client
+import importlib
+import importlib.metadata
+import itertools
 import json
 import logging
+import logging.handlers
+import mimetypes
 import os
 import pprint
+import random
+import shutil
+import signal
+import socket
+import sqlite3
 import string
+import sys
 import subprocess
 import textwrap
 import time
 import unicodedata
-from collections import defaultdict
+import uuid
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import partial, wraps
 from pathlib import Path
-from queue import Queue
-from threading import Thread
-from urllib.parse import urlencode
-from urllib.request import pathname2url
+from queue import Empty, SimpleQueue
+from threading import BoundedSemaphore, Condition, Event, Lock, Thread
+from urllib.error import HTTPError, URLError
+from urllib.parse import (
+    parse_qsl,
+    quote,
+    urlencode,
+    urlsplit,
+    urlunsplit,
+)
+from urllib.request import Request, pathname2url, urlopen
+from wsgiref.simple_server import (
+    ServerHandler,
+    WSGIRequestHandler,
+    WSGIServer,
+)
 
 import bottle
 import youtube_dl
@@ -23,14 +55,61 @@ import youtube_dl
 YDL_USERS = os.environ.get('YDL_USERS', 'youtube-dl:testing:./')
 
 
+def parse_size(size):
+    """Convert a `size` like "500M" or "2.5G" (bytes, or bytes/s for a rate)
+    to a number.
+
+    Returns None if `size` is empty or invalid.
+    """
+    return youtube_dl.downloader.FileDownloader.parse_bytes(size)
+
+
+def parse_window(window):
+    """Convert a time `window` "HH:MM-HH:MM" to a tuple of the start and end
+    in minutes after midnight.
+
+    Returns None if `window` is empty. Raises ValueError if it is invalid.
+    """
+    if not window:
+        return None
+    bounds = []
+    for hhmm in window.split('-'):
+        hours, minutes = hhmm.strip().split(':')
+        if not (0 <= int(hours) < 24 and 0 <= int(minutes) < 60):
+            raise ValueError("Invalid time %r" % hhmm)
+        bounds.append(60 * int(hours) + int(minutes))
+    start, end = bounds  # ValueError for more or less than two bounds
+    return start, end
+
+
+def in_window(window, now=None):
+    """Whether the local time `now` (default: current time) falls into the
+    `window` obtained from :func:`parse_window`.
+
+    Windows may extend past midnight (e.g., "22:00-06:00"). A `window` of
+    None contains all times.
+    """
+    if window is None:
+        return True
+    now = time.localtime(now)
+    minute = 60 * now.tm_hour + now.tm_min
+    start, end = window
+    if start <= end:
+        return start <= minute < end
+    return minute >= start or minute < end
+
+
 def process_users(ydl_users):
     """Process YDL_USERS specification."""
     tokens = {}
     outdirs = {}
     uids = {}
     gids = {}
+    rate_limits = {}
+    quotas = {}
     for spec in ydl_users.split(";"):
-        username, token, outdir, uid, gid = (spec + "::::").split(":")[:5]
+        fields = (spec + "::::::").split(":")[:7]
+        username, token, outdir, uid, gid, rate_limit, quota = fields
         tokens[username] = token
         outdirs[username] = outdir or './'
         if not outdirs[username].endswith("/"):
@@ -38,14 +117,21 @@ def process_users(ydl_users):
         Path(outdirs[username]).mkdir(parents=True, exist_ok=True)
         uids[username] = uid or None
         gids[username] = gid or None
-    return tokens, outdirs, uids, gids
+        rate_limits[username] = parse_size(rate_limit)
+        quotas[username] = parse_size(quota)
+    return tokens, outdirs, uids, gids, rate_limits, quotas
 
 
-TOKENS, OUTDIRS, UIDS, GIDS = process_users(YDL_USERS)
+TOKENS, OUTDIRS, UIDS, GIDS, RATE_LIMITS, QUOTAS = process_users(YDL_USERS)
 
 YDL_OUTPUT_TEMPLATE = '{title} [{id}]'
 YDL_SERVER_HOST = os.environ.get('YDL_SERVER_HOST', '0.0.0.0')
 YDL_SERVER_PORT = int(os.environ.get('YDL_SERVER_PORT', 8080))
+# 'threaded' (pool of YDL_SERVER_THREADS threads), 'wsgiref' (single thread),
+# or the name of any server adapter supported by bottle (e.g. 'aiohttp' for
+# an asyncio-based server, if the required packages are installed)
+YDL_SERVER_BACKEND = os.environ.get('YDL_SERVER_BACKEND', 'threaded').lower()
+YDL_SERVER_THREADS = max(1, int(os.environ.get('YDL_SERVER_THREADS', 16)))
 YDL_LOGFILE = os.environ.get('YDL_LOGFILE', 'youtube-dl-server.log')
 YDL_DL_LOGFILE = os.environ.get('YDL_DL_LOGFILE', 'youtube-dl.log')
 try:
@@ -57,6 +143,147 @@ except AttributeError:
 
 YDL_DEFAULT_PRESET = os.environ.get('YDL_DEFAULT_PRESET', 'normalmp4')
 
+# number of download threads
+YDL_WORKERS = max(1, int(os.environ.get('YDL_WORKERS', 2)))
+# max. number of simultaneous downloads, overall and for any single user
+# (0 for no limit; by default, a single user may use all download threads)
+YDL_MAX_ACTIVE = int(os.environ.get('YDL_MAX_ACTIVE', 0))
+YDL_MAX_ACTIVE_PER_USER = int(
+    os.environ.get('YDL_MAX_ACTIVE_PER_USER', YDL_WORKERS)
+)
+# number of threads extracting video information for submitted urls, and
+# max. number of submitted urls waiting for extraction
+YDL_EXTRACT_WORKERS = max(1, int(os.environ.get('YDL_EXTRACT_WORKERS', 4)))
+YDL_EXTRACT_QUEUE = max(1, int(os.environ.get('YDL_EXTRACT_QUEUE', 100)))
+# max. total download rate in bytes/s, e.g. "5M" (0 for no limit), shared by
+# all active downloads
+YDL_RATE_LIMIT = parse_size(os.environ.get('YDL_RATE_LIMIT', '')) or 0
+# time window ("HH:MM-HH:MM", local time) during which jobs submitted with
+# priority "low" are downloaded (empty for no restriction)
+YDL_OFFPEAK = os.environ.get('YDL_OFFPEAK', '')
+try:
+    OFFPEAK_WINDOW = parse_window(YDL_OFFPEAK)
+except ValueError:
+    print(
+        "WARNING: invalid YDL_OFFPEAK %r. Not holding low-priority jobs"
+        % YDL_OFFPEAK
+    )
+    OFFPEAK_WINDOW = None
+# max. number of automatic retries of a failed job, and the delay in seconds
+# before the first retry (doubling for every further retry, up to the max.
+# delay)
+YDL_RETRIES = int(os.environ.get('YDL_RETRIES', 3))
+YDL_RETRY_DELAY = float(os.environ.get('YDL_RETRY_DELAY', 30))
+YDL_RETRY_MAX_DELAY = float(os.environ.get('YDL_RETRY_MAX_DELAY', 3600))
+# number of finished jobs to remember (for polling their status)
+YDL_JOB_HISTORY = int(os.environ.get('YDL_JOB_HISTORY', 1000))
+# number of threads running postprocessors (ffmpeg) on downloaded files
+YDL_PP_WORKERS = max(
+    1, int(os.environ.get('YDL_PP_WORKERS', os.cpu_count() or 1))
+)
+# number of threads expanding the playlists of batch submissions, the max.
+# number of jobs created by a single batch, and the number of batches to
+# remember
+YDL_EXPAND_WORKERS = max(1, int(os.environ.get('YDL_EXPAND_WORKERS', 2)))
+YDL_BATCH_MAX = int(os.environ.get('YDL_BATCH_MAX', 10000))
+YDL_BATCH_HISTORY = int(os.environ.get('YDL_BATCH_HISTORY', 100))
+# max. number of entries in the cache of extracted video information (0 to
+# disable the cache), the time in seconds after which entries expire, and
+# the file in which the cache is kept between restarts (empty for none)
+YDL_INFO_CACHE_SIZE = int(os.environ.get('YDL_INFO_CACHE_SIZE', 256))
+YDL_INFO_CACHE_TTL = float(os.environ.get('YDL_INFO_CACHE_TTL', 3600))
+YDL_INFO_CACHE_FILE = os.environ.get('YDL_INFO_CACHE_FILE', '')
+# interval in seconds in which output directories are checked for changes,
+# and default number of files per page on the list of downloaded files
+YDL_LIST_REFRESH = float(os.environ.get('YDL_LIST_REFRESH', 10))
+YDL_LIST_PAGE_SIZE = int(os.environ.get('YDL_LIST_PAGE_SIZE', 200))
+# re-read templates when they change on disk (for development)
+YDL_RELOAD_TEMPLATES = (
+    os.environ.get('YDL_RELOAD_TEMPLATES', 'false').lower() == 'true'
+)
+# Let a fronting web server (nginx, Apache/lighttpd) send downloaded files:
+# 'x-accel-redirect' (nginx) or 'x-sendfile'. For 'x-accel-redirect', the
+# files for a user are redirected to the internal location
+# YDL_ACCEL_REDIRECT_PREFIX + username + '/' + filename
+YDL_SENDFILE_MODE = os.environ.get('YDL_SENDFILE_MODE', '').lower()
+YDL_ACCEL_REDIRECT_PREFIX = os.environ.get(
+    'YDL_ACCEL_REDIRECT_PREFIX', '/internal/'
+)
+# max. number of simultaneous streams of files that are still being
+# downloaded (/result?stream=true), each of which occupies a server thread
+YDL_MAX_STREAMS = int(os.environ.get('YDL_MAX_STREAMS', 4))
+# max. number of simultaneous streams of Server-Sent Events (/events), each
+# of which occupies a server thread; by default half of YDL_SERVER_THREADS
+YDL_MAX_EVENT_STREAMS = int(
+    os.environ.get('YDL_MAX_EVENT_STREAMS', YDL_SERVER_THREADS // 2)
+)
+# min. interval in seconds between progress updates of a running download
+YDL_PROGRESS_INTERVAL = float(os.environ.get('YDL_PROGRESS_INTERVAL', 1))
+# comma-separated addresses of reverse proxies whose X-Forwarded-For headers
+# are trusted for the address of a client (see client_address)
+YDL_TRUSTED_PROXIES = {
+    address.strip()
+    for address in os.environ.get('YDL_TRUSTED_PROXIES', '').split(',')
+    if address.strip()
+}
+# token required for the /metrics route (empty for no authentication)
+YDL_METRICS_TOKEN = os.environ.get('YDL_METRICS_TOKEN', '')
+# SQLite database in which jobs are persisted, so that they survive a restart
+# (':memory:' to disable persistence), and number of days after which
+# finished jobs are removed from it
+YDL_JOBS_DB = os.environ.get('YDL_JOBS_DB', 'youtube-dl-jobs.db')
+YDL_JOBS_RETENTION = float(os.environ.get('YDL_JOBS_RETENTION', 7))
+# On shutdown, either finish all queued downloads ('drain') or abort them
+# ('cancel')
+YDL_SHUTDOWN_MODE = os.environ.get('YDL_SHUTDOWN_MODE', 'drain').lower()
+if YDL_SHUTDOWN_MODE not in ('drain', 'cancel'):
+    print(
+        "WARNING: invalid YDL_SHUTDOWN_MODE %r. Using 'drain'"
+        % YDL_SHUTDOWN_MODE
+    )
+    YDL_SHUTDOWN_MODE = 'drain'
+# Either download in threads of the server process ('memory'), or leave the
+# downloads to worker processes ("youtube-dl-server.py worker") that take
+# jobs from the YDL_JOBS_DB ('shared')
+YDL_QUEUE = os.environ.get('YDL_QUEUE', 'memory').lower()
+if YDL_QUEUE not in ('memory', 'shared'):
+    print("WARNING: invalid YDL_QUEUE %r. Using 'memory'" % YDL_QUEUE)
+    YDL_QUEUE = 'memory'
+if YDL_QUEUE == 'shared' and YDL_JOBS_DB == ':memory:':
+    print("WARNING: YDL_QUEUE 'shared' requires a YDL_JOBS_DB file")
+    YDL_QUEUE = 'memory'
+# For a worker process, the url of the server from which to take jobs (empty
+# to take jobs directly from the YDL_JOBS_DB on the same host), and the
+# token for the "/worker" routes of the server (empty to disable the routes)
+YDL_WORKER_SERVER = os.environ.get('YDL_WORKER_SERVER', '')
+YDL_WORKER_TOKEN = os.environ.get('YDL_WORKER_TOKEN', '')
+# seconds after which a job is taken away from a worker that stopped sending
+# heartbeats, and the interval in seconds between heartbeats
+YDL_LEASE = float(os.environ.get('YDL_LEASE', 60))
+YDL_HEARTBEAT = float(os.environ.get('YDL_HEARTBEAT', 5))
+# min. interval in seconds between updates of youtube-dl (0 for no automatic
+# updates, only via the /update route), the timeout in seconds for an
+# update, and the file recording the last update
+YDL_UPDATE_INTERVAL = float(os.environ.get('YDL_UPDATE_INTERVAL', 86400))
+YDL_UPDATE_TIMEOUT = float(os.environ.get('YDL_UPDATE_TIMEOUT', 300))
+YDL_UPDATE_FILE = os.environ.get('YDL_UPDATE_FILE', 'youtube-dl-update.json')
+# max. total size of the files in all output directories, e.g. "500G" (0 for
+# no limit; the quotas of single users are part of YDL_USERS), the number of
+# days after which files are removed (0 to keep files forever), the min.
+# free space to keep on the file systems of the output directories, e.g.
+# "1G", and the interval in seconds between sweeps of the output directories
+# that enforce these limits (0 to only enforce them for new downloads).
+# Without any of these limits, files are never removed.
+YDL_QUOTA = parse_size(os.environ.get('YDL_QUOTA', '')) or 0
+YDL_MAX_AGE = float(os.environ.get('YDL_MAX_AGE', 0))
+YDL_MIN_FREE = parse_size(os.environ.get('YDL_MIN_FREE', '')) or 0
+YDL_SWEEP_INTERVAL = float(os.environ.get('YDL_SWEEP_INTERVAL', 600))
+# make room for a new download by removing files of other users, too (by
+# default, only files of the same user are removed for a new download)
+YDL_EVICT_OTHERS = (
+    os.environ.get('YDL_EVICT_OTHERS', 'false').lower() == 'true'
+)
+
 FORMATS = {  # preset => YoutubeDL format
     'smallmp4': 'mp4[height<=480]/best[ext=mp4]',
     'normalmp4': 'mp4[height<=720]/best[ext=mp4]',
@@ -81,432 +308,4364 @@ EXTENSIONS = {  # preset => file extension
     'mp3': 'mp3',
 }
 
+DERIVABLE = {  # preset => presets whose files it can be derived from
+    'smallmp4': ['normalmp4', 'bestmp4'],
+    'normalmp4': ['bestmp4'],
+    'mp3': ['bestmp4', 'normalmp4', 'smallmp4'],
+}
+
+MAX_HEIGHTS = {  # preset => maximum video height
+    'smallmp4': 480,
+    'normalmp4': 720,
+}
+
+PRIORITIES = ('normal', 'low')  # 'low': held until YDL_OFFPEAK
+
 MIMETYPES = {
     '.mp4': 'video/mp4',
     '.mp3': 'audio/mpeg',
     '.log': 'text/plain',
 }
 
-DL_Q = Queue()
 
-MAIN_LOGGER = logging.getLogger('youtubedl-server')
+class FairQueue:
+    """Download queue with round-robin scheduling across users.
 
-TEMPLATES = Path(__file__).parent / 'templates'
+    Every user has their own FIFO of jobs. :meth:`get` hands out the oldest
+    job of the next user (in round-robin order) who has fewer than
+    `max_per_user` active jobs, as long as there are fewer than `max_active`
+    active jobs in total (a limit of 0 means "no limit"). Thus, a large
+    backlog of one user cannot starve the other users.
 
+    If a function `ready` is given, only items for which ``ready(item)`` is
+    True are handed out; other items are held in the queue (without blocking
+    the items queued behind them). As readiness may change with time, it is
+    re-checked at least every `recheck` seconds.
 
-def configure_logging(
-    logger, logfile=None, log_to_stdout=True, level=logging.INFO
-):
-    """Set up the given `logger`."""
-    logger.setLevel(level)
-    formatter = logging.Formatter(
-        "%(asctime)s %(name)s [%(levelname)s]  %(message)s",
-        "%Y-%m-%d %H:%M:%S",
-    )
-    msg = "Set to log at level %r to " % logging.getLevelName(level)
-    if logfile is not None:
-        file_handler = logging.FileHandler(logfile)
-        file_handler.setLevel(logging.DEBUG)
-        file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
-        msg += str(logfile)
-        if log_to_stdout:
-            msg += " and "
-    if log_to_stdout:
-        stream_handler = logging.StreamHandler()
-        stream_handler.setLevel(logging.DEBUG)
-        stream_handler.setFormatter(formatter)
-        logger.addHandler(stream_handler)
-        msg += "stdout."
-    logger.debug(msg)
-    return logger
+    Every job obtained via :meth:`get` must be released with
+    :meth:`task_done` once it has been processed (successfully or not).
+    """
 
+    def __init__(self, max_active=0, max_per_user=0, ready=None, recheck=60):
+        self.max_active = max_active
+        self.max_per_user = max_per_user
+        self.ready = ready
+        self.recheck = recheck
+        self._queues = OrderedDict()  # username => deque of pending items
+        self._active = defaultdict(int)  # username => number of active jobs
+        self._n_active = 0
+        self._unfinished = 0
+        self._closed = False
+        self._lock = Lock()
+        self._changed = Condition(self._lock)
 
-def log_to_logger(fn, logger):
-    """Bottle pluging that wraps request for logging."""
+    def put(self, username, item):
+        """Append `item` to the queue of the given `username`."""
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Queue has been closed")
+            if username not in self._queues:
+                self._queues[username] = deque()
+            self._queues[username].append(item)
+            self._unfinished += 1
+            self._changed.notify()
 
-    @wraps(fn)
-    def _log_to_logger(*args, **kwargs):
-        actual_response = fn(*args, **kwargs)
-        # modify this to log exactly what you need:
-        logger.info(
-            'Request from %s %s %s %s',
-            bottle.request.remote_addr,
-            bottle.request.method,
-            bottle.request.url,
-            bottle.response.status,
-        )
-        return actual_response
+    def _next_ready(self, queue):
+        """Index of the first ready item in `queue`, or None."""
+        if self.ready is None:
+            return 0
+        for i, item in enumerate(queue):
+            if self.ready(item):
+                return i
+        return None
 
-    return _log_to_logger
+    def _pop(self):
+        if self.max_active and self._n_active >= self.max_active:
+            return None
+        for username, queue in self._queues.items():
+            if self.max_per_user:
+                if self._active[username] >= self.max_per_user:
+                    continue
+            i = self._next_ready(queue)
+            if i is None:
+                continue
+            item = queue[i]
+            del queue[i]
+            # move the user to the end of the line
+            del self._queues[username]
+            if queue:
+                self._queues[username] = queue
+            self._active[username] += 1
+            self._n_active += 1
+            return username, item
+        return None
 
+    def get(self):
+        """Return a tuple (username, item) for the next job to process.
 
-configure_logging(
-    MAIN_LOGGER, logfile=YDL_LOGFILE, log_to_stdout=True, level=YDL_LOGLEVEL
-)
-APP = bottle.Bottle()
-APP.install(partial(log_to_logger, logger=MAIN_LOGGER))
+        Blocks until a job is available under the concurrency limits. Once
+        the queue has been closed and no pending jobs remain (or only jobs
+        that are not ready), returns ``(None, None)``.
+        """
+        with self._lock:
+            while True:
+                found = self._pop()
+                if found is not None:
+                    return found
+                if self._closed and all(
+                    self._next_ready(queue) is None
+                    for queue in self._queues.values()
+                ):
+                    return None, None
+                if self.ready is None:
+                    self._changed.wait()
+                else:
+                    self._changed.wait(self.recheck)
 
+    def task_done(self, username):
+        """Mark a job of `username` obtained from :meth:`get` as finished."""
+        with self._lock:
+            self._active[username] -= 1
+            if self._active[username] <= 0:
+                del self._active[username]
+            self._n_active -= 1
+            self._unfinished -= 1
+            self._changed.notify_all()
 
-def is_authorized(username, token):
-    """Check whether the username/token combination is valid."""
-    if username not in TOKENS or TOKENS[username] != token:
-        time.sleep(1)  # make brute-forcing tokens very difficult
-        return False
-    return True
+    def close(self, cancel=False):
+        """Stop accepting new jobs, and wake up all waiting workers.
 
+        Pending jobs remain in the queue to be processed, unless `cancel` is
+        True, in which case they are discarded and returned as a list of
+        tuples (username, item).
+        """
+        cancelled = []
+        with self._lock:
+            self._closed = True
+            if cancel:
+                for username, queue in self._queues.items():
+                    cancelled.extend((username, item) for item in queue)
+                self._unfinished -= len(cancelled)
+                self._queues.clear()
+            self._changed.notify_all()
+        return cancelled
 
-@APP.route('/<username>')
-def dl_form(username):
-    """Route for the root page (form for submitting a video)."""
-    token = bottle.request.params.get("token", None)
-    if not is_authorized(username, token):
-        bottle.abort(401, "Not authorized")
-    template = (TEMPLATES / 'page.j2').read_text()
-    content = bottle.template(
-        (TEMPLATES / 'form.j2').read_text(), username=username, token=token
-    )
-    return bottle.template(template, title="youtube-dl", content=content)
+    def join(self):
+        """Block until all jobs have been processed."""
+        with self._lock:
+            while self._unfinished > 0:
+                self._changed.wait()
 
+    def qsize(self):
+        """Number of pending (not active) jobs."""
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
 
-@APP.route('/<username>/list')
-def list_files(username):
-    """Route for listing downloaded files."""
-    token = bottle.request.params.get("token", None)
-    sort = bottle.request.params.get("sort", 'ctime')
-    if not is_authorized(username, token):
-        bottle.abort(401, "Not authorized")
-    template = (TEMPLATES / 'page.j2').read_text()
-    content = [
-        '<h1 class="display-4">',
-        '<a href="/{username}?token={token}">youtube-dl</a>'.format(
-            username=username, token=token
-        ),
-        '</h1>' '<div class="text-left">',
-        '<p>Available files:</p>',
-        '<ul>',
-    ]
-    sortkeys = {
-        'name': lambda f: f.name,
-        'time': lambda f: f.stat().st_ctime,  # alias for creation time
-        'ctime': lambda f: f.stat().st_ctime,
-        'mtime': lambda f: f.stat().st_mtime,
-        'size': lambda f: f.stat().st_size,
-    }
-    sortkey = sortkeys.get(sort, sortkeys['ctime'])
-    files = Path(OUTDIRS[username]).iterdir()
-    for filename in sorted(files, key=sortkey):
-        if filename.is_file() and filename.suffix in ('.mp4', '.mp3'):
-            content.append(
-                '<li><a href="/%s/result/%s">%s</a></li>'
-                % (username, pathname2url(str(filename.name)), filename.name)
-            )
-    content.append('</ul></div>')
-    return bottle.template(
-        template, title="youtube-dl", content="\n".join(content)
-    )
+    def active(self):
+        """Dict username => number of active jobs."""
+        with self._lock:
+            return dict(self._active)
 
 
-@APP.route('/static/:filename#.*#')
-def server_static(filename):
-    """Route static resources, e.g. CSS files."""
-    return bottle.static_file(filename, root='./static')
+class BandwidthManager:
+    """Division of a total download rate `limit` (in bytes/s, 0 for no limit)
+    among the active downloads.
 
+    The downloads of a user with an entry in `user_limits` (username =>
+    bytes/s, or None) also share that user's limit. Within these limits, the
+    available rate is divided max-min fairly: if the downloads of a user are
+    capped below an equal share of the total, the remainder is divided among
+    the other downloads.
 
-@APP.route('/<username>/submit', method='POST')
-def submit(username):
-    """Route for submitting a request to download a video."""
-    return_json = bottle.request.params.get("return_json", 'true')
-    token = bottle.request.params.get("token", None)
-    if not is_authorized(username, token):
-        if return_json == 'true':
-            return {
-                "success": False,
-                "error": "not authorized",
-            }
-        else:
-            bottle.abort(401, "Not authorized")
-    url = bottle.request.params.get("url")
-    if not url:
-        if return_json == 'true':
-            return {
-                "success": False,
-                "error": "missing 'url' query param",
-            }
-        else:
-            bottle.abort(400, "missing 'url' query param")
-    preset = bottle.request.params.get("preset", YDL_DEFAULT_PRESET)
-    result = submit_download(username, url, preset)
+    The share of each download is set as the `rate_limit` of its job and as
+    the "ratelimit" parameter of its YoutubeDL instance, which youtube-dl
+    checks while downloading, so that the shares change mid-download when a
+    download starts or ends. Note that youtube-dl limits the average rate
+    since the start of a download, so a download whose share decreases
+    pauses until its average has come down to the new share.
 
-    if return_json == 'true':
-        return result
-    else:
-        if result['success']:
-            outfile = result['outfile']
-            # Redirect to resulting file (https://httpstatuses.com/303)
-            bottle.redirect(
-                "/%s/result/%s?%s"
-                % (
-                    username,
-                    pathname2url(outfile),
-                    urlencode({'url': url, 'download': 'false'}),
-                ),
-                code=303,
-            )
-        else:
-            return result
+    The current speed of each download is measured between calls to
+    :meth:`rebalance` (youtube-dl only reports the average speed).
+    """
 
+    def __init__(self, limit=0, user_limits=None):
+        self.limit = limit
+        self.user_limits = user_limits or {}
+        # job => [YoutubeDL params, time, downloaded bytes, current speed]
+        self._active = {}
+        self._lock = Lock()
 
-@APP.route('/<username>/result/:filename#.*#')
-def result_file(username, filename):
-    """Route for obtaining a downloaded file.
+    @property
+    def enabled(self):
+        """Whether any rate limit is configured."""
+        return bool(self.limit or any(self.user_limits.values()))
 
-    Depending on a `download` parameter in the HTTP request ('true'/'false'),
-    either try to download the file directly, or render an HTML page containing
-    a direct link to the file. The latter may be preferable because then a use
-    can right-click on the link and choose what do do with it.
+    def add(self, job, ydl_params):
+        """Register the active download for `job`, with the given
+        `ydl_params` (the "params" of its YoutubeDL instance)."""
+        with self._lock:
+            self._active[job] = [ydl_params, time.monotonic(), 0, None]
+            self._rebalance()
 
-    No authentication token is used. This is so that a "result" link can be
-    shared publicly without exposing the token.
-    """
-    try:
-        filename = Path(filename).name  # protect against escaping from OUTDIR
-        logfile = (Path(OUTDIRS[username]) / filename).with_suffix('.log')
-        download = bottle.request.params.get("download", 'true')
-        exists = (Path(OUTDIRS[username]) / filename).is_file()
-    except (OSError, KeyError):
-        # protect against e.g. too long filenames
-        bottle.abort(404, "Invalid filename")
+    def remove(self, job):
+        """Unregister the download for `job`."""
+        with self._lock:
+            self._active.pop(job, None)
+            job.rate_limit = None
+            self._rebalance()
 
-    if download == 'true':
-        if exists:
-            return bottle.static_file(
-                filename,
-                root=OUTDIRS[username],
-                mimetype=MIMETYPES.get(Path(filename).suffix, True),
-            )
-        else:
-            bottle.abort(404, "No file %s" % filename)
-    content = '<h1 class="display-4">youtube-dl</h1>\n'
-    url = bottle.request.params.get("url", None)
-    if exists:
-        if url:
-            content += r'''
-            <p>The video at <code><a href="{url}">{url}</a></code> has been processed.</p>
-            <p>Download the resulting file:</p>
-            <p class="lead"><a href="/{username}/result/{filename_enc}">{filename}</a></p>
-            '''.format(
-                username=username,
-                url=url,
-                filename_enc=pathname2url(filename),
-                filename=filename,
-            )
-        else:
-            content += r'''
-            <p>Download the completed file:</p>
-            <p class="lead"><a href="/{username}/result/{filename_enc}">{filename}</a></p>
-            '''.format(
-                username=username,
-                filename_enc=pathname2url(filename),
-                filename=filename,
-            )
-    else:  # file does not (yet) exist
-        if logfile.is_file():
-            loglink = (
-                ' (see <a href="/%s/result/%s?download=true">log file</a>)'
-                % (username, logfile.name)
-            )
-        else:
-            loglink = ''
-        if url:
-            content += r'''
-            <p>The video at <code><a href="{url}">{url}</a></code> is still being processed{loglink}.</p>
-            <p>Wait for youtube-dl to complete, then download the resulting file:</p>
-            <p class="lead"><a href="/{username}/result/{filename_enc}?{params}">{filename}</a></p>
-            '''.format(
-                username=username,
-                url=url,
-                loglink=loglink,
-                filename_enc=pathname2url(filename),
-                filename=filename,
-                params=urlencode({'download': 'false', 'url': url}),
-            )
-        else:
-            content += r'''
-            <p>The requested file may still be processing{loglink}.</p>
-            <p>Wait for youtube-dl to complete, then download the resulting file:</p>
-            <p class="lead"><a href="/{username}/result/{filename_enc}?download=false">{filename}</a></p>
-            '''.format(
-                username=username,
-                filename=filename,
-                filename_enc=pathname2url(filename),
-                loglink=loglink,
+    def rebalance(self):
+        """Measure the current speed of the active downloads, and recompute
+        their shares."""
+        with self._lock:
+            self._rebalance()
+
+    def throughput(self):
+        """Current total speed of all active downloads, in bytes/s."""
+        with self._lock:
+            return sum(
+                (job.speed if entry[3] is None else entry[3]) or 0
+                for (job, entry) in self._active.items()
             )
-    template = (TEMPLATES / 'page.j2').read_text()
-    return bottle.template(template, title=filename, content=content)
 
+    @staticmethod
+    def _divide(demands, budget):
+        """Max-min fair division of `budget` for `demands` (dict key =>
+        demand). Returns a dict key => allocation."""
+        allocation = {}
+        demands = dict(demands)
+        while demands:
+            share = budget / len(demands)
+            satisfied = {k: d for (k, d) in demands.items() if d <= share}
+            if not satisfied:
+                allocation.update((k, share) for k in demands)
+                break
+            for k, demand in satisfied.items():
+                allocation[k] = demand
+                budget -= demand
+                del demands[k]
+        return allocation
 
-def youtube_dl_show_progress(d, logger):
-    """Log download progress in :class:`YoutubeDL` instance.
+    def _measure(self):
+        now = time.monotonic()
+        for job, entry in self._active.items():
+            _, last_time, last_bytes, _ = entry
+            downloaded_bytes = job.downloaded_bytes or 0
+            if now - last_time < 1:
+                continue
+            if downloaded_bytes >= last_bytes:  # not a new file
+                entry[3] = (downloaded_bytes - last_bytes) / (now - last_time)
+            entry[1:3] = now, downloaded_bytes
 
-    After `logger` is set via :func:`functools.partial`, the resulting function
-    is used as a "progress_hook" for :class:`YoutubeDL`.
-    """
-    if d['status'] == 'error':
-        logger.error("Failed to download %r", d['filename'])
-    elif d['status'] == 'finished':
-        logger.info("Finished downloading %r", d['filename'])
-    elif d['status'] == 'downloading':
-        try:
-            total_bytes = d['total_bytes']
-        except (ValueError, TypeError):
-            total_bytes = d.get('total_estimates_bytes', None)
-        downloaded_MB = "%.1f" % (float(d['downloaded_bytes']) / 1048576.0)
-        try:
-            total_MB = "%.1f" % (float(total_bytes) / 1048576.0)
-            percent = "%d" % (
-                100 * float(d['downloaded_bytes']) / float(total_bytes)
-            )
-        except TypeError:
-            percent = '???'
-        try:
-            speed = "%.2f" % (float(d['speed']) / 1048576.0)
-        except TypeError:
-            speed = '???'
-        logger.info(
-            "Downloaded %s/%s MB (%s%%, %s MB/s)",
-            downloaded_MB,
-            total_MB,
-            percent,
-            speed,
-        )
+    def _rebalance(self):
+        self._measure()
+        if not self.enabled:
+            return
+        jobs_by_user = defaultdict(list)
+        for job in self._active:
+            jobs_by_user[job.username].append(job)
+        demands = {}
+        for username, jobs in jobs_by_user.items():
+            user_demands = {job: float('inf') for job in jobs}
+            user_limit = self.user_limits.get(username, None)
+            if user_limit:
+                user_demands = self._divide(user_demands, user_limit)
+            demands.update(user_demands)
+        if self.limit:
+            rates = self._divide(demands, self.limit)
+        else:
+            rates = demands
+        for job, rate in rates.items():
+            if rate == float('inf'):
+                job.rate_limit = None
+            else:
+                job.rate_limit = max(int(rate), 1)
+            self._active[job][0]['ratelimit'] = job.rate_limit
 
 
-def submit_download(username, url, preset):
-    """Send `url` to download-thread for downloading with given `preset`.
+class JobCancelled(Exception):
+    """Raised inside a running download when the server shuts down."""
 
-    Returns a dict with the following values:
 
-    * `success`: whether youtube-dl could successfully identify a video at the
-       given `url`
-    * `url`: the input `url`
-    * `preset`: the input `preset`
-    * `format`: the youtube-dl format code associated with the `preset`
-    * `outfile`: the name of the output file (inside YDL_OUTDIR)
+# attributes of a Job reporting the progress of its download
+JOB_PROGRESS = (
+    'phase',
+    'downloaded_bytes',
+    'total_bytes',
+    'speed',
+    'eta',
+    'rate_limit',
+)
 
-    If `success`, a tuple consisting of a YoutubeDL instance (initialized for
-    the given `preset`), the username, and the url will be placed on the DL_Q
-    Queue, to be processed by the download-thread.
-    """
-    fmt = FORMATS.get(preset, FORMATS[YDL_DEFAULT_PRESET])
-    ydl_params = {
-        'format': fmt,
-        'noplaylist': True,
-        'postprocessors': POSTPROCESSORS[preset],
-        'outtmpl': YDL_OUTPUT_TEMPLATE,
-        'progress_hooks': [],
-        'quiet': True,
-        'no_warnings': True,
-    }
-    if YDL_LOGLEVEL == logging.DEBUG:
-        MAIN_LOGGER.debug(
-            textwrap.indent(
-                "\nydl_params = %s" % pprint.pformat(ydl_params), '    '
-            )
-        )
-    with youtube_dl.YoutubeDL(ydl_params) as ydl:
-        try:
-            info = ydl.extract_info(url, download=False)
-        except Exception as exc_info:
-            MAIN_LOGGER.error("Exception: %r", exc_info)
-            success = False
-            outfile = None
-            MAIN_LOGGER.error(
-                "Could not add url %r to the download queue", url
-            )
-        else:
-            success = True
-            if YDL_LOGLEVEL == logging.DEBUG:
-                MAIN_LOGGER.debug(
-                    textwrap.indent(
-                        "\ninfo = %s" % pprint.pformat(info), '    '
-                    )
-                )
-            ext = EXTENSIONS.get(preset, 'mp4')
-            outfile = (
-                SanitizedFilenameTmpl(YDL_OUTPUT_TEMPLATE).format(**info)
-                + "."
-                + ext
-            )
-            outpath = str(Path(OUTDIRS[username]) / outfile)
-            logfile = Path(outpath).with_suffix('.log')
-            dl_logger = logging.getLogger('youtubedl.%s' % info['id'])
-            configure_logging(
-                dl_logger,
-                logfile=logfile,
-                log_to_stdout=True,
-                level=YDL_LOGLEVEL,
-            )
-            ydl.params['outtmpl'] = outpath
-            ydl.params['logger'] = dl_logger
-            ydl.add_progress_hook(
-                partial(youtube_dl_show_progress, logger=dl_logger)
-            )
-            DL_Q.put((ydl, username, url))
-            MAIN_LOGGER.info("Added url %r to the download queue", url)
 
-        return {
-            "success": success,
-            "url": url,
-            "preset": preset,
-            "format": fmt,
-            "outfile": outfile,
-        }
+class Job:
+    """Request to download `url` with the given `preset` for `username`.
 
+    The `state` of a job progresses through
 
-@APP.route("/update", method="GET")
-def update():
-    """Update the youtube-dl backend."""
-    token = bottle.request.params.get("token", None)
-    if token not in TOKENS.values():
-        bottle.abort(401, "Not authorized")
-    return _update()
+    * 'pending': waiting for extraction of the video information
+    * 'extracting': video information is being extracted
+    * 'queued': the `outfile` is known, and the job is waiting in the DL_Q
+      (or, with YDL_QUEUE 'shared', for a worker process, see
+      :class:`SQLiteQueue`)
+    * 'downloading': the job is being processed by a download thread (or
+      a worker process)
+    * 'postprocessing': the file has been downloaded, and is waiting for or
+      being processed by a postprocessing thread (only for presets with
+      postprocessors, or for merged formats)
+    * 'finished' or 'failed' (with an `error` message)
 
+    A job that failed with an error that may be temporary (see
+    :func:`classify_error`) is 'retrying' until it is resubmitted at
+    `retry_at` (see :func:`fail_job`). After YDL_RETRIES `attempts`, or for a
+    permanent error, the job is 'failed'. Failed jobs form a "dead-letter
+    list", from which they can be requeued (see :func:`requeue_job`).
 
-def _update():
-    command = ["pip", "install", "--upgrade", "youtube-dl"]
-    proc = subprocess.Popen(
-        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-    )
+    A job whose download was aborted on shutdown is 'interrupted'. Such jobs,
+    like all other jobs that have not reached a final state, are resumed
+    when the server restarts.
 
-    output, error = proc.communicate()
-    return {"output": output.decode('ascii'), "error": error.decode('ascii')}
+    Jobs with `priority` 'low' remain 'queued' until the YDL_OFFPEAK window.
 
+    The `resolved` event is set as soon as the `outfile` is known (or the
+    job failed before that), and the `done` event is set when the job reaches
+    its final state.
 
-class SanitizedFilenameTmpl:
-    """Format string that evaluates to a safe filename."""
+    A job is a compact record: it is what is placed on the DL_Q, while the
+    YoutubeDL instance and the logger for the download are only created by
+    the download thread that processes the job (see :func:`dl_worker`).
+    """
 
-    whitelist = "-_.() %s%s'\"" % (
-        string.ascii_letters,
-        string.digits,
-    )  #: string containing all allowed filename characters
-    char_limit = 128  #: max length of allowed filenames
-    # Technically, the limit is 255 - len('.part'), but 128 is much more
-    # reasonable for human consumption
+    __slots__ = (
+        'id',
+        'username',
+        'url',
+        'preset',
+        'priority',
+        'format',
+        'state',
+        'outfile',
+        'error',
+        'error_class',
+        'attempts',
+        'retry_at',
+        'extractor',
+        'video_id',
+        'height',
+        'filesize',
+        'postprocessing',
+        'phase',
+        'downloaded_bytes',
+        'total_bytes',
+        'speed',
+        'eta',
+        'rate_limit',
+        'created',
+        'resolved',
+        'done',
+    )
 
-    def __init__(self, tmpl):
-        self._tmpl = tmpl
+    def __init__(
+        self,
+        username,
+        url,
+        preset,
+        priority='normal',
+        job_id=None,
+        created=None,
+    ):
+        self.id = job_id or uuid.uuid4().hex
+        self.username = username
+        self.url = url
+        self.preset = preset
+        self.priority = priority  # 'normal' or 'low'
+        self.format = FORMATS.get(preset, FORMATS[YDL_DEFAULT_PRESET])
+        self.state = 'pending'
+        self.outfile = None
+        self.error = None
+        self.error_class = None  # 'network', 'extractor', 'permanent'
+        self.attempts = 0  # number of retries
+        self.retry_at = None  # time.time() of the next retry
+        self.extractor = None
+        self.video_id = None
+        self.height = None  # video height of the outfile
+        self.filesize = None  # expected size of the download in bytes
+        self.postprocessing = False  # whether there is a PP phase
+        self.phase = None  # 'downloading', 'postprocessing', 'done'
+        self.downloaded_bytes = None
+        self.total_bytes = None
+        self.speed = None  # bytes/s
+        self.eta = None  # seconds
+        self.rate_limit = None  # bytes/s, see BandwidthManager
+        self.created = created or time.time()
+        self.resolved = Event()
+        self.done = Event()
 
-    def _sanitize(self, val):
-        # 1. Replace unicode with ascii-equivalents
-        val = (
-            unicodedata.normalize('NFKD', val)
-            .encode('ASCII', 'ignore')
-            .decode()
+    @classmethod
+    def from_record(cls, record):
+        """Re-create a job from a row of the :class:`JobStore`."""
+        job = cls(
+            record['username'],
+            record['url'],
+            record['preset'],
+            priority=record['priority'] or 'normal',
+            job_id=record['id'],
+            created=record['created'],
         )
-        # 2. Throw away any non-whitelisted characters
-        val = ''.join(c for c in val if c in self.whitelist)
-        return val.strip()
+        job.outfile = record['outfile']
+        job.error_class = record['error_class']
+        job.attempts = record['attempts'] or 0
+        job.retry_at = record['retry_at']
+        job.extractor = record['extractor']
+        job.video_id = record['video_id']
+        job.height = record['height']
+        job.set_state(record['state'], error=record['error'])
+        return job
+
+    @property
+    def dedup_key(self):
+        """Tuple identifying the resulting file independent of the user."""
+        return (self.extractor, self.video_id, self.preset)
+
+    def set_state(self, state, error=None):
+        """Update the `state` (and `error`) of the job."""
+        self.state = state
+        if error is not None:
+            self.error = error
+        if state in ('queued', 'finished', 'failed'):
+            self.resolved.set()
+        if state in ('finished', 'failed'):
+            self.done.set()
+
+    def reset(self):
+        """Return a failed job to the 'pending' state, for processing it
+        again from scratch."""
+        self.state = 'pending'
+        self.error = self.error_class = self.retry_at = None
+        self.attempts = 0
+        self.phase = self.downloaded_bytes = self.total_bytes = None
+        self.speed = self.eta = None
+        self.resolved.clear()
+        self.done.clear()
+
+    def as_dict(self):
+        """Summary of the job, for returning as JSON."""
+        return {
+            "job": self.id,
+            "username": self.username,
+            "url": self.url,
+            "preset": self.preset,
+            "priority": self.priority,
+            "format": self.format,
+            "state": self.state,
+            "outfile": self.outfile,
+            "error": self.error,
+            "error_class": self.error_class,
+            "attempts": self.attempts,
+            "retry_at": self.retry_at,
+            "progress": {attr: getattr(self, attr) for attr in JOB_PROGRESS},
+        }
+
+
+class JobStore:
+    """Crash-safe storage of jobs in an SQLite database (in WAL mode).
+
+    Finished jobs older than `retention` days are removed by :meth:`compact`,
+    which runs automatically after every `compact_every` finished jobs.
+    """
+
+    FINAL_STATES = ('finished', 'failed')
+
+    def __init__(self, filename, retention=7, compact_every=500):
+        self.filename = filename
+        self.retention = retention
+        self.compact_every = compact_every
+        self._n_finished = 0
+        self._lock = Lock()
+        self._db = sqlite3.connect(
+            str(filename), check_same_thread=False, isolation_level=None
+        )
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self._db.execute('PRAGMA journal_mode = WAL')
+        # in WAL mode, NORMAL is safe against application crashes
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        self._db.execute(
+            '''CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                username TEXT NOT NULL,
+                url TEXT NOT NULL,
+                preset TEXT NOT NULL,
+                state TEXT NOT NULL,
+                outfile TEXT,
+                error TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL,
+                extractor TEXT,
+                video_id TEXT,
+                priority TEXT,
+                error_class TEXT,
+                attempts INTEGER,
+                worker TEXT,
+                lease_until REAL,
+                progress TEXT,
+                height INTEGER,
+                retry_at REAL
+            )'''
+        )
+        columns = set(
+            row['name'] for row in self._db.execute('PRAGMA table_info(jobs)')
+        )
+        for column, coltype in [
+            ('extractor', 'TEXT'),
+            ('video_id', 'TEXT'),
+            ('priority', 'TEXT'),
+            ('error_class', 'TEXT'),
+            ('attempts', 'INTEGER'),
+            ('worker', 'TEXT'),
+            ('lease_until', 'REAL'),
+            ('progress', 'TEXT'),
+            ('height', 'INTEGER'),
+            ('retry_at', 'REAL'),
+        ]:
+            if column not in columns:  # database from an older version
+                self._db.execute(
+                    'ALTER TABLE jobs ADD COLUMN %s %s' % (column, coltype)
+                )
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, updated)'
+        )
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS jobs_video '
+            'ON jobs (extractor, video_id, preset)'
+        )
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS jobs_queue '
+            'ON jobs (state, worker, username, created)'
+        )
+
+    def add(self, job):
+        """Insert a new `job`."""
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO jobs (id, username, url, preset, '
+                'state, outfile, error, created, updated, extractor, '
+                'video_id, priority) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    job.id,
+                    job.username,
+                    job.url,
+                    job.preset,
+                    job.state,
+                    job.outfile,
+                    job.error,
+                    job.created,
+                    time.time(),
+                    job.extractor,
+                    job.video_id,
+                    job.priority,
+                ),
+            )
+
+    def update(self, job):
+        """Store the current `state`, `outfile`, `error`, `error_class`,
+        `attempts`, `retry_at`, `extractor`, `video_id`, and `height` of
+        `job`."""
+        with self._lock:
+            self._db.execute(
+                'UPDATE jobs SET state = ?, outfile = ?, error = ?, '
+                'error_class = ?, attempts = ?, retry_at = ?, updated = ?, '
+                'extractor = ?, video_id = ?, height = ? WHERE id = ?',
+                (
+                    job.state,
+                    job.outfile,
+                    job.error,
+                    job.error_class,
+                    job.attempts,
+                    job.retry_at,
+                    time.time(),
+                    job.extractor,
+                    job.video_id,
+                    job.height,
+                    job.id,
+                ),
+            )
+            if job.state in self.FINAL_STATES:
+                self._n_finished += 1
+                if self._n_finished >= self.compact_every:
+                    self._compact()
+
+    def get(self, job_id):
+        """Return the row for the given `job_id`, or None."""
+        with self._lock:
+            return self._db.execute(
+                'SELECT * FROM jobs WHERE id = ?', (job_id,)
+            ).fetchone()
+
+    def finished(self, extractor, video_id, preset):
+        """List of rows for finished jobs for the given video and preset.
+
+        The most recently finished jobs come first.
+        """
+        with self._lock:
+            return self._db.execute(
+                'SELECT * FROM jobs WHERE extractor = ? AND video_id = ? '
+                'AND preset = ? AND state = ? ORDER BY updated DESC',
+                (extractor, video_id, preset, 'finished'),
+            ).fetchall()
+
+    def failed(self, username):
+        """List of rows for the failed jobs of `username`, most recent
+        first."""
+        with self._lock:
+            return self._db.execute(
+                'SELECT * FROM jobs WHERE username = ? AND state = ? '
+                'ORDER BY updated DESC',
+                (username, 'failed'),
+            ).fetchall()
+
+    def unfinished(self):
+        """List of rows for all jobs that have not reached a final state."""
+        with self._lock:
+            return self._db.execute(
+                'SELECT * FROM jobs WHERE state NOT IN (?, ?) '
+                'ORDER BY created',
+                self.FINAL_STATES,
+            ).fetchall()
+
+    def compact(self):
+        """Remove old finished jobs and shrink the database files."""
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        self._n_finished = 0
+        cutoff = time.time() - 86400 * self.retention
+        self._db.execute(
+            'DELETE FROM jobs WHERE state IN (?, ?) AND updated < ?',
+            self.FINAL_STATES + (cutoff,),
+        )
+        self._db.execute('PRAGMA incremental_vacuum')
+        self._db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+        """Close the database."""
+        with self._lock:
+            self._db.close()
+
+
+class SQLiteQueue:
+    """Download queue shared by worker processes, kept in the database of a
+    :class:`JobStore`.
+
+    The queue consists of the jobs that are 'queued' with an empty `worker`
+    column (see :meth:`push`). A worker :meth:`claim`s a job, which gives it
+    a lease on the job for `lease` seconds. The worker renews the lease with
+    every :meth:`heartbeat` (which also publishes the progress of the
+    download), and hands the job back with :meth:`complete`. The jobs of a
+    worker that crashed or lost its connection are returned to the queue by
+    :meth:`reclaim` once their lease expires.
+
+    Jobs are handed out like from a :class:`FairQueue`: the next job is the
+    oldest one of the user with the fewest active jobs, subject to
+    `max_active` and `max_per_user` (0 for no limit). Jobs with priority
+    'low' are only handed out during the `offpeak` window, if one is given.
+    """
+
+    ACTIVE_STATES = ('downloading', 'postprocessing')
+
+    def __init__(
+        self, filename, lease=60, max_active=0, max_per_user=0, offpeak=None
+    ):
+        self.lease = lease
+        self.max_active = max_active
+        self.max_per_user = max_per_user
+        self.offpeak = offpeak
+        self._lock = Lock()
+        self._db = sqlite3.connect(
+            str(filename),
+            check_same_thread=False,
+            isolation_level=None,
+            timeout=30,
+        )
+        self._db.row_factory = sqlite3.Row
+
+    @contextmanager
+    def _transaction(self):
+        """Run a transaction that locks the database for writing, against all
+        other processes."""
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def push(self, job_id):
+        """Add the 'queued' job with the given `job_id` to the queue."""
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE jobs SET worker = '', lease_until = NULL, "
+                "progress = NULL WHERE id = ?",
+                (job_id,),
+            )
+
+    def claim(self, worker):
+        """Lease the next job in the queue to `worker`.
+
+        Returns the row of the job as a dict (in the 'downloading' state), or
+        None if no job is available.
+        """
+        low = self.offpeak is None or in_window(self.offpeak)
+        where = "state = 'queued' AND worker = ''"
+        if not low:
+            where += " AND priority IS NOT 'low'"
+        with self._transaction() as db:
+            active = dict(
+                db.execute(
+                    'SELECT username, COUNT(*) FROM jobs '
+                    'WHERE state IN (?, ?) GROUP BY username',
+                    self.ACTIVE_STATES,
+                ).fetchall()
+            )
+            if self.max_active and sum(active.values()) >= self.max_active:
+                return None
+            candidates = [
+                (active.get(username, 0), created, username)
+                for (username, created) in db.execute(
+                    'SELECT username, MIN(created) FROM jobs '
+                    'WHERE %s GROUP BY username' % where
+                )
+                if not self.max_per_user
+                or active.get(username, 0) < self.max_per_user
+            ]
+            if not candidates:
+                return None
+            username = min(candidates)[2]
+            row = db.execute(
+                'SELECT * FROM jobs WHERE %s AND username = ? '
+                'ORDER BY created LIMIT 1' % where,
+                (username,),
+            ).fetchone()
+            now = time.time()
+            db.execute(
+                "UPDATE jobs SET state = 'downloading', worker = ?, "
+                "lease_until = ?, updated = ? WHERE id = ?",
+                (worker, now + self.lease, now, row['id']),
+            )
+        record = dict(row)
+        record.update(state='downloading', worker=worker)
+        return record
+
+    def heartbeat(self, worker, job_id, state, progress):
+        """Renew the lease of `worker` on the job with the given `job_id`,
+        and record its `state` ('downloading' or 'postprocessing') and
+        `progress` (see :meth:`Job.as_dict`).
+
+        Returns whether `worker` still holds the lease. If not, the job was
+        reclaimed, and the worker must abandon it.
+        """
+        if state not in self.ACTIVE_STATES:
+            state = 'downloading'
+        with self._transaction() as db:
+            cursor = db.execute(
+                'UPDATE jobs SET state = ?, lease_until = ?, progress = ? '
+                'WHERE id = ? AND worker = ?',
+                (
+                    state,
+                    time.time() + self.lease,
+                    json.dumps(progress),
+                    job_id,
+                    worker,
+                ),
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, worker, job_id, state, error=None, error_class=None):
+        """End the lease of `worker` on the job with the given `job_id`.
+
+        The `state` is 'finished', 'failed' (with an `error` message and its
+        `error_class`, see :func:`classify_error`), or 'queued' to return the
+        job to the queue. Returns whether `worker` still held the lease.
+        """
+        if state not in ('finished', 'failed', 'queued'):
+            raise ValueError("Invalid state %r" % state)
+        worker_column = '' if state == 'queued' else None
+        with self._transaction() as db:
+            cursor = db.execute(
+                'UPDATE jobs SET state = ?, error = ?, error_class = ?, '
+                'worker = ?, lease_until = NULL, updated = ? '
+                'WHERE id = ? AND worker = ?',
+                (
+                    state,
+                    error,
+                    error_class,
+                    worker_column,
+                    time.time(),
+                    job_id,
+                    worker,
+                ),
+            )
+            return cursor.rowcount == 1
+
+    def reclaim(self):
+        """Return all jobs with an expired lease to the queue.
+
+        Returns a list of the ids of the reclaimed jobs.
+        """
+        with self._transaction() as db:
+            job_ids = [
+                row['id']
+                for row in db.execute(
+                    "SELECT id FROM jobs WHERE state IN (?, ?) "
+                    "AND worker != '' AND lease_until < ?",
+                    self.ACTIVE_STATES + (time.time(),),
+                )
+            ]
+            db.executemany(
+                "UPDATE jobs SET state = 'queued', worker = '', "
+                "lease_until = NULL, progress = NULL WHERE id = ?",
+                [(job_id,) for job_id in job_ids],
+            )
+        return job_ids
+
+    def rows(self, job_ids):
+        """Dict of the rows for the given `job_ids`, by id."""
+        job_ids = list(job_ids)
+        rows = {}
+        with self._lock:
+            for i in range(0, len(job_ids), 500):
+                chunk = job_ids[i : i + 500]
+                for row in self._db.execute(
+                    'SELECT * FROM jobs WHERE id IN (%s)'
+                    % ', '.join('?' * len(chunk)),
+                    chunk,
+                ):
+                    rows[row['id']] = row
+        return rows
+
+    def close(self):
+        """Close the database."""
+        with self._lock:
+            self._db.close()
+
+
+class HttpQueue:
+    """Client for the shared download queue of the server at `url`, for
+    worker processes on other hosts.
+
+    It has the same methods for workers as :class:`SQLiteQueue`, which are
+    forwarded to the "/worker" routes of the server, authenticated with
+    `token` (the YDL_WORKER_TOKEN of the server).
+    """
+
+    def __init__(self, url, token, timeout=30):
+        self.url = url.rstrip('/')
+        self.token = token
+        self.timeout = timeout
+
+    def _call(self, method, **data):
+        data['token'] = self.token
+        request = Request(
+            '%s/worker/%s' % (self.url, method),
+            data=json.dumps(data).encode('utf-8'),
+            headers={'Content-Type': 'application/json'},
+        )
+        with urlopen(request, timeout=self.timeout) as resp:
+            return json.loads(resp.read().decode('utf-8'))
+
+    def claim(self, worker):
+        return self._call('claim', worker=worker)['job']
+
+    def heartbeat(self, worker, job_id, state, progress):
+        return self._call(
+            'heartbeat',
+            worker=worker,
+            job=job_id,
+            state=state,
+            progress=progress,
+        )['success']
+
+    def complete(self, worker, job_id, state, error=None, error_class=None):
+        return self._call(
+            'complete',
+            worker=worker,
+            job=job_id,
+            state=state,
+            error=error,
+            error_class=error_class,
+        )['success']
+
+    def close(self):
+        pass
+
+
+class JobRegistry:
+    """Lookup of jobs by their id.
+
+    All jobs are persisted in the given :class:`JobStore`. Of the jobs that
+    are finished, only the most recent `history` are kept in memory.
+    """
+
+    def __init__(self, store, history=1000):
+        self.store = store
+        self.history = history
+        self._jobs = OrderedDict()  # id => Job
+        self._finished = OrderedDict()  # id => None, in order of finishing
+        self._outfiles = {}  # (username, url, preset) => outfile
+        self._lock = Lock()
+        self.version = 0  # incremented for every change to any job
+        self.changed = Condition()  # notified for every change to any job
+
+    def notify(self):
+        """Wake up all threads waiting for a change to any job."""
+        with self.changed:
+            self.version += 1
+            self.changed.notify_all()
+
+    def wait(self, version, timeout=None):
+        """Wait until the `version` differs from the given one.
+
+        Returns the new version.
+        """
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def add(self, job, persist=True):
+        """Register a `job`.
+
+        Unless `persist` is False (for a job that was loaded from the
+        `store`), the job is also inserted into the `store`.
+        """
+        if persist:
+            self.store.add(job)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._track(job)
+
+    def update(self, job, state, error=None):
+        """Set the `state` (and `error`) of `job`, and persist it."""
+        job.set_state(state, error=error)
+        self.store.update(job)
+        with self._lock:
+            if self._jobs.get(job.id, None) is job:
+                self._track(job)
+        self.notify()
+
+    def _track(self, job):
+        """Keep track of whether `job` is finished, and drop the oldest
+        finished jobs beyond the `history` from memory."""
+        if not job.done.is_set():
+            self._finished.pop(job.id, None)
+            return
+        self._finished[job.id] = None
+        self._finished.move_to_end(job.id)
+        while len(self._finished) > self.history:
+            job_id, _ = self._finished.popitem(last=False)
+            self._jobs.pop(job_id, None)
+
+    def get(self, job_id):
+        """Return the job with the given `job_id`, or None.
+
+        Jobs no longer held in memory are loaded from the `store`.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id, None)
+        if job is None:
+            record = self.store.get(job_id)
+            if record is not None:
+                job = Job.from_record(record)
+        return job
+
+    def jobs_for(self, username):
+        """List of the jobs of `username` held in memory, oldest first."""
+        with self._lock:
+            return [
+                job for job in self._jobs.values() if job.username == username
+            ]
+
+    def jobs_in(self, states):
+        """List of the jobs held in memory that are in one of the given
+        `states`."""
+        with self._lock:
+            return [job for job in self._jobs.values() if job.state in states]
+
+    def failed(self, username):
+        """List of the failed jobs of `username`, most recent first."""
+        jobs = []
+        for record in self.store.failed(username):
+            with self._lock:
+                job = self._jobs.get(record['id'], None)
+            jobs.append(job or Job.from_record(record))
+        return jobs
+
+    def resolve(self, job, outfile):
+        """Record the `outfile` for `job`.
+
+        The `outfile` is persisted with the next call to :meth:`update`.
+        """
+        job.outfile = outfile
+        with self._lock:
+            self._outfiles[(job.username, job.url, job.preset)] = outfile
+
+    def predict_outfile(self, username, url, preset):
+        """Outfile of the most recent job for the same request, or None."""
+        with self._lock:
+            return self._outfiles.get((username, url, preset), None)
+
+
+class Batch:
+    """Group of jobs for `username` created by a single batch submission.
+
+    The submitted `urls` are expanded by :func:`expand_batch`, which adds the
+    job for each video via :meth:`add` as soon as it is discovered. Urls that
+    could not be expanded or submitted are recorded via :meth:`add_error`.
+    The `expanding` flag is cleared once all `urls` have been processed.
+    """
+
+    def __init__(self, username, urls, preset, priority='normal'):
+        self.id = uuid.uuid4().hex
+        self.username = username
+        self.urls = urls
+        self.preset = preset
+        self.priority = priority
+        self.jobs = []
+        self.errors = []  # (url, error)
+        self.expanding = True
+        self.created = time.time()
+        self._lock = Lock()
+
+    def add(self, job):
+        """Add a submitted `job` to the batch."""
+        with self._lock:
+            self.jobs.append(job)
+
+    def add_error(self, url, error):
+        """Record that `url` could not be submitted."""
+        with self._lock:
+            self.errors.append((url, error))
+
+    @property
+    def done(self):
+        """Whether the batch is expanded and all of its jobs are done."""
+        if self.expanding:
+            return False
+        with self._lock:
+            return all(job.done.is_set() for job in self.jobs)
+
+    def as_dict(self, with_jobs=False):
+        """Aggregate progress of the batch, for returning as JSON.
+
+        If `with_jobs` is True, the result includes the summary of every job
+        in the batch.
+        """
+        with self._lock:
+            jobs = list(self.jobs)
+            errors = list(self.errors)
+        states = defaultdict(int)
+        for job in jobs:
+            states[job.state] += 1
+        if self.expanding:
+            state = 'expanding'
+        elif all(job.done.is_set() for job in jobs):
+            state = 'finished'
+        else:
+            state = 'running'
+        result = {
+            "batch": self.id,
+            "username": self.username,
+            "preset": self.preset,
+            "priority": self.priority,
+            "state": state,
+            "jobs": len(jobs),
+            "states": dict(states),
+            "downloaded_bytes": sum(job.downloaded_bytes or 0 for job in jobs),
+            "total_bytes": sum(job.total_bytes or 0 for job in jobs),
+            "errors": [
+                {"url": url, "error": error} for (url, error) in errors
+            ],
+        }
+        if with_jobs:
+            result['job_list'] = [job.as_dict() for job in jobs]
+        return result
+
+
+class BatchRegistry:
+    """Lookup of batches by their id.
+
+    Batches are kept in memory only. Of the batches that are done, only the
+    most recent `history` are kept.
+    """
+
+    def __init__(self, history=100):
+        self.history = history
+        self._batches = OrderedDict()  # id => Batch
+        self._lock = Lock()
+
+    def add(self, batch):
+        """Register a `batch`."""
+        with self._lock:
+            self._batches[batch.id] = batch
+            done = [b for b in self._batches.values() if b.done]
+            for old in done[: max(0, len(done) - self.history)]:
+                del self._batches[old.id]
+
+    def get(self, batch_id):
+        """Return the batch with the given `batch_id`, or None."""
+        with self._lock:
+            return self._batches.get(batch_id, None)
+
+
+class FileIndex:
+    """Index of the downloaded files in an output directory.
+
+    The index holds the size, ctime, mtime, and inode of each file with one
+    of the given `suffixes`, and the `total` size of all files. It is updated
+    by :meth:`add` and :meth:`remove`, and by :meth:`refresh`, which re-scans
+    the directory (including the size and times of every file, as files may
+    have been replaced) only if the directory's mtime has changed. Sorted
+    listings are cached until the next change.
+    """
+
+    SORTKEYS = {
+        'name': None,
+        'time': 1,  # alias for creation time
+        'ctime': 1,
+        'mtime': 2,
+        'size': 0,
+    }  # sort => index in the (size, ctime, mtime) tuple
+
+    def __init__(self, outdir, suffixes=('.mp4', '.mp3')):
+        self.outdir = Path(outdir)
+        self.suffixes = suffixes
+        self._files = {}  # name => (size, ctime, mtime)
+        self._inodes = {}  # name => (st_dev, st_ino)
+        self._sorted = {}  # sort => list of names
+        self._dir_mtime = None
+        self._lock = Lock()
+        self.total = 0  # bytes
+
+    def refresh(self):
+        """Re-scan the directory if it has changed since the last scan."""
+        try:
+            dir_mtime = self.outdir.stat().st_mtime_ns
+        except OSError:
+            return
+        if dir_mtime == self._dir_mtime:
+            return
+        files = {}
+        inodes = {}
+        with os.scandir(str(self.outdir)) as entries:
+            for entry in entries:
+                if os.path.splitext(entry.name)[1] not in self.suffixes:
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+                files[entry.name] = (st.st_size, st.st_ctime, st.st_mtime)
+                inodes[entry.name] = (st.st_dev, st.st_ino)
+        with self._lock:
+            self._files = files
+            self._inodes = inodes
+            self.total = sum(size for (size, _, _) in files.values())
+            self._sorted = {}
+            self._dir_mtime = dir_mtime
+
+    def add(self, name):
+        """Add (or update) the file `name` in the index."""
+        if os.path.splitext(name)[1] not in self.suffixes:
+            return
+        try:
+            st = (self.outdir / name).stat()
+        except OSError:
+            return self.remove(name)
+        with self._lock:
+            old = self._files.get(name, None)
+            if old is not None:
+                self.total -= old[0]
+            self._files[name] = (st.st_size, st.st_ctime, st.st_mtime)
+            self._inodes[name] = (st.st_dev, st.st_ino)
+            self.total += st.st_size
+            self._sorted = {}
+
+    def remove(self, name):
+        """Remove the file `name` from the index."""
+        with self._lock:
+            old = self._files.pop(name, None)
+            if old is not None:
+                del self._inodes[name]
+                self.total -= old[0]
+                self._sorted = {}
+
+    def entries(self):
+        """List of tuples (name, size, ctime, inode) for all files."""
+        if self._dir_mtime is None:
+            self.refresh()
+        with self._lock:
+            return [
+                (name, size, ctime, self._inodes[name])
+                for (name, (size, ctime, _)) in self._files.items()
+            ]
+
+    def listing(self, sort='ctime', offset=0, limit=None, prefix=''):
+        """Return a tuple (total, files) for a page of the index.
+
+        The `files` are a list of tuples (name, size, ctime, mtime), sorted
+        ascending by the `sort` key, starting at `offset`, and of length
+        `limit` at most (no limit if None). Only files whose name starts
+        with `prefix` are included, `total` being the number of such files.
+        """
+        if self._dir_mtime is None:
+            self.refresh()
+        if sort not in self.SORTKEYS:
+            sort = 'ctime'
+        with self._lock:
+            files = self._files
+            names = self._sorted.get(sort, None)
+            if names is None:
+                if self.SORTKEYS[sort] is None:
+                    names = sorted(files)
+                else:
+                    i = self.SORTKEYS[sort]
+                    names = sorted(files, key=lambda name: files[name][i])
+                self._sorted[sort] = names
+        if prefix:
+            if sort == 'name':
+                start = bisect_left(names, prefix)
+                end = bisect_left(names, prefix + '\U0010ffff')
+                names = names[start:end]
+            else:
+                names = [name for name in names if name.startswith(prefix)]
+        total = len(names)
+        end = None if limit is None else offset + limit
+        return total, [(name,) + files[name] for name in names[offset:end]]
+
+
+def file_index(username):
+    """Return the :class:`FileIndex` for the OUTDIR of `username`."""
+    return FILE_INDEX[OUTDIRS[username]]
+
+
+def index_refresher():
+    """Periodically refresh all FILE_INDEX entries.
+
+    This is the main function of the index refresher thread.
+    """
+    while not SHUTDOWN.wait(YDL_LIST_REFRESH):
+        for index in FILE_INDEX.values():
+            try:
+                index.refresh()
+            except OSError as exc_info:
+                MAIN_LOGGER.error("Cannot refresh file index: %r", exc_info)
+
+
+class Retention:
+    """Disk quotas and retention policy for the files in the output
+    directories.
+
+    The files are those of the :class:`FileIndex` `indexes` (outdir =>
+    index). For every file, the time of its last access via the /result
+    route and whether it is pinned are kept in the table "files" of the
+    SQLite database `filename`. Files that are not pinned are removed, least
+    recently used (last accessed, or else created) first, as far as
+    necessary to
+
+    * remove files older than `max_age` days (0 for no limit)
+    * keep the files of every user within the user's quota in bytes
+      (`quotas`: username => bytes, 0 or None for no limit)
+    * keep all files within the global `quota` in bytes (0 for no limit)
+    * keep `min_free` bytes of free space on every file system (0 to never
+      remove files for lack of free space)
+
+    Without any of these limits, no file is ever removed. Hardlinked copies
+    of a file (see :func:`link_file`) count for the quota of every user, but
+    only once for the global quota and the free space; only removing all
+    copies frees that space.
+
+    The limits are enforced by :meth:`sweep` (see :func:`retention_sweeper`)
+    and, before a download starts, by :meth:`admit`. Both take into account
+    the bytes still to be written by downloads in progress (see
+    :func:`reserved_space`). To make room for a new download, :meth:`admit`
+    only removes files of the same user, unless `evict_others` is True. The
+    sizes and times of the files are taken from the `indexes`, and
+    :meth:`admit` only lists the files if the running totals of the indexes
+    show that the new file does not fit.
+    """
+
+    def __init__(
+        self,
+        filename,
+        indexes,
+        outdirs,
+        quotas,
+        quota=0,
+        max_age=0,
+        min_free=0,
+        evict_others=False,
+    ):
+        self.indexes = indexes
+        self.outdirs = outdirs
+        self.quotas = {}  # outdir => bytes (the smallest quota of its users)
+        for username, limit in quotas.items():
+            outdir = outdirs[username]
+            if limit:
+                limit = min(limit, self.quotas.get(outdir, limit))
+                self.quotas[outdir] = limit
+        self.quota = quota
+        self.max_age = max_age
+        self.min_free = min_free
+        self.evict_others = evict_others
+        self._lock = Lock()
+        self._db = sqlite3.connect(
+            str(filename), check_same_thread=False, isolation_level=None
+        )
+        self._db.execute(
+            '''CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                accessed REAL,
+                pinned INTEGER NOT NULL DEFAULT 0
+            )'''
+        )
+
+    @property
+    def active(self):
+        """Whether any limit is set, i.e., whether files may be removed."""
+        return bool(self.quotas or self.quota or self.max_age or self.min_free)
+
+    def touch(self, username, filename):
+        """Record an access to the file `filename` of `username`."""
+        path = str(Path(self.outdirs[username]) / filename)
+        with self._lock:
+            self._db.execute(
+                'INSERT INTO files (path, accessed) VALUES (?, ?) '
+                'ON CONFLICT (path) '
+                'DO UPDATE SET accessed = excluded.accessed',
+                (path, time.time()),
+            )
+
+    def pin(self, username, filename, pinned=True):
+        """Pin (or unpin) the file `filename` of `username`."""
+        path = str(Path(self.outdirs[username]) / filename)
+        with self._lock:
+            self._db.execute(
+                'INSERT INTO files (path, pinned) VALUES (?, ?) '
+                'ON CONFLICT (path) DO UPDATE SET pinned = excluded.pinned',
+                (path, int(pinned)),
+            )
+
+    def sweep(self, reserved):
+        """Remove files as necessary to satisfy all limits, with `reserved`
+        bytes (outdir => bytes) for downloads in progress.
+
+        Returns a list of the limits that cannot be satisfied (because they
+        are exceeded by pinned files alone).
+        """
+        for index in self.indexes.values():
+            index.refresh()
+        with self._lock:
+            return self._enforce(self._scan(), reserved)
+
+    def admit(self, username, size, reserved):
+        """Make room for a new file of `size` bytes for `username`, in
+        addition to the `reserved` bytes (outdir => bytes) for other
+        downloads in progress.
+
+        Returns None if the file fits, or else an error message. Only the
+        limits for the output directory of `username` are checked. No files
+        are removed unless this makes the file fit.
+        """
+        reserved = dict(reserved)
+        outdir = self.outdirs[username]
+        reserved[outdir] = reserved.get(outdir, 0) + size
+        for index in self.indexes.values():
+            index.refresh()
+        with self._lock:
+            if self._fits(outdir, reserved):
+                return None
+            files = self._scan() if self.active else []
+            if not self.evict_others:
+                for file in files:
+                    if file['outdir'] != outdir:
+                        file['evictable'] = False
+            violations = self._enforce(
+                copy.deepcopy(files), reserved, scope=outdir, remove=False
+            )
+            if not violations:
+                self._enforce(files, reserved, scope=outdir)
+        if violations:
+            return "Not enough disk space for %s: %s" % (
+                youtube_dl.utils.format_bytes(size),
+                ", ".join(violations),
+            )
+        return None
+
+    def _devices(self):
+        """Dict st_dev => list of the outdirs on that file system."""
+        devices = defaultdict(list)
+        for outdir in self.indexes:
+            devices[os.stat(outdir).st_dev].append(outdir)
+        return devices
+
+    def _fits(self, outdir, reserved):
+        """Whether all limits for `outdir` are satisfied with the `reserved`
+        bytes (outdir => bytes) without removing any files, according to
+        the running totals of the `indexes`.
+
+        Hardlinked copies are counted repeatedly for the global quota, so
+        that this errs on the side of a full check by :meth:`_enforce`.
+        """
+        quota = self.quotas.get(outdir, 0)
+        if quota and self.indexes[outdir].total + reserved[outdir] > quota:
+            return False
+        if self.quota > 0:
+            used = sum(index.total for index in self.indexes.values())
+            if used + sum(reserved.values()) > self.quota:
+                return False
+        device = os.stat(outdir).st_dev
+        on_device = self._devices()[device]
+        needed = self.min_free + sum(reserved.get(d, 0) for d in on_device)
+        return needed <= shutil.disk_usage(outdir).free
+
+    def _scan(self):
+        """List of dicts describing all files in the output directories."""
+        records = {
+            path: (accessed, pinned)
+            for (path, accessed, pinned) in self._db.execute(
+                'SELECT path, accessed, pinned FROM files'
+            )
+        }
+        files = []
+        for outdir, index in self.indexes.items():
+            for (name, size, ctime, inode) in index.entries():
+                path = str(Path(outdir) / name)
+                accessed, pinned = records.pop(path, (None, 0))
+                files.append(
+                    {
+                        'path': path,
+                        'outdir': outdir,
+                        'name': name,
+                        'size': size,
+                        'inode': inode,
+                        'created': ctime,
+                        'used': accessed or ctime,
+                        'pinned': bool(pinned),
+                        'evictable': not pinned,
+                        'removed': False,
+                    }
+                )
+        if records:  # files that no longer exist
+            self._db.executemany(
+                'DELETE FROM files WHERE path = ?', [(p,) for p in records]
+            )
+        return files
+
+    def _enforce(self, files, reserved, scope=None, remove=True):
+        """Remove `files` (from :meth:`_scan`) as necessary to satisfy all
+        limits, and return the list of limits that cannot be satisfied.
+
+        With a `scope` (an output directory), only the limits that apply to
+        that directory are checked, and files older than `max_age` are left
+        to :meth:`sweep`. Only files marked as "evictable" are removed, and
+        without `remove`, they are only marked as removed.
+        """
+        violations = []
+        devices = self._devices()
+        if scope is not None:
+            device = os.stat(scope).st_dev
+            devices = {device: devices[device]}
+        free = {
+            device: shutil.disk_usage(outdirs[0]).free
+            for (device, outdirs) in devices.items()
+        }
+        if self.max_age > 0 and scope is None:
+            cutoff = time.time() - 86400 * self.max_age
+            for file in files:
+                if file['evictable'] and file['created'] < cutoff:
+                    self._remove(file, "max. age", remove)
+        for outdir, quota in self.quotas.items():
+            if scope is not None and outdir != scope:
+                continue
+            in_outdir = [file for file in files if file['outdir'] == outdir]
+            used = sum(f['size'] for f in in_outdir if not f['removed'])
+            excess = used + reserved.get(outdir, 0) - quota
+            if self._evict(in_outdir, excess, "quota", remove, group=False):
+                violations.append("quota of %r exceeded" % outdir)
+        if self.quota > 0:
+            sizes = {f['inode']: f['size'] for f in files if not f['removed']}
+            excess = sum(sizes.values()) + sum(reserved.values()) - self.quota
+            if self._evict(files, excess, "global quota", remove):
+                violations.append("global quota exceeded")
+        for device, outdirs in devices.items():
+            on_device = [file for file in files if file['inode'][0] == device]
+            excess = (
+                self.min_free
+                + sum(reserved.get(outdir, 0) for outdir in outdirs)
+                - free[device]
+                - self._freed(on_device)
+            )
+            if self.min_free > 0:
+                full = self._evict(on_device, excess, "free space", remove)
+            else:  # no limit, so never remove files for lack of space
+                full = excess > 0
+            if full:
+                violations.append(
+                    "file system of %r is full" % (scope or outdirs[0])
+                )
+        return violations
+
+    @staticmethod
+    def _freed(files):
+        """Bytes freed by removing the `files` marked as removed."""
+        kept = {file['inode'] for file in files if not file['removed']}
+        freed = {
+            file['inode']: file['size']
+            for file in files
+            if file['removed'] and file['inode'] not in kept
+        }
+        return sum(freed.values())
+
+    def _evict(self, files, excess, reason, remove=True, group=True):
+        """Remove the least recently used evictable `files` (those that are
+        not pinned, see :meth:`admit`) until `excess` bytes are freed (see
+        :meth:`_remove`). With `group`, all
+        hardlinked copies of a file are removed together. Returns whether
+        there is any remaining excess."""
+        if excess <= 0:
+            return False
+        units = defaultdict(list)
+        for file in files:
+            units[file['inode'] if group else file['path']].append(file)
+        for unit in sorted(
+            units.values(), key=lambda unit: max(f['used'] for f in unit)
+        ):
+            if excess <= 0:
+                break
+            if not all(f['evictable'] for f in unit) or unit[0]['removed']:
+                continue
+            if all(self._remove(f, reason, remove) for f in unit):
+                excess -= unit[0]['size']
+        return excess > 0
+
+    def _remove(self, file, reason, remove=True):
+        """Remove a `file` (with its log file) and return whether it was
+        removed. Without `remove`, only mark the file as removed."""
+        if not remove:
+            file['removed'] = True
+            return True
+        try:
+            os.remove(file['path'])
+        except FileNotFoundError:
+            pass
+        except OSError as exc_info:
+            MAIN_LOGGER.error("Cannot remove %r: %r", file['path'], exc_info)
+            return False
+        file['removed'] = True
+        index = self.indexes[file['outdir']]
+        index.remove(file['name'])
+        path = Path(file['path'])
+        if not any(path.with_suffix(s).exists() for s in index.suffixes):
+            try:
+                path.with_suffix('.log').unlink()
+            except OSError:
+                pass
+        self._db.execute('DELETE FROM files WHERE path = ?', (file['path'],))
+        MAIN_LOGGER.info("Removed %r (%s)", file['path'], reason)
+        return True
+
+    def close(self):
+        """Close the database."""
+        with self._lock:
+            self._db.close()
+
+
+def reserved_space(exclude=None):
+    """Bytes (outdir => bytes) still to be written by the downloads in
+    progress, except for the job `exclude`."""
+    reserved = defaultdict(int)
+    for job in JOBS.jobs_in(('queued', 'downloading', 'postprocessing')):
+        if job is not exclude and job.filesize:
+            remaining = job.filesize - (job.downloaded_bytes or 0)
+            reserved[OUTDIRS[job.username]] += max(0, remaining)
+    return reserved
+
+
+def retention_sweeper():
+    """Periodically enforce the quotas and retention policy of RETENTION.
+
+    This is the main function of the retention sweeper thread.
+    """
+    while True:
+        try:
+            for violation in RETENTION.sweep(reserved_space()):
+                MAIN_LOGGER.warning("Cannot free disk space: %s", violation)
+        except (OSError, sqlite3.Error) as exc_info:
+            MAIN_LOGGER.error("Cannot sweep output directories: %r", exc_info)
+        if STOPPING.wait(YDL_SWEEP_INTERVAL):
+            return
+
+
+class Counter:
+    """Metric counting events, optionally with labels.
+
+    The values for the different combinations of labels (tuples of strings,
+    in the order of `labelnames`) are rendered in the Prometheus text format
+    by :class:`MetricsRegistry`. If a function `fn` is given, it is called on
+    every rendering to obtain the value (without labels).
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=(), fn=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.fn = fn
+        self._values = {}  # labels => value
+        self._lock = Lock()
+
+    def inc(self, amount=1, labels=()):
+        """Increase the value for the given `labels` by `amount`."""
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        """List of tuples (suffix, labels, value)."""
+        if self.fn is not None:
+            value = self.fn()
+            return [] if value is None else [('', (), value)]
+        with self._lock:
+            return [('', labels, val) for labels, val in self._values.items()]
+
+
+class Gauge(Counter):
+    """Metric for a value that can go up and down."""
+
+    kind = 'gauge'
+
+    def set(self, value, labels=()):
+        """Set the value for the given `labels`."""
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Counter):
+    """Metric for the distribution of observed values (e.g. latencies)."""
+
+    kind = 'histogram'
+
+    DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=None):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets or self.DEFAULT_BUCKETS)
+
+    def observe(self, value, labels=()):
+        """Record an observed `value` for the given `labels`."""
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels, None)
+            if entry is None:
+                entry = self._values[labels] = [
+                    [0] * (len(self.buckets) + 1),
+                    0.0,
+                ]
+            entry[0][i] += 1
+            entry[1] += value
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            values = [
+                (labels, list(counts), total)
+                for (labels, (counts, total)) in self._values.items()
+            ]
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                samples.append(('_bucket', labels + (le,), cumulative))
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """Collection of metrics, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        """Add `metric` to the registry, and return it."""
+        self._metrics.append(metric)
+        return metric
+
+    @staticmethod
+    def _escape(value):
+        return (
+            str(value)
+            .replace('\\', '\\\\')
+            .replace('"', '\\"')
+            .replace('\n', '\\n')
+        )
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for suffix, labels, value in metric.samples():
+                labelnames = metric.labelnames
+                if suffix == '_bucket':
+                    labelnames = labelnames + ('le',)
+                if labels:
+                    labelstr = '{%s}' % ','.join(
+                        '%s="%s"' % (name, self._escape(val))
+                        for (name, val) in zip(labelnames, labels)
+                    )
+                else:
+                    labelstr = ''
+                lines.append(
+                    '%s%s%s %s' % (metric.name, suffix, labelstr, value)
+                )
+        return '\n'.join(lines) + '\n'
+
+
+def process_stats():
+    """Dict with the resident memory (`rss_bytes`) and the number of open
+    file descriptors (`open_fds`) of the server process.
+
+    The values are read from /proc, and are None where it is unavailable.
+    """
+    stats = {'rss_bytes': None, 'open_fds': None}
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        stats['rss_bytes'] = pages * os.sysconf('SC_PAGE_SIZE')
+        stats['open_fds'] = len(os.listdir('/proc/self/fd'))
+    except (OSError, ValueError, IndexError):
+        pass
+    return stats
+
+
+class Deduplicator:
+    """Coalesce concurrent jobs for the same video and preset.
+
+    The first job to :meth:`claim` a :attr:`Job.dedup_key` becomes the
+    "primary" job that does the actual download. Later jobs with the same key
+    are attached to the primary job as "followers" until the primary job is
+    released.
+    """
+
+    def __init__(self):
+        self._primaries = {}  # dedup_key => primary Job
+        self._followers = defaultdict(list)  # primary job id => [Job, ...]
+        self._lock = Lock()
+
+    def claim(self, job):
+        """Claim the `job`'s key, or attach `job` to an existing primary.
+
+        Returns the primary job `job` was attached to, or None if `job` itself
+        became the primary job.
+        """
+        with self._lock:
+            primary = self._primaries.get(job.dedup_key, None)
+            if primary is None:
+                self._primaries[job.dedup_key] = job
+            else:
+                self._followers[primary.id].append(job)
+            return primary
+
+    def release(self, job):
+        """Release the key of primary `job` and return a list of followers."""
+        with self._lock:
+            if self._primaries.get(job.dedup_key, None) is job:
+                del self._primaries[job.dedup_key]
+            return self._followers.pop(job.id, [])
+
+
+class RetryScheduler:
+    """Resubmission of jobs after a delay.
+
+    Jobs added with :meth:`schedule` are passed to the `submit` function
+    once their `retry_at` time has come, by the thread running :meth:`run`.
+    """
+
+    def __init__(self, submit):
+        self.submit = submit
+        self._heap = []  # (retry_at, sequence number, job)
+        self._sequence = itertools.count()
+        self._closed = False
+        self._changed = Condition()
+
+    def schedule(self, job):
+        """Submit `job` again at `job.retry_at`."""
+        with self._changed:
+            heapq.heappush(
+                self._heap, (job.retry_at, next(self._sequence), job)
+            )
+            self._changed.notify()
+
+    def __len__(self):
+        with self._changed:
+            return len(self._heap)
+
+    def _next(self):
+        with self._changed:
+            while not self._closed:
+                now = time.time()
+                if self._heap and self._heap[0][0] <= now:
+                    return heapq.heappop(self._heap)[2]
+                timeout = (self._heap[0][0] - now) if self._heap else None
+                self._changed.wait(timeout)
+            return None
+
+    def run(self):
+        """Submit jobs as they become due, until :meth:`close` is called."""
+        while True:
+            job = self._next()
+            if job is None:
+                return
+            self.submit(job)
+
+    def close(self):
+        """Stop :meth:`run`. Jobs that are not due yet remain 'retrying', to
+        be resumed after a restart."""
+        with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+
+
+class JobGate:
+    """Gate that threads pass while working on a job with youtube-dl.
+
+    Work on a job is wrapped in ``with gate:``. The :meth:`exclusive`
+    context closes the gate: new work waits at the gate, and the context is
+    entered once all work in progress has left it. The gate must not be
+    entered again by a thread that is already inside.
+    """
+
+    def __init__(self):
+        self._active = 0
+        self._closed = False
+        self._changed = Condition()
+
+    def __enter__(self):
+        with self._changed:
+            self._changed.wait_for(lambda: not self._closed)
+            self._active += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self._changed:
+            self._active -= 1
+            self._changed.notify_all()
+
+    def active(self):
+        """Number of threads inside the gate."""
+        with self._changed:
+            return self._active
+
+    @contextmanager
+    def exclusive(self):
+        """Close the gate, and wait until no thread is inside."""
+        with self._changed:
+            self._changed.wait_for(lambda: not self._closed)
+            self._closed = True
+            self._changed.wait_for(lambda: self._active == 0)
+        try:
+            yield
+        finally:
+            with self._changed:
+                self._closed = False
+                self._changed.notify_all()
+
+
+def normalize_url(url):
+    """Normalize `url` for use as a cache key.
+
+    Surrounding whitespace and the fragment are removed, the scheme and host
+    are lower-cased, and the query parameters are sorted.
+    """
+    parts = urlsplit(url.strip())
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit(
+        (parts.scheme.lower(), parts.netloc.lower(), parts.path, query, '')
+    )
+
+
+class InfoCache:
+    """LRU cache of video information extracted by youtube-dl.
+
+    Entries are keyed by the normalized url and the preset, and expire after
+    `ttl` seconds. There are at most `maxsize` entries (0 disables the
+    cache). The `hits`, `misses`, and `evictions` attributes count the cache
+    lookups and removals, for sizing the cache.
+    """
+
+    def __init__(self, maxsize=256, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key => (expiration time, info)
+        self._lock = Lock()
+
+    def _lookup(self, key):
+        entry = self._entries.get(key, None)
+        if entry is None:
+            return None
+        expires, info = entry
+        if expires < time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return info
+
+    def get(self, url, preset):
+        """Return the cached info for `url` and `preset`, or None."""
+        key = (normalize_url(url), preset)
+        with self._lock:
+            info = self._lookup(key)
+            if info is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return info
+
+    def peek(self, url, preset):
+        """Like :meth:`get`, but without counting a hit or miss."""
+        key = (normalize_url(url), preset)
+        with self._lock:
+            return self._lookup(key)
+
+    def discard(self, url, preset):
+        """Remove the cached info for `url` and `preset`, if any."""
+        key = (normalize_url(url), preset)
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def put(self, url, preset, info):
+        """Store `info` for `url` and `preset`."""
+        if self.maxsize <= 0:
+            return
+        key = (normalize_url(url), preset)
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, info)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """Dict of cache statistics."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": (self.hits / lookups) if lookups else None,
+            }
+
+    def save(self, filename):
+        """Write all unexpired entries to the JSON file `filename`."""
+        now = time.time()
+        with self._lock:
+            entries = [
+                (url, preset, expires, info)
+                for ((url, preset), (expires, info)) in self._entries.items()
+                if expires >= now
+            ]
+        data = []
+        for entry in entries:
+            try:
+                data.append(json.dumps(entry))
+            except (TypeError, ValueError):
+                continue  # skip info that cannot be serialized
+        tmpfile = Path(str(filename) + '.tmp')
+        tmpfile.write_text("[%s]" % ",\n".join(data))
+        tmpfile.replace(filename)
+
+    def load(self, filename):
+        """Add the unexpired entries from the JSON file `filename`."""
+        now = time.time()
+        entries = json.loads(Path(filename).read_text())
+        with self._lock:
+            for (url, preset, expires, info) in entries:
+                if expires >= now:
+                    self._entries[(url, preset)] = (expires, info)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+def job_is_ready(job):
+    """Whether the download for `job` may start now.
+
+    Jobs with priority 'low' are only ready during the YDL_OFFPEAK window.
+    """
+    return job.priority != 'low' or in_window(OFFPEAK_WINDOW)
+
+
+DL_Q = FairQueue(
+    max_active=YDL_MAX_ACTIVE,
+    max_per_user=YDL_MAX_ACTIVE_PER_USER,
+    ready=job_is_ready if OFFPEAK_WINDOW is not None else None,
+)
+
+BANDWIDTH = BandwidthManager(limit=YDL_RATE_LIMIT, user_limits=RATE_LIMITS)
+
+SHUTDOWN = Event()  # set when in-flight downloads should be aborted
+STOPPING = Event()  # set when the server stops, ending all event streams
+
+JOBS = JobRegistry(
+    JobStore(YDL_JOBS_DB, retention=YDL_JOBS_RETENTION),
+    history=YDL_JOB_HISTORY,
+)
+
+WORKER_QUEUE = None  # shared queue for worker processes
+if YDL_QUEUE == 'shared':
+    WORKER_QUEUE = SQLiteQueue(
+        YDL_JOBS_DB,
+        lease=YDL_LEASE,
+        max_active=YDL_MAX_ACTIVE,
+        max_per_user=YDL_MAX_ACTIVE_PER_USER,
+        offpeak=OFFPEAK_WINDOW,
+    )
+
+BATCHES = BatchRegistry(history=YDL_BATCH_HISTORY)
+
+DEDUP = Deduplicator()
+
+RETRIES = RetryScheduler(submit=lambda job: resubmit_job(job))
+
+GATE = JobGate()  # closed while the youtube_dl module is reloaded
+
+FILE_INDEX = {outdir: FileIndex(outdir) for outdir in set(OUTDIRS.values())}
+
+RETENTION = Retention(
+    YDL_JOBS_DB,
+    FILE_INDEX,
+    OUTDIRS,
+    QUOTAS,
+    quota=YDL_QUOTA,
+    max_age=YDL_MAX_AGE,
+    min_free=YDL_MIN_FREE,
+    evict_others=YDL_EVICT_OTHERS,
+)
+
+INFO_CACHE = InfoCache(maxsize=YDL_INFO_CACHE_SIZE, ttl=YDL_INFO_CACHE_TTL)
+
+METRICS = MetricsRegistry()
+METRIC_QUEUE_PENDING = METRICS.register(
+    Gauge(
+        'ydl_queue_pending',
+        "Number of jobs waiting in the download queue",
+        fn=lambda: DL_Q.qsize(),
+    )
+)
+METRIC_WORKERS_ACTIVE = METRICS.register(
+    Gauge(
+        'ydl_workers_active',
+        "Number of download threads processing a job",
+        fn=lambda: sum(DL_Q.active().values()),
+    )
+)
+METRIC_WORKERS = METRICS.register(
+    Gauge(
+        'ydl_workers', "Number of download threads", fn=lambda: YDL_WORKERS
+    )
+)
+METRIC_RSS = METRICS.register(
+    Gauge(
+        'process_resident_memory_bytes',
+        "Resident memory size in bytes",
+        fn=lambda: process_stats()['rss_bytes'],
+    )
+)
+METRIC_OPEN_FDS = METRICS.register(
+    Gauge(
+        'process_open_fds',
+        "Number of open file descriptors",
+        fn=lambda: process_stats()['open_fds'],
+    )
+)
+METRIC_THROUGHPUT = METRICS.register(
+    Gauge(
+        'ydl_download_rate_bytes',
+        "Current total download rate in bytes/s",
+        fn=lambda: BANDWIDTH.throughput(),
+    )
+)
+METRIC_RATE_LIMIT = METRICS.register(
+    Gauge(
+        'ydl_rate_limit_bytes',
+        "Configured total download rate limit in bytes/s (0 for none)",
+        fn=lambda: BANDWIDTH.limit,
+    )
+)
+METRIC_STAGE_SECONDS = METRICS.register(
+    Histogram(
+        'ydl_stage_seconds',
+        "Duration of the stages of processing a job",
+        labelnames=('stage',),
+    )
+)
+METRIC_REQUEST_SECONDS = METRICS.register(
+    Histogram(
+        'ydl_http_request_seconds',
+        "Time until the response to an HTTP request starts",
+        labelnames=('method', 'route'),
+    )
+)
+METRIC_RESULT_BYTES = METRICS.register(
+    Counter('ydl_result_bytes_total', "Bytes of files served from /result")
+)
+METRIC_DOWNLOADED_BYTES = METRICS.register(
+    Counter(
+        'ydl_downloaded_bytes_total',
+        "Bytes downloaded by youtube-dl",
+        labelnames=('extractor',),
+    )
+)
+METRIC_DOWNLOADS = METRICS.register(
+    Counter(
+        'ydl_downloads_total',
+        "Finished downloads",
+        labelnames=('extractor',),
+    )
+)
+METRIC_FAILURES = METRICS.register(
+    Counter(
+        'ydl_failures_total',
+        "Failed jobs",
+        labelnames=('extractor', 'stage'),
+    )
+)
+METRIC_RETRIES = METRICS.register(
+    Counter(
+        'ydl_retries_total',
+        "Retries of failed jobs",
+        labelnames=('error_class',),
+    )
+)
+METRIC_RETRYING = METRICS.register(
+    Gauge(
+        'ydl_jobs_retrying',
+        "Number of jobs waiting for a retry",
+        fn=lambda: len(RETRIES),
+    )
+)
+METRIC_CACHE_HITS = METRICS.register(
+    Counter(
+        'ydl_info_cache_hits_total',
+        "Hits in the info cache",
+        fn=lambda: INFO_CACHE.hits,
+    )
+)
+METRIC_CACHE_MISSES = METRICS.register(
+    Counter(
+        'ydl_info_cache_misses_total',
+        "Misses in the info cache",
+        fn=lambda: INFO_CACHE.misses,
+    )
+)
+
+EXTRACTOR = ThreadPoolExecutor(
+    max_workers=YDL_EXTRACT_WORKERS, thread_name_prefix='extractor'
+)
+# limits the number of jobs submitted to the EXTRACTOR at any time
+EXTRACT_SLOTS = BoundedSemaphore(YDL_EXTRACT_QUEUE)
+POSTPROCESSOR = ThreadPoolExecutor(
+    max_workers=YDL_PP_WORKERS, thread_name_prefix='postprocessor'
+)
+EXPANDER = ThreadPoolExecutor(
+    max_workers=YDL_EXPAND_WORKERS, thread_name_prefix='expander'
+)
+
+MAIN_LOGGER = logging.getLogger('youtubedl-server')
+DL_LOGGER = logging.getLogger('youtubedl')
+
+TEMPLATES = Path(__file__).parent / 'templates'
+
+
+class TemplateCache:
+    """Compiled templates from the `folder`.
+
+    Each template is read and compiled only once. If `reload` is True, a
+    template is re-compiled whenever the mtime of its file changes.
+    """
+
+    def __init__(self, folder, reload=False):
+        self.folder = Path(folder)
+        self.reload = reload
+        self._templates = {}  # name => (mtime, SimpleTemplate)
+        self._lock = Lock()
+
+    def get(self, name):
+        """Return the compiled template for the file `name`."""
+        entry = self._templates.get(name, None)
+        if entry is not None and not self.reload:
+            return entry[1]
+        path = self.folder / name
+        mtime = path.stat().st_mtime_ns
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+        template = bottle.SimpleTemplate(source=path.read_text())
+        template.co  # compile now rather than on the first render
+        with self._lock:
+            self._templates[name] = (mtime, template)
+        return template
+
+    def render(self, name, **kwargs):
+        """Render the template `name` with the given `kwargs`."""
+        return self.get(name).render(**kwargs)
+
+    def clear(self):
+        """Forget all compiled templates."""
+        with self._lock:
+            self._templates.clear()
+
+
+TEMPLATE_CACHE = TemplateCache(TEMPLATES, reload=YDL_RELOAD_TEMPLATES)
+
+
+class LogWriter:
+    """Background thread writing log records for :class:`QueuedHandler`.
+
+    Logging on hot paths (request handling, progress hooks) only puts a
+    record on a queue. A single thread takes records off the queue in
+    batches, and passes them to their target handlers, flushing each target
+    once per batch (see :class:`BatchedFlush`).
+    """
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self._queue = SimpleQueue()
+        self._thread = Thread(target=self._run, name='log_writer', daemon=True)
+        self._thread.start()
+
+    def put(self, target, record):
+        """Pass `record` to the handler `target`, or close `target` after all
+        earlier records if `record` is None."""
+        self._queue.put((target, record))
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            written = set()
+            for (target, record) in batch:
+                if target is None:  # see close()
+                    self._flush(written)
+                    return
+                try:
+                    if record is None:
+                        target.close()
+                        written.discard(target)
+                    else:
+                        target.handle(record)
+                        written.add(target)
+                except Exception:
+                    target.handleError(record)
+            self._flush(written)
+
+    @staticmethod
+    def _flush(targets):
+        for target in targets:
+            if isinstance(target, BatchedFlush):
+                target.flush_batch()
+            else:
+                target.flush()
+
+    def close(self, timeout=5):
+        """Write all queued records, and stop the thread."""
+        self._queue.put((None, None))
+        self._thread.join(timeout)
+
+
+class BatchedFlush:
+    """Mixin for a :class:`logging.StreamHandler` that only flushes its
+    stream in :meth:`flush_batch`, after a batch of records has been
+    written (by the :class:`LogWriter`)."""
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+
+class BatchedFileHandler(BatchedFlush, logging.FileHandler):
+    pass
+
+
+class BatchedStreamHandler(BatchedFlush, logging.StreamHandler):
+    pass
+
+
+class QueuedHandler(logging.handlers.QueueHandler):
+    """Handler passing records on to the handler `target`, via the LOG_WRITER.
+
+    Closing the handler closes the `target` after all records that were
+    passed on before.
+    """
+
+    def __init__(self, target, writer):
+        super().__init__(writer)
+        self.target = target
+        self.setLevel(target.level)
+
+    def prepare(self, record):
+        # Only merge the arguments into the message (which may refer to
+        # mutable objects); all formatting happens in the LOG_WRITER
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        self.queue.put(self.target, record)
+
+    def close(self):
+        self.queue.put(self.target, None)
+        super().close()
+
+
+LOG_WRITER = LogWriter()
+atexit.register(LOG_WRITER.close)
+
+
+def configure_logging(
+    logger, logfile=None, log_to_stdout=True, level=logging.INFO
+):
+    """Set up the given `logger`.
+
+    The `logfile` is only opened when the first message is written to it. All
+    messages are written by the LOG_WRITER.
+    """
+    logger.setLevel(level)
+    formatter = logging.Formatter(
+        "%(asctime)s %(name)s [%(levelname)s]  %(message)s",
+        "%Y-%m-%d %H:%M:%S",
+    )
+    msg = "Set to log at level %r to " % logging.getLevelName(level)
+    if logfile is not None:
+        file_handler = BatchedFileHandler(logfile, delay=True)
+        file_handler.setLevel(logging.DEBUG)
+        file_handler.setFormatter(formatter)
+        logger.addHandler(QueuedHandler(file_handler, LOG_WRITER))
+        msg += str(logfile)
+        if log_to_stdout:
+            msg += " and "
+    if log_to_stdout:
+        stream_handler = BatchedStreamHandler()
+        stream_handler.setLevel(logging.DEBUG)
+        stream_handler.setFormatter(formatter)
+        logger.addHandler(QueuedHandler(stream_handler, LOG_WRITER))
+        msg += "stdout."
+    logger.debug(msg)
+    return logger
+
+
+def log_to_logger(fn, logger):
+    """Bottle pluging that wraps request for logging."""
+
+    @wraps(fn)
+    def _log_to_logger(*args, **kwargs):
+        actual_response = fn(*args, **kwargs)
+        # modify this to log exactly what you need:
+        logger.info(
+            'Request from %s %s %s %s',
+            bottle.request.remote_addr,
+            bottle.request.method,
+            bottle.request.url,
+            bottle.response.status,
+        )
+        return actual_response
+
+    return _log_to_logger
+
+
+def measure_latency(fn, histogram):
+    """Bottle plugin that records the duration of requests in `histogram`.
+
+    For streamed responses, this is the time until the streaming starts.
+    """
+
+    @wraps(fn)
+    def _measure_latency(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            histogram.observe(
+                time.perf_counter() - start,
+                (bottle.request.method, bottle.request.route.rule),
+            )
+
+    return _measure_latency
+
+
+configure_logging(
+    MAIN_LOGGER, logfile=YDL_LOGFILE, log_to_stdout=True, level=YDL_LOGLEVEL
+)
+configure_logging(
+    DL_LOGGER, logfile=YDL_DL_LOGFILE, log_to_stdout=True, level=YDL_LOGLEVEL
+)
+APP = bottle.Bottle()
+APP.install(partial(log_to_logger, logger=MAIN_LOGGER))
+APP.install(partial(measure_latency, histogram=METRIC_REQUEST_SECONDS))
+
+
+class AuthThrottle:
+    """Throttle for failed authorization attempts, per client address.
+
+    After a failed attempt, further failed attempts from the same client are
+    rejected right away for `delay` seconds, doubling with each consecutive
+    failure up to `max_delay`. This makes brute-forcing tokens very difficult
+    without blocking a server thread. A client's failures are forgotten after
+    `max_delay` seconds without further failures.
+
+    Attempts with a correct token are never rejected, so that an attacker
+    cannot lock out other clients (e.g., behind the same address).
+    """
+
+    def __init__(self, delay=1, max_delay=60, maxsize=10000):
+        self.delay = delay
+        self.max_delay = max_delay
+        self.maxsize = maxsize
+        self._failures = {}  # client => (number of failures, blocked until)
+        self._lock = Lock()
+
+    def retry_after(self, client):
+        """Number of seconds for which `client` is blocked (or 0)."""
+        entry = self._failures.get(client, None)
+        if entry is None:
+            return 0
+        return max(entry[1] - time.monotonic(), 0)
+
+    def failure(self, client):
+        """Record a failed attempt from `client`."""
+        now = time.monotonic()
+        with self._lock:
+            n_failures, until = self._failures.get(client, (0, 0))
+            if until + self.max_delay < now:
+                n_failures = 0  # forgotten
+            delay = min(self.delay * 2 ** n_failures, self.max_delay)
+            self._failures[client] = (n_failures + 1, now + delay)
+            if len(self._failures) > self.maxsize:
+                for (key, (_, until)) in list(self._failures.items()):
+                    if until + self.max_delay < now:
+                        del self._failures[key]
+
+
+AUTH_THROTTLE = AuthThrottle()
+
+
+def client_address():
+    """Address of the client of the current request.
+
+    This is the REMOTE_ADDR of the connection, unless that is one of the
+    YDL_TRUSTED_PROXIES: then, it is the last address in the X-Forwarded-For
+    header that is not a trusted proxy.
+    """
+    environ = bottle.request.environ
+    address = environ.get('REMOTE_ADDR', '')
+    if address in YDL_TRUSTED_PROXIES:
+        forwarded = environ.get('HTTP_X_FORWARDED_FOR', '').split(',')
+        for hop in reversed([hop.strip() for hop in forwarded]):
+            if hop and hop not in YDL_TRUSTED_PROXIES:
+                return hop
+    return address
+
+
+def auth_failure():
+    """Record a failed authorization attempt of the current request.
+
+    Abort with status 429 if the client (see :func:`client_address`) is still
+    blocked by earlier failures (see :class:`AuthThrottle`).
+    """
+    client = client_address()
+    retry_after = AUTH_THROTTLE.retry_after(client)
+    AUTH_THROTTLE.failure(client)
+    if retry_after > 0:
+        raise bottle.HTTPError(
+            429,
+            "Too many failed attempts",
+            **{'Retry-After': str(int(retry_after) + 1)},
+        )
+
+
+def is_authorized(username, token):
+    """Check whether the username/token combination is valid.
+
+    Failed attempts throttle further failed attempts from the same client
+    (see :func:`auth_failure`).
+    """
+    if username not in TOKENS or TOKENS[username] != token:
+        auth_failure()
+        return False
+    return True
+
+
+@APP.route('/<username>')
+def dl_form(username):
+    """Route for the root page (form for submitting a video)."""
+    token = bottle.request.params.get("token", None)
+    if not is_authorized(username, token):
+        bottle.abort(401, "Not authorized")
+    content = TEMPLATE_CACHE.render('form.j2', username=username, token=token)
+    return TEMPLATE_CACHE.render(
+        'page.j2', title="youtube-dl", content=content
+    )
+
+
+@APP.route('/<username>/list')
+def list_files(username):
+    """Route for listing downloaded files.
+
+    The HTTP request may contain the parameters `sort` ('name', 'ctime',
+    'mtime', 'size'), `offset` and `limit` for pagination, and `q` to show
+    only files whose name starts with the given string. For
+    `return_json=true`, the listing is returned as JSON.
+    """
+    return_json = bottle.request.params.get("return_json", 'false')
+    token = bottle.request.params.get("token", None)
+    sort = bottle.request.params.get("sort", 'ctime')
+    prefix = bottle.request.params.getunicode("q", '')
+    if not is_authorized(username, token):
+        bottle.abort(401, "Not authorized")
+    try:
+        offset = max(0, int(bottle.request.params.get("offset", 0)))
+        limit = int(bottle.request.params.get("limit", YDL_LIST_PAGE_SIZE))
+        limit = max(1, limit)
+    except ValueError:
+        bottle.abort(400, "Invalid offset or limit")
+    total, files = file_index(username).listing(
+        sort=sort, offset=offset, limit=limit, prefix=prefix
+    )
+    if return_json == 'true':
+        return {
+            "total": total,
+            "offset": offset,
+            "limit": limit,
+            "files": [
+                {
+                    "name": name,
+                    "size": size,
+                    "ctime": ctime,
+                    "mtime": mtime,
+                    "url": "/%s/result/%s" % (username, pathname2url(name)),
+                }
+                for (name, size, ctime, mtime) in files
+            ],
+        }
+    params = {'token': token, 'sort': sort, 'q': prefix, 'limit': limit}
+    prev_url = next_url = None
+    if offset > 0:
+        prev_url = "/%s/list?%s" % (
+            username,
+            urlencode(dict(params, offset=max(0, offset - limit))),
+        )
+    if offset + limit < total:
+        next_url = "/%s/list?%s" % (
+            username,
+            urlencode(dict(params, offset=offset + limit)),
+        )
+    content = TEMPLATE_CACHE.render(
+        'list.j2',
+        username=username,
+        token=token,
+        first=min(offset + 1, total),
+        last=offset + len(files),
+        total=total,
+        files=[
+            (name, "/%s/result/%s" % (username, pathname2url(name)))
+            for (name, size, ctime, mtime) in files
+        ],
+        prev_url=prev_url,
+        next_url=next_url,
+    )
+    return TEMPLATE_CACHE.render(
+        'page.j2', title="youtube-dl", content=content
+    )
+
+
+@APP.route('/static/:filename#.*#')
+def server_static(filename):
+    """Route static resources, e.g. CSS files."""
+    return bottle.static_file(filename, root='./static')
+
+
+@APP.route('/<username>/submit', method='POST')
+def submit(username):
+    """Route for submitting a request to download a video."""
+    return_json = bottle.request.params.get("return_json", 'true')
+    token = bottle.request.params.get("token", None)
+    if not is_authorized(username, token):
+        if return_json == 'true':
+            return {
+                "success": False,
+                "error": "not authorized",
+            }
+        else:
+            bottle.abort(401, "Not authorized")
+    url = bottle.request.params.get("url")
+    if not url:
+        if return_json == 'true':
+            return {
+                "success": False,
+                "error": "missing 'url' query param",
+            }
+        else:
+            bottle.abort(400, "missing 'url' query param")
+    preset = bottle.request.params.get("preset", YDL_DEFAULT_PRESET)
+    priority = bottle.request.params.get("priority", 'normal')
+    if priority not in PRIORITIES:
+        if return_json == 'true':
+            return {
+                "success": False,
+                "error": "invalid 'priority' query param",
+            }
+        else:
+            bottle.abort(400, "invalid 'priority' query param")
+    result = submit_download(username, url, preset, priority=priority)
+
+    if return_json == 'true':
+        return result
+    else:
+        if result['success']:
+            # Redirect to the job status, which in turn redirects to the
+            # resulting file once it is known (https://httpstatuses.com/303)
+            bottle.redirect(
+                "/%s/job/%s?return_json=false" % (username, result['job']),
+                code=303,
+            )
+        else:
+            return result
+
+
+@APP.route('/<username>/batch', method='POST')
+def batch_submit(username):
+    """Route for submitting a batch of urls, including playlists.
+
+    The urls are given either as a JSON body ``{"urls": [...], "preset":
+    ..., "token": ...}``, or as form parameters: any number of `url`
+    parameters, and/or a `urls` parameter with one url per line.
+
+    Returns (as JSON) the id of the batch, whose aggregate progress is
+    available from the "batch status" route.
+    """
+    try:
+        data = bottle.request.json or {}
+    except bottle.HTTPError:
+        data = None
+    if not isinstance(data, dict):
+        bottle.response.status = 400
+        return {"success": False, "error": "invalid JSON body"}
+    params = bottle.request.params
+    token = data.get("token", params.get("token", None))
+    if not is_authorized(username, token):
+        return {"success": False, "error": "not authorized"}
+    if "urls" in data:
+        urls = data["urls"]
+        if not (
+            isinstance(urls, list) and all(isinstance(u, str) for u in urls)
+        ):
+            bottle.response.status = 400
+            return {"success": False, "error": "'urls' must be a list of urls"}
+    else:
+        urls = params.getall("url") + params.get("urls", "").split()
+    urls = [url.strip() for url in urls if url.strip()]
+    if not urls:
+        return {"success": False, "error": "missing 'urls' query param"}
+    preset = data.get("preset", params.get("preset", YDL_DEFAULT_PRESET))
+    if not isinstance(preset, str):
+        bottle.response.status = 400
+        return {"success": False, "error": "invalid 'preset' query param"}
+    priority = data.get("priority", params.get("priority", 'normal'))
+    if priority not in PRIORITIES:
+        return {"success": False, "error": "invalid 'priority' query param"}
+    batch = submit_batch(username, urls, preset, priority=priority)
+    if batch is None:
+        return {"success": False, "error": "server is shutting down"}
+    return {
+        "success": True,
+        "batch": batch.id,
+        "urls": len(urls),
+        "preset": preset,
+        "priority": priority,
+    }
+
+
+@APP.route('/<username>/batch/<batch_id>')
+def batch_status(username, batch_id):
+    """Route for the aggregate progress of a batch, as JSON.
+
+    Like for the "job" route, no authentication token is used. With
+    ``jobs=true``, the status of every job in the batch is included.
+    """
+    batch = BATCHES.get(batch_id)
+    if batch is None or batch.username != username:
+        bottle.abort(404, "No batch %s" % batch_id)
+    with_jobs = bottle.request.params.get("jobs", 'false') == 'true'
+    return batch.as_dict(with_jobs=with_jobs)
+
+
+@APP.route('/<username>/job/<job_id>')
+def job_status(username, job_id):
+    """Route for querying the status of a submitted job.
+
+    Like for the "result" route, no authentication token is used: the job id
+    is sufficiently hard to guess.
+
+    If the HTTP request has a `wait` parameter, wait up to that many seconds
+    (but no more than 30) for the `outfile` of the job to be resolved.
+
+    For `return_json=false`, redirect to the "result" route for the job
+    as soon as the `outfile` is known, and otherwise render an HTML page that
+    reloads periodically.
+    """
+    return_json = bottle.request.params.get("return_json", 'true')
+    job = JOBS.get(job_id)
+    if job is None or job.username != username:
+        bottle.abort(404, "No job %s" % job_id)
+    try:
+        wait = min(float(bottle.request.params.get("wait", 0)), 30)
+    except ValueError:
+        wait = 0
+    if wait > 0:
+        job.resolved.wait(wait)
+    if return_json == 'true':
+        return job.as_dict()
+    if job.outfile is not None:
+        bottle.redirect(
+            "/%s/result/%s?%s"
+            % (
+                username,
+                pathname2url(job.outfile),
+                urlencode(
+                    {'url': job.url, 'download': 'false', 'job': job.id}
+                ),
+            ),
+            code=303,
+        )
+    if job.state != 'failed':
+        bottle.response.set_header('Refresh', '2')
+    content = TEMPLATE_CACHE.render(
+        'job.j2', state=job.state, url=job.url, error=job.error or ''
+    )
+    return TEMPLATE_CACHE.render(
+        'page.j2', title="youtube-dl", content=content
+    )
+
+
+@APP.route('/<username>/jobs')
+def list_jobs(username):
+    """Route for the status of all recent jobs of a user, as JSON."""
+    token = bottle.request.params.get("token", None)
+    if not is_authorized(username, token):
+        bottle.abort(401, "Not authorized")
+    return {"jobs": [job.as_dict() for job in JOBS.jobs_for(username)]}
+
+
+@APP.route('/<username>/failed')
+def list_failed(username):
+    """Route for the "dead-letter list" of failed jobs of a user, as JSON."""
+    token = bottle.request.params.get("token", None)
+    if not is_authorized(username, token):
+        bottle.abort(401, "Not authorized")
+    return {"jobs": [job.as_dict() for job in JOBS.failed(username)]}
+
+
+@APP.route('/<username>/job/<job_id>/requeue', method='POST')
+def requeue(username, job_id):
+    """Route for requeueing a failed job."""
+    token = bottle.request.params.get("token", None)
+    if not is_authorized(username, token):
+        return {"success": False, "error": "not authorized"}
+    job = JOBS.get(job_id)
+    if job is None or job.username != username:
+        bottle.abort(404, "No job %s" % job_id)
+    error = requeue_job(job)
+    return {"success": error is None, "job": job.id, "error": error}
+
+
+@APP.route('/<username>/failed/requeue', method='POST')
+def requeue_failed(username):
+    """Route for requeueing all failed jobs of a user.
+
+    With an `error_class` parameter, only the jobs that failed with an error
+    of that class (see :func:`classify_error`) are requeued.
+    """
+    token = bottle.request.params.get("token", None)
+    if not is_authorized(username, token):
+        return {"success": False, "error": "not authorized"}
+    error_class = bottle.request.params.get("error_class", None)
+    requeued = []
+    errors = []
+    for job in JOBS.failed(username):
+        if error_class is not None and job.error_class != error_class:
+            continue
+        error = requeue_job(job)
+        if error is None:
+            requeued.append(job.id)
+        else:
+            errors.append({"job": job.id, "error": error})
+    return {"success": not errors, "requeued": requeued, "errors": errors}
+
+
+@APP.route('/<username>/pin', method='POST')
+def pin_file(username):
+    """Route for pinning a downloaded `file`, so that it is never removed by
+    the retention policy (see :class:`Retention`).
+
+    With a `pinned` parameter 'false', the file is unpinned instead.
+    """
+    token = bottle.request.params.get("token", None)
+    if not is_authorized(username, token):
+        return {"success": False, "error": "not authorized"}
+    filename = Path(bottle.request.params.get("file", "")).name
+    if not filename or not (Path(OUTDIRS[username]) / filename).is_file():
+        bottle.abort(404, "No file %s" % filename)
+    pinned = bottle.request.params.get("pinned", 'true') == 'true'
+    RETENTION.pin(username, filename, pinned)
+    return {"success": True, "file": filename, "pinned": pinned}
+
+
+EVENT_SLOTS = BoundedSemaphore(max(1, YDL_MAX_EVENT_STREAMS))
+
+
+def job_events(get_jobs, release, until_done=False, keepalive=15):
+    """Generate Server-Sent Events for the jobs returned by `get_jobs()`.
+
+    Each time the status of one of the jobs changes, a "job" event with the
+    JSON-data of that job is sent. If `until_done`, the stream ends when all
+    jobs have reached a final state. Comments are sent at least every
+    `keepalive` seconds, to keep the connection open. The stream starts with
+    a comment, so that the headers are sent right away. The function
+    `release` is called at the end.
+    """
+    sent = {}  # job id => last data sent
+    last_sent = time.monotonic()
+    try:
+        yield ": connected\n\n"
+        while not STOPPING.is_set():
+            version = JOBS.version
+            jobs = get_jobs()
+            done = all(job.done.is_set() for job in jobs)
+            for job in jobs:
+                data = json.dumps(job.as_dict())
+                if sent.get(job.id, None) != data:
+                    sent[job.id] = data
+                    last_sent = time.monotonic()
+                    yield "event: job\ndata: %s\n\n" % data
+            if until_done and done:
+                return
+            if time.monotonic() - last_sent >= keepalive:
+                last_sent = time.monotonic()
+                yield ": keepalive\n\n"
+            JOBS.wait(version, timeout=keepalive)
+    finally:
+        release()
+
+
+def _start_event_stream():
+    """Reserve one of the YDL_MAX_EVENT_STREAMS slots for a stream of events.
+
+    Abort with 503 if all slots are taken, so that event streams cannot
+    occupy all threads of the server. Otherwise, set the headers of the
+    response. The slot must be released with ``EVENT_SLOTS.release()``.
+    """
+    if not EVENT_SLOTS.acquire(blocking=False):
+        bottle.abort(503, "Too many event streams")
+    bottle.response.content_type = 'text/event-stream'
+    bottle.response.set_header('Cache-Control', 'no-cache')
+    bottle.response.set_header('X-Accel-Buffering', 'no')  # for nginx
+
+
+@APP.route('/<username>/job/<job_id>/events')
+def job_status_events(username, job_id):
+    """Route for a stream of Server-Sent Events for the status of a job.
+
+    Like for the "job" route, no authentication token is used.
+    """
+    job = JOBS.get(job_id)
+    if job is None or job.username != username:
+        bottle.abort(404, "No job %s" % job_id)
+    _start_event_stream()
+    return job_events(
+        lambda: [job], release=EVENT_SLOTS.release, until_done=True
+    )
+
+
+@APP.route('/<username>/events')
+def user_events(username):
+    """Route for a stream of Server-Sent Events for all jobs of a user."""
+    token = bottle.request.params.get("token", None)
+    if not is_authorized(username, token):
+        bottle.abort(401, "Not authorized")
+    _start_event_stream()
+    return job_events(
+        partial(JOBS.jobs_for, username), release=EVENT_SLOTS.release
+    )
+
+
+class FileRange:
+    """Read-only file-like object for `length` bytes of the file at `path`,
+    starting at `offset`."""
+
+    def __init__(self, path, offset, length):
+        self.file = open(str(path), 'rb')
+        self.file.seek(offset)
+        self.offset = offset
+        self.length = length
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        METRIC_RESULT_BYTES.inc(len(data))
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def serve_file(path, mimetype=True):
+    """Return the file at `path` as the response to the current request.
+
+    Unlike :func:`bottle.static_file`, this supports conditional requests
+    via ETag (If-None-Match, If-Range), single byte ranges, and delegating the
+    transfer to a fronting web server (YDL_SENDFILE_MODE). If `mimetype` is
+    True, it is guessed from the file name. The Content-Length and the ETag
+    always derive from a fresh :func:`os.stat` of the file, so that they
+    match a file that was replaced under the same name.
+
+    The body of the response is a :class:`FileRange`, which a
+    :class:`SendfileRequestHandler` transmits with :func:`os.sendfile`.
+    """
+    if mimetype is True:
+        mimetype = mimetypes.guess_type(str(path))[0]
+    headers = bottle.response.headers
+    headers['Content-Type'] = mimetype or 'application/octet-stream'
+    if YDL_SENDFILE_MODE == 'x-accel-redirect':
+        username = bottle.request.url_args.get('username', '')
+        headers['X-Accel-Redirect'] = quote(
+            YDL_ACCEL_REDIRECT_PREFIX + username + '/' + Path(path).name
+        )
+        return ''
+    elif YDL_SENDFILE_MODE == 'x-sendfile':
+        headers['X-Sendfile'] = str(Path(path).resolve())
+        return ''
+    try:
+        st = os.stat(str(path))
+    except OSError:
+        bottle.abort(404, "No file %s" % Path(path).name)
+    size, mtime = st.st_size, st.st_mtime
+    etag = '"%x-%x"' % (int(mtime * 1e6), size)
+    headers['ETag'] = etag
+    headers['Last-Modified'] = bottle.http_date(mtime)
+    headers['Accept-Ranges'] = 'bytes'
+    if_none_match = bottle.request.environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        etags = [tag.strip() for tag in if_none_match.split(',')]
+        if etag in etags or '*' in etags:
+            return bottle.HTTPResponse(status=304, **headers)
+    else:
+        ims = bottle.request.environ.get('HTTP_IF_MODIFIED_SINCE')
+        if ims is not None:
+            ims = bottle.parse_date(ims.split(";")[0].strip())
+            if ims is not None and ims >= int(mtime):
+                return bottle.HTTPResponse(status=304, **headers)
+    offset, length = 0, size
+    range_header = bottle.request.environ.get('HTTP_RANGE')
+    if_range = bottle.request.environ.get('HTTP_IF_RANGE', etag)
+    if range_header and if_range == etag:
+        ranges = list(bottle.parse_range_header(range_header, size))
+        if not ranges:
+            headers['Content-Range'] = 'bytes */%d' % size
+            return bottle.HTTPResponse(status=416, **headers)
+        offset, end = ranges[0]  # multiple ranges are not supported
+        length = end - offset
+        bottle.response.status = 206
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (offset, end - 1, size)
+    headers['Content-Length'] = str(length)
+    try:
+        return FileRange(path, offset, length)
+    except OSError:
+        bottle.abort(404, "No file %s" % Path(path).name)
+
+
+class SendfileServerHandler(ServerHandler):
+    """WSGI server handler that sends a :class:`FileRange` response with
+    :func:`os.sendfile` (via :meth:`socket.socket.sendfile`)."""
+
+    def sendfile(self):
+        filelike = self.result.filelike
+        if not isinstance(filelike, FileRange):
+            return False
+        if not self.headers_sent:
+            self.send_headers()
+        sent = self.request_handler.connection.sendfile(
+            filelike.file, filelike.offset, filelike.length
+        )
+        self.bytes_sent += sent
+        METRIC_RESULT_BYTES.inc(sent)
+        return True
+
+
+class SendfileRequestHandler(WSGIRequestHandler):
+    """Request handler for :class:`bottle.WSGIRefServer` that uses the
+    :class:`SendfileServerHandler`."""
+
+    def address_string(self):  # no reverse DNS lookups
+        return self.client_address[0]
+
+    def log_request(self, *args, **kwargs):
+        pass  # requests are logged by the log_to_logger plugin
+
+    def handle(self):
+        """Handle a single HTTP request"""
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+        if not self.parse_request():  # An error code has been sent
+            return
+        handler = SendfileServerHandler(
+            self.rfile,
+            self.wfile,
+            self.get_stderr(),
+            self.get_environ(),
+            multithread=isinstance(self.server, ThreadPoolWSGIServer),
+        )
+        handler.request_handler = self  # backpointer for logging
+        handler.run(self.server.get_app())
+
+
+class ThreadPoolWSGIServer(WSGIServer):
+    """WSGI server handling requests in a pool of `pool_size` threads."""
+
+    pool_size = YDL_SERVER_THREADS
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pool = ThreadPoolExecutor(
+            max_workers=self.pool_size, thread_name_prefix='http'
+        )
+
+    def process_request(self, request, client_address):
+        self._pool.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        """Close the socket, and wait for the requests in progress.
+
+        Long-running responses (event streams, streamed files) end when the
+        server is STOPPING, so this is set first.
+        """
+        super().server_close()
+        STOPPING.set()
+        JOBS.notify()
+        self._pool.shutdown(wait=True)
+
+
+def make_server_adapter():
+    """Return the bottle server adapter for YDL_SERVER_BACKEND."""
+    if YDL_SERVER_BACKEND in ('threaded', 'wsgiref'):
+        server_class = WSGIServer
+        if YDL_SERVER_BACKEND == 'threaded':
+            server_class = ThreadPoolWSGIServer
+        return bottle.WSGIRefServer(
+            host=YDL_SERVER_HOST,
+            port=YDL_SERVER_PORT,
+            handler_class=SendfileRequestHandler,
+            server_class=server_class,
+        )
+    try:
+        adapter = bottle.server_names[YDL_SERVER_BACKEND]
+    except KeyError:
+        raise ValueError(
+            "Invalid YDL_SERVER_BACKEND %r" % YDL_SERVER_BACKEND
+        ) from None
+    return adapter(host=YDL_SERVER_HOST, port=YDL_SERVER_PORT)
+
+
+def stop_server(server):
+    """Make the running `server` adapter return from its `run` method."""
+    srv = getattr(server, 'srv', None)
+    if srv is not None:  # WSGIRefServer
+        Thread(target=srv.shutdown, name='stop_server').start()
+    else:
+        raise KeyboardInterrupt  # handled by bottle.run
+
+
+@APP.route('/<username>/result/:filename#.*#')
+def result_file(username, filename):
+    """Route for obtaining a downloaded file.
+
+    Depending on a `download` parameter in the HTTP request ('true'/'false'),
+    either try to download the file directly, or render an HTML page containing
+    a direct link to the file. The latter may be preferable because then a use
+    can right-click on the link and choose what do do with it.
+
+    No authentication token is used. This is so that a "result" link can be
+    shared publicly without exposing the token.
+
+    With a `stream` parameter 'true', a file that is still being downloaded
+    is streamed while the download progresses (see :func:`stream_file`).
+    """
+    try:
+        filename = Path(filename).name  # protect against escaping from OUTDIR
+        logfile = (Path(OUTDIRS[username]) / filename).with_suffix('.log')
+        download = bottle.request.params.get("download", 'true')
+        exists = (Path(OUTDIRS[username]) / filename).is_file()
+    except (OSError, KeyError):
+        # protect against e.g. too long filenames
+        bottle.abort(404, "Invalid filename")
+
+    if download == 'true':
+        if exists:
+            try:
+                RETENTION.touch(username, filename)
+            except sqlite3.Error as exc_info:
+                MAIN_LOGGER.error("Cannot record access: %r", exc_info)
+            return serve_file(
+                Path(OUTDIRS[username]) / filename,
+                mimetype=MIMETYPES.get(Path(filename).suffix, True),
+            )
+        elif bottle.request.params.get("stream", 'false') == 'true':
+            return stream_file(username, filename)
+        else:
+            bottle.abort(404, "No file %s" % filename)
+    url = bottle.request.params.get("url", None)
+    job_id = bottle.request.params.get("job", None)
+    content = TEMPLATE_CACHE.render(
+        'result.j2',
+        username=username,
+        job_id=job_id,
+        url=url,
+        exists=exists,
+        filename=filename,
+        filename_enc=pathname2url(filename),
+        has_logfile=(not exists) and logfile.is_file(),
+        logfile_enc=pathname2url(logfile.name),
+        params=urlencode(
+            [
+                (key, val)
+                for (key, val) in [
+                    ('download', 'false'),
+                    ('url', url),
+                    ('job', job_id),
+                ]
+                if val
+            ]
+        ),
+    )
+    return TEMPLATE_CACHE.render('page.j2', title=filename, content=content)
+
+
+STREAM_SLOTS = BoundedSemaphore(max(1, YDL_MAX_STREAMS))
+
+
+def stream_file(username, filename):
+    """Stream the file `filename` of `username` while it is downloaded.
+
+    This requires an unfinished job for the file whose preset has no
+    postprocessing (so that the downloaded file is the final file). The
+    response has no Content-Length, and follows the download (see
+    :func:`follow_download`) until the file is complete. At most
+    YDL_MAX_STREAMS files are streamed at the same time.
+    """
+    for job in JOBS.jobs_for(username):
+        if job.outfile == filename and not job.done.is_set():
+            break
+    else:
+        bottle.abort(404, "No file %s" % filename)
+    if job.postprocessing:
+        bottle.abort(404, "File %s is not available for streaming" % filename)
+    if not STREAM_SLOTS.acquire(blocking=False):
+        bottle.abort(503, "Too many streams")
+    path = Path(OUTDIRS[username]) / filename
+    bottle.response.content_type = (
+        MIMETYPES.get(path.suffix, None)
+        or mimetypes.guess_type(filename)[0]
+        or 'application/octet-stream'
+    )
+    bottle.response.set_header('Cache-Control', 'no-store')
+    return follow_download(job, path, release=STREAM_SLOTS.release)
+
+
+def follow_download(job, path, release, chunk_size=262144, poll=0.5):
+    """Yield the content of the file `path` while `job` downloads it.
+
+    Reading starts with the ".part" file of the download, waiting for more
+    data whenever it reaches the end. Since youtube-dl renames the ".part"
+    file to `path` when the download is complete, the open file then
+    continues as the finished file, and the generator returns at its end.
+    If the ".part" file is replaced (e.g. by a retry), reading continues in
+    the new file at the same offset. The generator also returns if the job
+    fails, or when the server stops. The function `release` is called at
+    the end.
+    """
+    part = Path(str(path) + '.part')
+    fh = None
+    offset = 0
+    complete = False  # whether `fh` is the finished file
+
+    def stat(file):
+        try:
+            return os.stat(str(file))
+        except OSError:
+            return None
+
+    try:
+        while not STOPPING.is_set():
+            data = fh.read(chunk_size) if fh is not None else b''
+            if data:
+                offset += len(data)
+                yield data
+                continue
+            if complete:
+                return
+            final = stat(path)
+            if final is not None and (job.done.is_set() or fh is not None):
+                if fh is None or not os.path.samestat(
+                    os.fstat(fh.fileno()), final
+                ):
+                    if fh is not None:
+                        fh.close()
+                    fh = open(str(path), 'rb')
+                    fh.seek(offset)
+                complete = True
+                continue
+            if job.done.is_set():
+                return  # failed
+            current = stat(part)
+            if current is not None and (
+                fh is None
+                or not os.path.samestat(os.fstat(fh.fileno()), current)
+            ):
+                try:
+                    new_fh = open(str(part), 'rb')
+                except FileNotFoundError:  # renamed in the meantime
+                    continue
+                if fh is not None:
+                    fh.close()
+                fh = new_fh
+                fh.seek(offset)
+                continue
+            time.sleep(poll)
+    except OSError as exc_info:
+        DL_LOGGER.error("Cannot stream %r: %r", str(path), exc_info)
+    finally:
+        if fh is not None:
+            fh.close()
+        release()
+
+
+def youtube_dl_show_progress(d, logger):
+    """Log download progress in :class:`YoutubeDL` instance.
+
+    After `logger` is set via :func:`functools.partial`, the resulting function
+    is used as a "progress_hook" for :class:`YoutubeDL`.
+    """
+    if d['status'] == 'error':
+        logger.error("Failed to download %r", d['filename'])
+    elif d['status'] == 'finished':
+        logger.info("Finished downloading %r", d['filename'])
+    elif d['status'] == 'downloading':
+        total_bytes = d.get('total_bytes') or d.get('total_bytes_estimate')
+        downloaded_MB = "%.1f" % (float(d['downloaded_bytes']) / 1048576.0)
+        try:
+            total_MB = "%.1f" % (float(total_bytes) / 1048576.0)
+            percent = "%d" % (
+                100 * float(d['downloaded_bytes']) / float(total_bytes)
+            )
+        except (TypeError, ZeroDivisionError):
+            total_MB = '???'
+            percent = '???'
+        try:
+            speed = "%.2f" % (float(d['speed']) / 1048576.0)
+        except (KeyError, TypeError):
+            speed = '???'
+        logger.info(
+            "Downloaded %s/%s MB (%s%%, %s MB/s)",
+            downloaded_MB,
+            total_MB,
+            percent,
+            speed,
+        )
+
+
+class ProgressReporter:
+    """Progress hook for :class:`YoutubeDL` publishing the progress of a
+    `job`.
+
+    The progress attributes of the `job` are updated on every call, but the
+    JOBS registry is notified, and the progress is logged to `logger` (via
+    :func:`youtube_dl_show_progress`) at most once every `interval`
+    seconds while downloading.
+    """
+
+    __slots__ = (
+        'job',
+        'logger',
+        'interval',
+        'postprocessing',
+        '_last',
+        '_counted_bytes',
+    )
+
+    def __init__(self, job, logger, interval=1, postprocessing=False):
+        self.job = job
+        self.logger = logger
+        self.interval = interval
+        self.postprocessing = postprocessing  # whether there is a PP phase
+        self._last = 0
+        self._counted_bytes = 0  # for METRIC_DOWNLOADED_BYTES
+
+    def _count_bytes(self, downloaded_bytes):
+        if downloaded_bytes:
+            METRIC_DOWNLOADED_BYTES.inc(
+                downloaded_bytes - self._counted_bytes, (self.job.extractor,)
+            )
+            self._counted_bytes = downloaded_bytes
+
+    def __call__(self, d):
+        job = self.job
+        status = d['status']
+        if status == 'downloading':
+            job.phase = 'downloading'
+            job.downloaded_bytes = d.get('downloaded_bytes')
+            job.total_bytes = d.get('total_bytes') or d.get(
+                'total_bytes_estimate'
+            )
+            job.speed = d.get('speed')
+            job.eta = d.get('eta')
+            now = time.monotonic()
+            if now - self._last < self.interval:
+                return
+            self._last = now
+            self._count_bytes(job.downloaded_bytes)
+            BANDWIDTH.rebalance()
+        elif status == 'finished':
+            job.downloaded_bytes = job.total_bytes = d.get('total_bytes')
+            job.speed = job.eta = None
+            self._count_bytes(job.downloaded_bytes)
+            self._counted_bytes = 0  # next format in a merged download
+            if self.postprocessing:
+                job.phase = 'postprocessing'
+        youtube_dl_show_progress(d, self.logger)
+        JOBS.notify()
+
+
+def youtube_dl_check_cancelled(d):
+    """Abort a running download if the server is shutting down.
+
+    Used as a "progress_hook" for :class:`YoutubeDL`.
+    """
+    if SHUTDOWN.is_set():
+        raise JobCancelled("Server is shutting down")
+
+
+def submit_download(username, url, preset, priority='normal', block=False):
+    """Send `url` to the extraction-threads for downloading with `preset`.
+
+    Downloads with `priority` 'low' are held in the queue until the
+    YDL_OFFPEAK window.
+
+    Returns a dict with the following values:
+
+    * `success`: whether the request was accepted. It is rejected if too many
+      submitted urls are still waiting for extraction (unless `block` is
+      True, in which case the call waits until the url can be accepted), or
+      if the server is shutting down.
+    * `job`: the id of the job created for the request, if `success`
+    * `url`: the input `url`
+    * `preset`: the input `preset`
+    * `format`: the youtube-dl format code associated with the `preset`
+    * `outfile`: the predicted name of the output file (inside the user's
+      OUTDIR), or None if it cannot be predicted. The actual `outfile` is
+      available via the job status once the video information has been
+      extracted.
+
+    The extraction of the video information happens in the EXTRACTOR pool
+    (see :func:`extract_job`), which then places the job on the DL_Q.
+    """
+    job = Job(username, url, preset, priority=priority)
+    result = {
+        "success": False,
+        "job": None,
+        "url": url,
+        "preset": preset,
+        "format": job.format,
+        "outfile": predict_outfile(username, url, preset),
+    }
+    if not _acquire_extract_slot(block):
+        if STOPPING.is_set():
+            result['error'] = "server is shutting down"
+            return result
+        MAIN_LOGGER.error(
+            "Could not add url %r to the download queue: too many pending "
+            "submissions",
+            url,
+        )
+        result['error'] = "too many pending submissions"
+        return result
+    JOBS.add(job)
+    if not _submit_to_extractor(job):
+        result['error'] = "server is shutting down"
+        return result
+    result['success'] = True
+    result['job'] = job.id
+    return result
+
+
+def submit_batch(username, urls, preset, priority='normal'):
+    """Create a :class:`Batch` for downloading all `urls` with `preset` (and
+    `priority`, see :func:`submit_download`).
+
+    The urls are expanded asynchronously in the EXPANDER pool, see
+    :func:`expand_batch`. Returns the batch, or None if the server is
+    shutting down.
+    """
+    batch = Batch(username, urls, preset, priority=priority)
+    try:
+        EXPANDER.submit(expand_batch, batch)
+    except RuntimeError:  # EXPANDER has been shut down
+        return None
+    BATCHES.add(batch)
+    return batch
+
+
+def playlist_entries(ie_result, page_size=50):
+    """Iterate over the entries of a playlist, as tuples (url, reference).
+
+    The `ie_result` is the unprocessed result of
+    :meth:`youtube_dl.YoutubeDL.extract_info` (with ``process=False``). Its
+    "entries" may be a list, a generator, or a
+    :class:`youtube_dl.utils.PagedList`. The latter two are consumed lazily
+    (`page_size` entries at a time for a paged list), so that the first
+    entries of a long playlist are available before the remaining pages
+    have been requested. An entry is a `reference` if it only refers to its
+    url (which may be another playlist) instead of describing a video.
+    """
+    entries = ie_result.get('entries') or []
+    if isinstance(entries, youtube_dl.utils.PagedList):
+        entries = _paged_entries(entries, page_size)
+    for entry in entries:
+        if not entry:
+            continue
+        url = entry.get('webpage_url') or entry.get('url')
+        if url:
+            reference = entry.get('_type') in ('url', 'url_transparent')
+            yield url, reference
+
+
+def _paged_entries(paged_list, page_size):
+    start = 0
+    while True:
+        page = paged_list.getslice(start, start + page_size)
+        if not page:
+            return
+        yield from page
+        start += len(page)
+
+
+def batch_entries(ydl, batch, url, depth=3):
+    """Iterate over the urls of the videos that `url` refers to, for `batch`.
+
+    The url is looked up without processing. For a playlist, this only
+    yields a "flat" list of its entries (see :func:`playlist_entries`).
+    Entries that refer to another url, which may be a playlist itself, are
+    looked up in the same way as they are reached, up to `depth` levels
+    deep; those that fail are recorded as errors of `batch`. For a single
+    video, the processed video information is placed in the INFO_CACHE, to
+    avoid a second lookup by :func:`extract_job`.
+    """
+    ie_result = ydl.extract_info(url, download=False, process=False)
+    kind = ie_result.get('_type', 'video')
+    if kind in ('url', 'url_transparent') and depth > 0:
+        yield from batch_entries(ydl, batch, ie_result['url'], depth - 1)
+        return
+    if kind not in ('playlist', 'multi_video'):
+        if kind == 'video':
+            INFO_CACHE.put(
+                url,
+                batch.preset,
+                ydl.process_ie_result(ie_result, download=False),
+            )
+        yield url
+        return
+    for entry_url, reference in playlist_entries(ie_result):
+        if not reference or depth <= 0:
+            yield entry_url
+            continue
+        try:
+            yield from batch_entries(ydl, batch, entry_url, depth - 1)
+        except Exception as exc_info:
+            MAIN_LOGGER.error("Exception: %r", exc_info)
+            MAIN_LOGGER.error("Could not expand url %r", entry_url)
+            batch.add_error(entry_url, str(exc_info))
+
+
+def expand_batch(batch):
+    """Submit a job for every video in the urls of `batch`.
+
+    This runs in the EXPANDER pool. The urls are expanded lazily (see
+    :func:`batch_entries`), and a job is submitted for each video as it is
+    discovered. Submission blocks while the EXTRACTOR is at capacity, so
+    that a large playlist is fed into the queue at the rate at which it can
+    be processed.
+    """
+    ydl_params = {
+        'format': FORMATS.get(batch.preset, FORMATS[YDL_DEFAULT_PRESET]),
+        'extract_flat': 'in_playlist',
+        'quiet': True,
+        'no_warnings': True,
+    }
+    n_jobs = 0
+    try:
+        with youtube_dl.YoutubeDL(ydl_params) as ydl:
+            for url in batch.urls:
+                if STOPPING.is_set():
+                    batch.add_error(url, "server is shutting down")
+                    continue
+                if n_jobs >= YDL_BATCH_MAX:
+                    batch.add_error(url, "too many jobs in batch")
+                    continue
+                try:
+                    for entry_url in batch_entries(ydl, batch, url):
+                        if n_jobs >= YDL_BATCH_MAX:
+                            batch.add_error(url, "too many jobs in batch")
+                            break
+                        result = submit_download(
+                            batch.username,
+                            entry_url,
+                            batch.preset,
+                            priority=batch.priority,
+                            block=True,
+                        )
+                        if not result['success']:
+                            batch.add_error(entry_url, result['error'])
+                            if STOPPING.is_set():
+                                break
+                            continue
+                        batch.add(JOBS.get(result['job']))
+                        n_jobs += 1
+                except Exception as exc_info:
+                    MAIN_LOGGER.error("Exception: %r", exc_info)
+                    MAIN_LOGGER.error("Could not expand url %r", url)
+                    batch.add_error(url, str(exc_info))
+        MAIN_LOGGER.info(
+            "Submitted %d jobs for batch %s (%s)",
+            n_jobs,
+            batch.id,
+            batch.username,
+        )
+    finally:
+        batch.expanding = False
+        JOBS.notify()
+
+
+def predict_outfile(username, url, preset):
+    """Predict the name of the output file for downloading `url`.
+
+    The prediction is based on earlier requests for the same `url` and
+    `preset`. Returns None if no prediction is possible.
+    """
+    outfile = JOBS.predict_outfile(username, url, preset)
+    if outfile is None:
+        info = INFO_CACHE.peek(url, preset)
+        if info is not None:
+            outfile = outfile_for_info(info, preset)
+    return outfile
+
+
+def outfile_for_info(info, preset):
+    """Name of the output file for the video described by `info`."""
+    ext = EXTENSIONS.get(preset, 'mp4')
+    return (
+        SanitizedFilenameTmpl(YDL_OUTPUT_TEMPLATE).format(**info) + "." + ext
+    )
+
+
+def _acquire_extract_slot(block=False):
+    """Acquire one of the EXTRACT_SLOTS, and return whether this succeeded.
+
+    If `block` is True, wait until a slot becomes available, unless the
+    server is stopping.
+    """
+    acquired = EXTRACT_SLOTS.acquire(blocking=False)
+    while block and not acquired and not STOPPING.is_set():
+        acquired = EXTRACT_SLOTS.acquire(timeout=1)
+    return acquired
+
+
+def _submit_to_extractor(job):
+    """Hand `job` to the EXTRACTOR, after one of the EXTRACT_SLOTS has been
+    acquired.
+
+    Returns whether the job was accepted. If not (because the server is
+    shutting down), the job remains 'pending', to be resumed after a restart.
+    """
+    try:
+        EXTRACTOR.submit(extract_job, job)
+    except RuntimeError:  # EXTRACTOR has been shut down
+        EXTRACT_SLOTS.release()
+        return False
+    return True
+
+
+def resume_jobs():
+    """Re-submit all unfinished jobs from the JobStore.
+
+    All such jobs go through the extraction again, as the download urls in
+    any earlier video information may have expired. The exception are jobs
+    that a worker process still holds a lease on (with YDL_QUEUE 'shared'):
+    these are only tracked until the worker completes them. Jobs that are
+    'retrying' are scheduled for their retry again. All jobs keep their
+    number of `attempts`.
+    """
+    for record in JOBS.store.unfinished():
+        if (
+            WORKER_QUEUE is not None
+            and record['worker']
+            and (record['lease_until'] or 0) > time.time()
+        ):
+            JOBS.add(Job.from_record(record), persist=False)
+            continue
+        if record['state'] == 'retrying' and record['username'] in OUTDIRS:
+            job = Job.from_record(record)
+            if job.retry_at is None:
+                job.retry_at = time.time()
+            MAIN_LOGGER.info(
+                "Resuming retry %d of url %r", job.attempts, job.url
+            )
+            JOBS.add(job, persist=False)
+            RETRIES.schedule(job)
+            continue
+        job = Job(
+            record['username'],
+            record['url'],
+            record['preset'],
+            priority=record['priority'] or 'normal',
+            job_id=record['id'],
+            created=record['created'],
+        )
+        job.attempts = record['attempts'] or 0
+        job.error_class = record['error_class']
+        if job.username not in OUTDIRS:
+            JOBS.add(job, persist=False)
+            JOBS.update(job, 'failed', error="unknown user")
+            continue
+        MAIN_LOGGER.info(
+            "Resuming %s job for url %r", record['state'], job.url
+        )
+        JOBS.add(job, persist=False)
+        JOBS.update(job, 'pending')
+        EXTRACT_SLOTS.acquire()
+        if not _submit_to_extractor(job):
+            return
+
+
+def extract_job(job):
+    """Extract the video information for `job` and place it on the DL_Q.
+
+    This runs in the EXTRACTOR pool. On success, the `outfile` of the job is
+    resolved, and the job is placed on the DL_Q queue for the job's username,
+    to be processed by one of the download-threads (or, with YDL_QUEUE
+    'shared', on the WORKER_QUEUE). The video information is kept in the
+    INFO_CACHE, from which the download proceeds.
+
+    No download is necessary if the file already exists for the same video
+    and preset (see :func:`find_completed_file`), or if it can be derived
+    from the file of a higher-quality preset (see :func:`find_source_file`).
+    In the latter case, the job is placed in the POSTPROCESSOR pool instead
+    (see :func:`derive_job`).
+
+    Before the job is placed on the DL_Q, there must be enough disk space
+    for the expected size of the download (see :func:`admit_download`).
+    """
+    try:
+        url = job.url
+        JOBS.update(job, 'extracting')
+        info = INFO_CACHE.get(url, job.preset)
+        if info is None:
+            ydl_params = {
+                'format': job.format,
+                'noplaylist': True,
+                'quiet': True,
+                'no_warnings': True,
+            }
+            start = time.perf_counter()
+            try:
+                with GATE, youtube_dl.YoutubeDL(ydl_params) as ydl:
+                    info = ydl.extract_info(url, download=False)
+            except Exception as exc_info:
+                MAIN_LOGGER.error("Exception: %r", exc_info)
+                MAIN_LOGGER.error(
+                    "Could not add url %r to the download queue", url
+                )
+                fail_job(job, exc_info, 'extract')
+                return
+            METRIC_STAGE_SECONDS.observe(
+                time.perf_counter() - start, ('extract',)
+            )
+            INFO_CACHE.put(url, job.preset, info)
+        if MAIN_LOGGER.isEnabledFor(logging.DEBUG):
+            MAIN_LOGGER.debug(
+                textwrap.indent("\ninfo = %s" % pprint.pformat(info), '    ')
+            )
+        outfile = outfile_for_info(info, job.preset)
+        JOBS.resolve(job, outfile)
+        job.extractor = info.get('extractor_key', info.get('extractor'))
+        job.video_id = info['id']
+        job.height = info.get('height')
+        job.filesize = expected_filesize(info)
+        job.postprocessing = bool(
+            POSTPROCESSORS[job.preset] or info.get('requested_formats')
+        )
+        primary = DEDUP.claim(job)
+        if primary is not None:
+            JOBS.update(job, 'queued')
+            MAIN_LOGGER.info(
+                "Attached url %r to the download of %r for %s",
+                url,
+                primary.outfile,
+                primary.username,
+            )
+            return
+        source = find_completed_file(job)
+        if source is not None:
+            MAIN_LOGGER.info("Reusing %r for url %r", str(source), url)
+            deliver_file(source, job)
+            complete_job(job, str(Path(OUTDIRS[job.username]) / outfile))
+            return
+        JOBS.update(job, 'queued')
+        derivable = find_source_file(job)
+        if derivable is not None:
+            MAIN_LOGGER.info(
+                "Deriving %r from %r for url %r",
+                outfile,
+                str(derivable[0]),
+                url,
+            )
+            _submit_derivation(job, *derivable)
+            return
+        error = admit_download(job)
+        if error is not None:
+            MAIN_LOGGER.error("Rejected url %r: %s", url, error)
+            retry_or_fail(job, error, 'permanent', 'admission')
+            return
+        queue_download(job)
+        MAIN_LOGGER.info("Added url %r to the download queue", url)
+    except Exception as exc_info:
+        MAIN_LOGGER.error("Exception: %r", exc_info)
+        abort_job(job, 'failed', str(exc_info))
+    finally:
+        EXTRACT_SLOTS.release()
+
+
+def user_ids(username):
+    """Tuple (uid, gid) for files of `username`, or (None, None)."""
+    if UIDS.get(username, None) is None:
+        return None, None
+    uid = int(UIDS[username])
+    gid = int(GIDS.get(username, None) or uid)
+    return uid, gid
+
+
+FICLONE = 0x40049409  # ioctl for creating a reflink (copy-on-write clone)
+
+
+def link_file(src, dst, uid=None, gid=None):
+    """Make the file `src` available as `dst`, without copying if possible.
+
+    Creates a hardlink if `src` already has the given `uid` and `gid` (as
+    otherwise, changing the owner of `dst` would also change the owner of
+    `src`), or else a reflink on file systems that support it, or else a
+    copy. If `uid` is given, `dst` is owned by `uid` and `gid`.
+    """
+    src, dst = str(src), str(dst)
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    src_stat = os.stat(src)
+    tmp = dst + '.link'
+    linked = False
+    if uid is None or (src_stat.st_uid, src_stat.st_gid) == (uid, gid):
+        try:
+            os.link(src, tmp)
+            linked = True
+        except OSError:
+            pass  # e.g. different file systems
+    if not linked:
+        try:
+            with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            shutil.copy2(src, tmp)
+        if uid is not None:
+            os.chown(tmp, uid=uid, gid=gid)
+    os.replace(tmp, dst)
+
+
+def find_completed_file(job):
+    """Return the path of an existing file that `job` can reuse, or None.
+
+    This is the result of an earlier finished job for the same video and
+    preset, from any user.
+    """
+    for record in JOBS.store.finished(*job.dedup_key):
+        if record['username'] not in OUTDIRS or record['outfile'] is None:
+            continue
+        path = Path(OUTDIRS[record['username']]) / record['outfile']
+        if path.is_file():
+            return path
+    return None
+
+
+def find_source_file(job):
+    """Return the path and video height of an existing file from which the
+    file for `job` can be derived locally, or None.
+
+    Candidates are the results of earlier finished jobs for the same video,
+    from any user, with one of the presets listed in DERIVABLE for the
+    preset of `job`. For presets with MAX_HEIGHTS, a candidate must have at
+    least the video height that a download for `job` would have. If the
+    outfile of `job` exists already, youtube-dl reuses it, so there is
+    nothing to derive.
+    """
+    if (Path(OUTDIRS[job.username]) / job.outfile).exists():
+        return None
+    needed = job.height or MAX_HEIGHTS.get(job.preset)
+    for preset in DERIVABLE.get(job.preset, []):
+        for record in JOBS.store.finished(job.extractor, job.video_id, preset):
+            if record['username'] not in OUTDIRS or record['outfile'] is None:
+                continue
+            height = record['height']
+            if job.preset in MAX_HEIGHTS and (
+                height is None or height < needed
+            ):
+                continue
+            path = Path(OUTDIRS[record['username']]) / record['outfile']
+            if path.is_file():
+                return path, height
+    return None
+
+
+def expected_filesize(info):
+    """Expected size in bytes of the download for the video information
+    `info` (the sum over all requested formats), or None if unknown."""
+    sizes = [
+        fmt.get('filesize') or fmt.get('filesize_approx')
+        for fmt in info.get('requested_formats') or [info]
+    ]
+    if not all(sizes):
+        return None
+    return int(sum(sizes))
+
+
+def admit_download(job):
+    """Make room for the download of `job` (see :meth:`Retention.admit`).
+
+    Returns None if the expected `filesize` of the job (0 if unknown) fits
+    into the quotas and the free disk space, or else an error message.
+    """
+    try:
+        return RETENTION.admit(
+            job.username, job.filesize or 0, reserved_space(exclude=job)
+        )
+    except (OSError, sqlite3.Error) as exc_info:
+        MAIN_LOGGER.error("Cannot check disk space: %r", exc_info)
+        return None
+
+
+def queue_download(job):
+    """Place the 'queued' `job` on the DL_Q (or, with YDL_QUEUE 'shared', on
+    the WORKER_QUEUE)."""
+    if WORKER_QUEUE is not None:
+        WORKER_QUEUE.push(job.id)
+    else:
+        DL_Q.put(job.username, job)
+
+
+def deliver_file(src, job):
+    """Hardlink (or copy) `src` to the outfile of `job`."""
+    dst = Path(OUTDIRS[job.username]) / job.outfile
+    uid, gid = user_ids(job.username)
+    link_file(src, dst, uid=uid, gid=gid)
+    file_index(job.username).add(job.outfile)
+    DL_LOGGER.info("Linked %r to %r", str(src), str(dst))
+
+
+def complete_job(job, outpath):
+    """Mark `job` as finished with the file `outpath`.
+
+    The file is delivered to all jobs that were coalesced with `job`.
+    """
+    file_index(job.username).add(job.outfile)
+    job.phase = 'done'
+    JOBS.update(job, 'finished')
+    for follower in DEDUP.release(job):
+        try:
+            deliver_file(outpath, follower)
+            follower.height = job.height
+            follower.phase = 'done'
+            JOBS.update(follower, 'finished')
+        except OSError as exc_info:
+            DL_LOGGER.error("Exception: %r", exc_info)
+            JOBS.update(follower, 'failed', error=str(exc_info))
+
+
+def abort_job(job, state, error):
+    """Set `job` and all jobs coalesced with it to `state` with `error`."""
+    JOBS.update(job, state, error=error)
+    for follower in DEDUP.release(job):
+        JOBS.update(follower, state, error=error)
+
+
+# network errors that are worth retrying
+NETWORK_ERRORS = (
+    URLError,
+    ConnectionError,
+    TimeoutError,
+    http.client.HTTPException,
+)
+# messages of network errors that youtube-dl reports without an exception
+NETWORK_ERROR_MESSAGES = ('giving up after', 'Did not get any data blocks')
+
+
+def is_youtube_dl_error(exc_info, name):
+    """Whether `exc_info` is an instance of the class `name` of
+    :mod:`youtube_dl.utils`.
+
+    The classes are compared by name, so that this also holds for exceptions
+    raised by a youtube_dl module that was replaced in the meantime (see
+    :func:`reload_youtube_dl`).
+    """
+    return any(
+        cls.__name__ == name and cls.__module__ == 'youtube_dl.utils'
+        for cls in type(exc_info).__mro__
+    )
+
+
+def classify_error(exc_info):
+    """Classify the exception `exc_info` raised while processing a job.
+
+    Returns one of
+
+    * 'network' for a (probably temporary) problem with the connection: the
+      job is retried with the same video information, resuming any partial
+      download from its ".part" file
+    * 'extractor' for a problem with the video information, e.g., an
+      expired media url (HTTP 403/404/410) or a failing extractor: the job is
+      retried with freshly extracted information
+    * 'permanent' for all other errors, e.g., an unavailable video, an
+      unsupported url, or a failed postprocessor: the job is not retried
+    """
+    if is_youtube_dl_error(exc_info, 'DownloadError'):
+        if exc_info.exc_info is not None and exc_info.exc_info[1]:
+            exc_info = exc_info.exc_info[1]
+        elif any(msg in str(exc_info) for msg in NETWORK_ERROR_MESSAGES):
+            return 'network'
+    if is_youtube_dl_error(exc_info, 'ExtractorError'):
+        if exc_info.cause is not None:
+            if classify_error(exc_info.cause) == 'network':
+                return 'network'
+        # youtube-dl adds a request for a bug report to the message of all
+        # errors that are not "expected" (like an unavailable video)
+        if 'please report this issue' in str(exc_info):
+            return 'extractor'
+        return 'permanent'
+    if isinstance(exc_info, HTTPError):
+        if exc_info.code in (403, 404, 410):
+            return 'extractor'
+        if exc_info.code == 429 or exc_info.code >= 500:
+            return 'network'
+        return 'permanent'
+    if isinstance(exc_info, NETWORK_ERRORS):
+        return 'network'
+    if is_youtube_dl_error(exc_info, 'ContentTooShortError'):
+        return 'network'
+    return 'permanent'
+
+
+def retry_delay(attempts):
+    """Jittered exponential backoff: the delay in seconds before the retry
+    following the given number of previous `attempts`."""
+    delay = min(YDL_RETRY_DELAY * 2 ** attempts, YDL_RETRY_MAX_DELAY)
+    return random.uniform(delay / 2, delay)
+
+
+def fail_job(job, exc_info, stage):
+    """Handle the exception `exc_info` raised during the given `stage`
+    ('extract' or 'download') of `job`.
+
+    See :func:`retry_or_fail`.
+    """
+    retry_or_fail(job, str(exc_info), classify_error(exc_info), stage)
+
+
+def retry_or_fail(job, error, error_class, stage):
+    """Handle the `error` message of the given `error_class` (see
+    :func:`classify_error`) that occurred during `stage` of `job`.
+
+    Depending on the `error_class` and the number of `attempts` so far,
+    `job` and all jobs coalesced with it are scheduled for a retry, or they
+    fail (see :func:`abort_job`).
+    """
+    job.error_class = error_class
+    if error_class == 'permanent' or job.attempts >= YDL_RETRIES:
+        METRIC_FAILURES.inc(labels=(job.extractor or 'unknown', stage))
+        abort_job(job, 'failed', error)
+        return
+    if error_class == 'extractor':
+        INFO_CACHE.discard(job.url, job.preset)
+    for retried_job in [job] + DEDUP.release(job):
+        retried_job.error_class = error_class
+        retried_job.retry_at = time.time() + retry_delay(retried_job.attempts)
+        retried_job.attempts += 1
+        JOBS.update(retried_job, 'retrying', error=error)
+        METRIC_RETRIES.inc(labels=(error_class,))
+        MAIN_LOGGER.warning(
+            "Retrying url %r in %.0fs (%s error, attempt %d of %d)",
+            retried_job.url,
+            retried_job.retry_at - time.time(),
+            error_class,
+            retried_job.attempts,
+            YDL_RETRIES,
+        )
+        RETRIES.schedule(retried_job)
+
+
+def resubmit_job(job):
+    """Send a job that is 'retrying' to the EXTRACTOR again.
+
+    If the server is stopping, the job remains 'retrying', to be resumed
+    after a restart.
+    """
+    if not _acquire_extract_slot(block=True):
+        return
+    job.retry_at = None
+    JOBS.update(job, 'pending')
+    _submit_to_extractor(job)
+
+
+def requeue_job(job):
+    """Process a failed `job` (from the dead-letter list) again.
+
+    Returns an error message, or None if the job was requeued.
+    """
+    if job.state != 'failed':
+        return "job %s has not failed" % job.id
+    if not _acquire_extract_slot():
+        return "too many pending submissions"
+    job.reset()
+    JOBS.add(job, persist=False)
+    JOBS.update(job, 'pending')
+    if not _submit_to_extractor(job):
+        return "server is shutting down"
+    MAIN_LOGGER.info("Requeued url %r for %s", job.url, job.username)
+    return None
+
+
+@APP.route("/status", method="GET")
+def status():
+    """Report statistics about the server."""
+    token = bottle.request.params.get("token", None)
+    if token not in TOKENS.values():
+        bottle.abort(401, "Not authorized")
+    return {
+        "queue": {"pending": DL_Q.qsize(), "active": DL_Q.active()},
+        "info_cache": INFO_CACHE.stats(),
+        "process": process_stats(),
+        "bandwidth": {
+            "limit": BANDWIDTH.limit,
+            "throughput": BANDWIDTH.throughput(),
+        },
+    }
+
+
+@APP.route("/metrics", method="GET")
+def metrics():
+    """Report metrics in the Prometheus text format."""
+    if YDL_METRICS_TOKEN:
+        token = bottle.request.params.get("token", None)
+        if token != YDL_METRICS_TOKEN:
+            bottle.abort(401, "Not authorized")
+    bottle.response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    return METRICS.render()
+
+
+def worker_request():
+    """Return the JSON body of a request to one of the "/worker" routes.
+
+    The body must contain the YDL_WORKER_TOKEN as "token", and the id of the
+    worker process as "worker". Failed attempts are throttled like for user
+    tokens (see :func:`auth_failure`).
+    """
+    if WORKER_QUEUE is None or not YDL_WORKER_TOKEN:
+        bottle.abort(404, "No shared queue")
+    data = bottle.request.json or {}
+    if data.get('token') != YDL_WORKER_TOKEN:
+        auth_failure()
+        bottle.abort(401, "Not authorized")
+    if not data.get('worker'):
+        bottle.abort(400, "Missing worker")
+    return data
+
+
+@APP.route("/worker/claim", method="POST")
+def worker_claim():
+    """Lease the next job in the WORKER_QUEUE to a remote worker."""
+    data = worker_request()
+    return {"job": WORKER_QUEUE.claim(data['worker'])}
+
+
+@APP.route("/worker/heartbeat", method="POST")
+def worker_heartbeat():
+    """Renew the lease of a remote worker on a job."""
+    data = worker_request()
+    held = WORKER_QUEUE.heartbeat(
+        data['worker'],
+        data.get('job'),
+        data.get('state'),
+        data.get('progress'),
+    )
+    return {"success": held}
+
+
+@APP.route("/worker/complete", method="POST")
+def worker_complete():
+    """End the lease of a remote worker on a job."""
+    data = worker_request()
+    try:
+        held = WORKER_QUEUE.complete(
+            data['worker'],
+            data.get('job'),
+            data.get('state'),
+            error=data.get('error'),
+            error_class=data.get('error_class'),
+        )
+    except ValueError as exc_info:
+        bottle.abort(400, str(exc_info))
+    return {"success": held}
+
+
+@APP.route("/update", method="GET")
+def update():
+    """Update the youtube-dl backend.
+
+    The update runs in the background, and at most once per
+    YDL_UPDATE_INTERVAL. Returns the status of the UPDATER, including the
+    result of the last update.
+    """
+    token = bottle.request.params.get("token", None)
+    if token not in TOKENS.values():
+        bottle.abort(401, "Not authorized")
+    started = UPDATER.start(interval=YDL_UPDATE_INTERVAL)
+    return dict(UPDATER.status(), started=started)
+
+
+class Updater:
+    """Self-update of youtube-dl via pip, in a background thread.
+
+    The pip process is killed after `timeout` seconds. The time and the
+    result of the last update are recorded in the JSON file `state_file`, so
+    that updates can be throttled across restarts (see :meth:`start`). If an
+    update installed a new version, the youtube_dl module is reloaded as soon
+    as no job is in progress (see :func:`reload_youtube_dl`).
+    """
+
+    def __init__(self, state_file, timeout=300):
+        self.state_file = state_file
+        self.timeout = timeout
+        self._lock = Lock()
+        self._thread = None
+        self._state = {}  # "time", "output", "error"
+        try:
+            with open(state_file) as in_fh:
+                self._state = json.load(in_fh)
+        except (OSError, ValueError):
+            pass
+
+    def status(self):
+        """Summary of the last update, for returning as JSON."""
+        with self._lock:
+            return dict(
+                self._state,
+                running=(self._thread is not None),
+                version=youtube_dl.version.__version__,
+            )
+
+    def start(self, interval=0):
+        """Start an update in the background.
+
+        No update is started while one is running, or if the last update was
+        less than `interval` seconds ago. Returns whether an update was
+        started.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return False
+            if time.time() - self._state.get('time', 0) < interval:
+                return False
+            self._thread = Thread(
+                target=self._run, name='updater', daemon=True
+            )
+            self._thread.start()
+            return True
+
+    def _run(self):
+        try:
+            MAIN_LOGGER.info("Updating youtube-dl to the newest version")
+            result = self._pip()
+            MAIN_LOGGER.info(result["output"].strip())
+            MAIN_LOGGER.info(result["error"].strip())
+            with self._lock:
+                self._state = result
+            try:
+                with open(self.state_file, 'w') as out_fh:
+                    json.dump(result, out_fh)
+            except OSError as exc_info:
+                MAIN_LOGGER.error("Cannot save update state: %r", exc_info)
+            self.reload()
+        except Exception as exc_info:
+            MAIN_LOGGER.error("Exception: %r", exc_info)
+        finally:
+            with self._lock:
+                self._thread = None
+
+    @staticmethod
+    def installed_version():
+        """Version of the installed youtube-dl package, or None."""
+        try:
+            return importlib.metadata.version('youtube_dl')
+        except importlib.metadata.PackageNotFoundError:
+            return None
+
+    def reload(self):
+        """Reload the youtube_dl module as soon as no job is in progress, if
+        a different version has been installed (e.g. by the update of
+        another process)."""
+        version = self.installed_version()
+        if version is None or version == youtube_dl.version.__version__:
+            return
+        MAIN_LOGGER.info(
+            "Reloading youtube-dl %s once no job is in progress", version
+        )
+        with GATE.exclusive():
+            if self.installed_version() != youtube_dl.version.__version__:
+                reload_youtube_dl()
+        MAIN_LOGGER.info("Using youtube-dl %s", youtube_dl.version.__version__)
+
+    def _pip(self):
+        command = [
+            sys.executable,
+            "-m",
+            "pip",
+            "install",
+            "--upgrade",
+            "youtube-dl",
+        ]
+        try:
+            proc = subprocess.run(
+                command, capture_output=True, timeout=self.timeout
+            )
+            output, error = proc.stdout, proc.stderr
+        except subprocess.TimeoutExpired as exc_info:
+            output = exc_info.stdout or b''
+            error = b"Timed out after %g seconds" % self.timeout
+        except OSError as exc_info:
+            output, error = b'', str(exc_info).encode('utf-8')
+        return {
+            "time": time.time(),
+            "output": output.decode('utf-8', 'replace'),
+            "error": error.decode('utf-8', 'replace'),
+        }
+
+
+UPDATER = Updater(YDL_UPDATE_FILE, timeout=YDL_UPDATE_TIMEOUT)
+
+
+def auto_update():
+    """Update youtube-dl every YDL_UPDATE_INTERVAL seconds, starting right
+    away if the last update was longer ago than that.
+
+    This is the main function of a background thread. In between updates, it
+    checks (at least hourly) whether another process sharing the
+    installation updated youtube-dl. Updates are disabled if
+    YDL_UPDATE_INTERVAL is 0.
+    """
+    if YDL_UPDATE_INTERVAL <= 0:
+        return
+    while True:
+        if not UPDATER.start(interval=YDL_UPDATE_INTERVAL):
+            try:
+                UPDATER.reload()
+            except Exception as exc_info:
+                MAIN_LOGGER.error("Exception: %r", exc_info)
+        if STOPPING.wait(min(YDL_UPDATE_INTERVAL, 3600)):
+            return
+
+
+class SanitizedFilenameTmpl:
+    """Format string that evaluates to a safe filename."""
+
+    whitelist = "-_.() %s%s'\"" % (
+        string.ascii_letters,
+        string.digits,
+    )  #: string containing all allowed filename characters
+    char_limit = 128  #: max length of allowed filenames
+    # Technically, the limit is 255 - len('.part'), but 128 is much more
+    # reasonable for human consumption
+
+    def __init__(self, tmpl):
+        self._tmpl = tmpl
+
+    def _sanitize(self, val):
+        # 1. Replace unicode with ascii-equivalents
+        val = (
+            unicodedata.normalize('NFKD', val)
+            .encode('ASCII', 'ignore')
+            .decode()
+        )
+        # 2. Throw away any non-whitelisted characters
+        val = ''.join(c for c in val if c in self.whitelist)
+        return val.strip()
 
     def format(self, **kwargs):
         keys = set(
@@ -538,33 +4697,600 @@ class SanitizedFilenameTmpl:
         return filename.strip()
 
 
+def job_logger(job, outpath):
+    """Create the logger for downloading `job` to `outpath`.
+
+    Messages are written to a log file next to `outpath`, and propagate to
+    the DL_LOGGER. The logger is not registered with the :mod:`logging`
+    module, so that it is discarded after :func:`close_logger`.
+    """
+    logger = logging.Logger('youtubedl.%s' % job.video_id)
+    logger.parent = DL_LOGGER
+    return configure_logging(
+        logger,
+        logfile=Path(outpath).with_suffix('.log'),
+        log_to_stdout=False,
+        level=YDL_LOGLEVEL,
+    )
+
+
+def close_logger(logger):
+    """Remove and close all handlers of `logger`."""
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+
+def build_ydl(job, outpath, logger, reporter):
+    """Create a YoutubeDL instance for downloading `job` to `outpath`.
+
+    The instance logs to `logger` and reports its progress to `reporter`.
+    """
+    ydl_params = {
+        'format': job.format,
+        'noplaylist': True,
+        'postprocessors': POSTPROCESSORS[job.preset],
+        'outtmpl': outpath,
+        'logger': logger,
+        'progress_hooks': [reporter, youtube_dl_check_cancelled],
+        'continuedl': True,  # resume from ".part" files when retrying
+        'quiet': True,
+        'no_warnings': True,
+    }
+    if MAIN_LOGGER.isEnabledFor(logging.DEBUG):
+        MAIN_LOGGER.debug(
+            textwrap.indent(
+                "\nydl_params = %s" % pprint.pformat(ydl_params), '    '
+            )
+        )
+    return DownloadOnlyYoutubeDL(ydl_params)
+
+
+class DownloadOnly:
+    """Mixin for :class:`youtube_dl.YoutubeDL` that does not run any
+    postprocessors after a download.
+
+    Instead, the name of the downloaded file and the video information that
+    would have been passed to the postprocessors are recorded in the
+    `downloaded` attribute, so that the postprocessors can be run in a
+    separate thread, via :func:`postprocess_job`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.downloaded = None  # (filename, info)
+
+    def post_process(self, filename, ie_info):
+        self.downloaded = (filename, ie_info)
+
+
+def download_only_class():
+    """Combine :class:`DownloadOnly` with the current YoutubeDL class."""
+    return type(
+        'DownloadOnlyYoutubeDL', (DownloadOnly, youtube_dl.YoutubeDL), {}
+    )
+
+
+DownloadOnlyYoutubeDL = download_only_class()
+
+
+def reload_youtube_dl():
+    """Import the youtube_dl package again, after it has been updated.
+
+    This must only be called while no job is in progress (see
+    :class:`JobGate`). Any code that still holds on to the old modules (like
+    the expansion of a playlist in a batch) continues to use them.
+    """
+    global youtube_dl, DownloadOnlyYoutubeDL
+    for name in list(sys.modules):
+        if name == 'youtube_dl' or name.startswith('youtube_dl.'):
+            del sys.modules[name]
+    importlib.invalidate_caches()
+    youtube_dl = importlib.import_module('youtube_dl')
+    DownloadOnlyYoutubeDL = download_only_class()
+
+
+def download(ydl, job):
+    """Use `ydl` to download the video for `job`.
+
+    If the INFO_CACHE still holds the video information for the job, the
+    download proceeds directly from it, without extracting the information
+    again.
+    """
+    info = INFO_CACHE.peek(job.url, job.preset)
+    if info is not None:
+        info = ydl.filter_requested_info(copy.deepcopy(info))
+        try:
+            ydl.process_ie_result(info, download=True)
+            return
+        except youtube_dl.utils.DownloadError as exc_info:
+            if SHUTDOWN.is_set():
+                raise
+            DL_LOGGER.warning(
+                "Download from cached info failed (%s), retrying with %r",
+                exc_info,
+                job.url,
+            )
+    ydl.download([job.url])
+
+
+def finish_job(job, outpath):
+    """Hand over the finished file `outpath` of `job` to its user."""
+    start = time.perf_counter()
+    uid, gid = user_ids(job.username)
+    if uid is not None:
+        os.chown(outpath, uid=uid, gid=gid)
+    complete_job(job, outpath)
+    METRIC_STAGE_SECONDS.observe(time.perf_counter() - start, ('chown',))
+
+
+def _submit_to_postprocessor(job, filename, info, dl_logger):
+    """Hand the downloaded file for `job` to the POSTPROCESSOR.
+
+    If the POSTPROCESSOR has been shut down, postprocess in the current
+    thread instead.
+    """
+    try:
+        POSTPROCESSOR.submit(postprocess_job, job, filename, info, dl_logger)
+    except RuntimeError:  # POSTPROCESSOR has been shut down
+        postprocess_job(job, filename, info, dl_logger)
+
+
+def run_postprocessors(job, filename, info, dl_logger):
+    """Run the postprocessors for `job` on the downloaded `filename`.
+
+    The video information `info` is as recorded by
+    :class:`DownloadOnlyYoutubeDL`: its "__postprocessors" (for merging
+    formats, or fixups) run before the postprocessors of the job's preset.
+    Returns the path of the resulting file.
+    """
+    outfile = str(Path(OUTDIRS[job.username]) / job.outfile)
+    ydl_params = {
+        'postprocessors': POSTPROCESSORS[job.preset],
+        'outtmpl': outfile,
+        'logger': dl_logger,
+        'quiet': True,
+        'no_warnings': True,
+    }
+    start = time.perf_counter()
+    with GATE, youtube_dl.YoutubeDL(ydl_params) as ydl:
+        for pp in info.get('__postprocessors') or []:
+            pp.set_downloader(ydl)
+        ydl.post_process(filename, info)
+    METRIC_STAGE_SECONDS.observe(time.perf_counter() - start, ('postprocess',))
+    dl_logger.info("Postprocessed %r", outfile)
+    return outfile
+
+
+def postprocess_job(job, filename, info, dl_logger):
+    """Run the postprocessors for `job` (see :func:`run_postprocessors`),
+    and finish the job.
+
+    This runs in the POSTPROCESSOR pool, so that the CPU-bound
+    postprocessing does not block a download thread. The `dl_logger` of the
+    download is closed when done.
+    """
+    try:
+        outfile = run_postprocessors(job, filename, info, dl_logger)
+        finish_job(job, outfile)
+    except Exception as exc_info:
+        DL_LOGGER.error("Exception: %r", exc_info)
+        if SHUTDOWN.is_set():
+            abort_job(job, 'interrupted', str(exc_info))
+        else:
+            fail_job(job, exc_info, 'postprocess')
+    finally:
+        close_logger(dl_logger)
+
+
+def _submit_derivation(job, source, height):
+    """Hand `job` to the POSTPROCESSOR, to derive its file from `source`.
+
+    If the POSTPROCESSOR has been shut down, the job is 'interrupted'.
+    """
+    try:
+        POSTPROCESSOR.submit(derive_job, job, source, height)
+    except RuntimeError:  # POSTPROCESSOR has been shut down
+        abort_job(job, 'interrupted', "Server shut down")
+
+
+def derive_file(
+    source, height, preset, outpath, workdir, logger, uid=None, gid=None
+):
+    """Create `outpath` for `preset` from the local file `source`, with the
+    given video `height`, of a higher-quality preset (see
+    :func:`find_source_file`).
+
+    For a preset with postprocessors (like 'mp3'), these run on a link to
+    `source`. A video preset with MAX_HEIGHTS below `height` is downscaled
+    with ffmpeg. Otherwise, `source` already is a valid file for `preset`,
+    and is linked to `outpath` (see :func:`link_file`, with the `uid` and
+    `gid` of the owner of `outpath`, so that `source` keeps its owner).
+    Intermediate files are created in the directory `workdir`. Returns the
+    video height of `outpath`.
+    """
+    max_height = MAX_HEIGHTS.get(preset)
+    if not POSTPROCESSORS[preset] and (
+        max_height is None or height <= max_height
+    ):
+        link_file(source, outpath, uid=uid, gid=gid)
+        return height
+    ydl_params = {
+        'postprocessors': POSTPROCESSORS[preset],
+        'logger': logger,
+        'quiet': True,
+        'no_warnings': True,
+    }
+    workdir.mkdir(exist_ok=True)
+    with youtube_dl.YoutubeDL(ydl_params) as ydl:
+        if POSTPROCESSORS[preset]:
+            # the postprocessors replace the extension of the file name
+            filename = str(workdir / (outpath.stem + source.suffix))
+            link_file(source, filename)
+            info = {'filepath': filename, 'ext': source.suffix[1:]}
+            ydl.post_process(filename, info)
+            height = None
+        else:
+            ffmpeg = youtube_dl.postprocessor.ffmpeg.FFmpegPostProcessor(ydl)
+            ffmpeg.run_ffmpeg(
+                str(source),
+                str(workdir / outpath.name),
+                ['-vf', 'scale=-2:%d' % max_height, '-c:a', 'copy'],
+            )
+            height = max_height
+    os.replace(str(workdir / outpath.name), str(outpath))
+    return height
+
+
+def derive_job(job, source, height):
+    """Derive the file for `job` from `source` (see :func:`derive_file`),
+    and finish the job.
+
+    This runs in the POSTPROCESSOR pool. If the file cannot be derived
+    (e.g., because ffmpeg is not available), the job falls back to a regular
+    download.
+    """
+    outpath = Path(OUTDIRS[job.username]) / job.outfile
+    workdir = outpath.parent / ('.derive-%s' % job.id)
+    dl_logger = job_logger(job, outpath)
+    try:
+        job.phase = 'postprocessing'
+        JOBS.update(job, 'postprocessing')
+        start = time.perf_counter()
+        uid, gid = user_ids(job.username)
+        with GATE:
+            job.height = derive_file(
+                source,
+                height,
+                job.preset,
+                outpath,
+                workdir,
+                dl_logger,
+                uid=uid,
+                gid=gid,
+            )
+        METRIC_STAGE_SECONDS.observe(time.perf_counter() - start, ('derive',))
+        dl_logger.info("Derived %r from %r", str(outpath), str(source))
+        finish_job(job, str(outpath))
+    except Exception as exc_info:
+        DL_LOGGER.error("Exception: %r", exc_info)
+        if SHUTDOWN.is_set():
+            abort_job(job, 'interrupted', str(exc_info))
+        else:
+            DL_LOGGER.warning(
+                "Cannot derive %r from %r, downloading instead",
+                str(outpath),
+                str(source),
+            )
+            job.phase = None
+            JOBS.update(job, 'queued')
+            queue_download(job)
+    finally:
+        shutil.rmtree(str(workdir), ignore_errors=True)
+        close_logger(dl_logger)
+
+
 def dl_worker():
     """Process downloads from the DL_Q.
 
-    This is the main function of the download thread.
+    This is the main function of each download thread. It returns when the
+    DL_Q is closed and no jobs remain.
     """
-    logger = logging.getLogger('youtubedl')
-    configure_logging(
-        logger, logfile=YDL_DL_LOGFILE, log_to_stdout=True, level=YDL_LOGLEVEL
-    )
+    logger = DL_LOGGER
     while True:
+        username, job = DL_Q.get()
+        if job is None:
+            return  # queue was closed
+        dl_logger = None
         try:
-            ydl, username, url = DL_Q.get()
-            if ydl is None:
-                return  # end the download thread with poison pill
-            outfile = ydl.params['outtmpl']
+            JOBS.update(job, 'downloading')
+            outfile = str(Path(OUTDIRS[username]) / job.outfile)
             if Path(outfile).is_file():
-                logger.info("Removing existing %r", outfile)
-                Path(outfile).unlink()
-            ydl.download([url])
-            if UIDS.get(username, None) is not None:
-                uid = int(UIDS[username])
-                gid = int(GIDS.get(username, uid))
-                os.chown(outfile, uid=uid, gid=gid)
-            logger.info("Downloaded to %r", outfile)
-            DL_Q.task_done()
+                logger.info("Reusing existing %r", outfile)
+            else:
+                dl_logger = job_logger(job, outfile)
+                reporter = ProgressReporter(
+                    job,
+                    dl_logger,
+                    interval=YDL_PROGRESS_INTERVAL,
+                    postprocessing=job.postprocessing,
+                )
+                start = time.perf_counter()
+                with GATE, build_ydl(job, outfile, dl_logger, reporter) as ydl:
+                    BANDWIDTH.add(job, ydl.params)
+                    try:
+                        download(ydl, job)
+                    finally:
+                        BANDWIDTH.remove(job)
+                METRIC_STAGE_SECONDS.observe(
+                    time.perf_counter() - start, ('download',)
+                )
+                METRIC_DOWNLOADS.inc(labels=(job.extractor,))
+                logger.info("Downloaded to %r", outfile)
+                filename, info = ydl.downloaded or (outfile, {})
+                if info.get('__postprocessors') or POSTPROCESSORS[job.preset]:
+                    JOBS.update(job, 'postprocessing')
+                    _submit_to_postprocessor(job, filename, info, dl_logger)
+                    dl_logger = None  # closed after postprocessing
+                    continue
+            finish_job(job, outfile)
         except Exception as exc_info:
             logger.error("Exception: %r", exc_info)
+            if SHUTDOWN.is_set():
+                abort_job(job, 'interrupted', str(exc_info))
+            else:
+                fail_job(job, exc_info, 'download')
+        finally:
+            if dl_logger is not None:
+                close_logger(dl_logger)
+            DL_Q.task_done(username)
+
+
+def sync_workers():
+    """Follow the jobs in the WORKER_QUEUE (with YDL_QUEUE 'shared').
+
+    This is the main function of a thread of the server. Every YDL_HEARTBEAT
+    seconds, jobs with an expired lease are returned to the queue, and the
+    state and progress that the worker processes recorded in the database
+    are copied to the jobs in memory. Jobs that a worker finished are
+    completed (delivering the file to all coalesced jobs), and failed jobs
+    are retried or fail according to :func:`retry_or_fail`.
+    """
+    while not STOPPING.wait(YDL_HEARTBEAT):
+        try:
+            _sync_workers()
+        except Exception as exc_info:
+            MAIN_LOGGER.error("Exception: %r", exc_info)
+
+
+def _sync_workers():
+    for job_id in WORKER_QUEUE.reclaim():
+        MAIN_LOGGER.warning("Lease on job %s expired, requeued it", job_id)
+    jobs = JOBS.jobs_in(('queued',) + SQLiteQueue.ACTIVE_STATES)
+    rows = WORKER_QUEUE.rows(job.id for job in jobs)
+    changed = False
+    for job in jobs:
+        row = rows.get(job.id, None)
+        if row is None:
+            continue
+        state = row['state']
+        if state in SQLiteQueue.ACTIVE_STATES and row['progress']:
+            progress = json.loads(row['progress'])
+            for (attr, value) in progress.items():
+                if attr in JOB_PROGRESS:
+                    setattr(job, attr, value)
+            changed = True
+        if state == 'finished':
+            outfile = str(Path(OUTDIRS[job.username]) / job.outfile)
+            complete_job(job, outfile)
+        elif state == 'failed':
+            MAIN_LOGGER.error("Worker failed on url %r", job.url)
+            error_class = row['error_class'] or 'permanent'
+            retry_or_fail(job, row['error'], error_class, 'download')
+        elif state != job.state:
+            job.set_state(state)
+            changed = True
+    if changed:
+        JOBS.notify()
+
+
+def check_lease(lost, d):
+    """Abort a running download in a worker process once the Event `lost`
+    is set.
+
+    After `lost` is set via :func:`functools.partial`, the resulting function
+    is used as a "progress_hook" for :class:`YoutubeDL`.
+    """
+    if lost.is_set():
+        raise JobCancelled("Lost the lease on the job")
+
+
+def worker_download(job, lost):
+    """Download (and postprocess) `job` in a worker process.
+
+    The download is aborted if the Event `lost` is set. Returns a tuple
+    (state, error, error_class) for :meth:`SQLiteQueue.complete`.
+    """
+    outfile = str(Path(OUTDIRS[job.username]) / job.outfile)
+    dl_logger = None
+    try:
+        if Path(outfile).is_file():
+            DL_LOGGER.info("Reusing existing %r", outfile)
+        else:
+            dl_logger = job_logger(job, outfile)
+            reporter = ProgressReporter(
+                job,
+                dl_logger,
+                interval=YDL_PROGRESS_INTERVAL,
+                postprocessing=bool(POSTPROCESSORS[job.preset]),
+            )
+            with GATE, build_ydl(job, outfile, dl_logger, reporter) as ydl:
+                ydl.add_progress_hook(partial(check_lease, lost))
+                BANDWIDTH.add(job, ydl.params)
+                try:
+                    download(ydl, job)
+                finally:
+                    BANDWIDTH.remove(job)
+            DL_LOGGER.info("Downloaded to %r", outfile)
+            filename, info = ydl.downloaded or (outfile, {})
+            if info.get('__postprocessors') or POSTPROCESSORS[job.preset]:
+                job.state = 'postprocessing'
+                outfile = run_postprocessors(job, filename, info, dl_logger)
+        uid, gid = user_ids(job.username)
+        if uid is not None:
+            os.chown(outfile, uid=uid, gid=gid)
+        return 'finished', None, None
+    except Exception as exc_info:
+        DL_LOGGER.error("Exception: %r", exc_info)
+        if SHUTDOWN.is_set() or lost.is_set():
+            return 'queued', None, None
+        return 'failed', str(exc_info), classify_error(exc_info)
+    finally:
+        if dl_logger is not None:
+            close_logger(dl_logger)
+
+
+def queue_worker(queue, worker, active):
+    """Download jobs from the shared `queue` as `worker`.
+
+    This is the main function of each download thread of a worker process.
+    It returns when the process is STOPPING. The jobs being downloaded are
+    in the dict `active`, as job id => (job, lost, claimed), with the
+    time.monotonic() before the job was `claimed`, see :func:`renew_leases`.
+    """
+    while not STOPPING.is_set():
+        claimed = time.monotonic()
+        try:
+            record = queue.claim(worker)
+        except Exception as exc_info:  # e.g. server not reachable
+            DL_LOGGER.error("Cannot claim a job: %r", exc_info)
+            record = None
+        if record is None:
+            STOPPING.wait(YDL_HEARTBEAT)
+            continue
+        job = Job.from_record(record)
+        lost = Event()
+        active[job.id] = (job, lost, claimed)
+        DL_LOGGER.info("Claimed job %s for url %r", job.id, job.url)
+        try:
+            state, error, error_class = worker_download(job, lost)
+        finally:
+            del active[job.id]
+        if lost.is_set():
+            continue
+        try:
+            queue.complete(
+                worker, job.id, state, error=error, error_class=error_class
+            )
+        except Exception as exc_info:  # job is requeued once lease expires
+            DL_LOGGER.error("Cannot complete job %s: %r", job.id, exc_info)
+
+
+def renew_leases(queue, worker, active, renewed):
+    """Renew the leases of `worker` on the `active` jobs in the shared
+    `queue` (see :func:`queue_worker`).
+
+    The Event `lost` for a job in `active` is set if the worker no longer
+    holds the lease on it, or if the lease was last renewed (or the job
+    claimed) more than YDL_LEASE seconds ago, because the worker could not
+    reach the queue. In the latter case, the job may already have been
+    reclaimed and given to another worker, so the download must stop. The
+    dict `renewed` maps job ids to the time.monotonic() of the last renewal.
+    """
+    for job_id in list(renewed):
+        if job_id not in active:
+            del renewed[job_id]
+    for (job, lost, claimed) in list(active.values()):
+        sent = time.monotonic()
+        try:
+            held = queue.heartbeat(
+                worker, job.id, job.state, job.as_dict()['progress']
+            )
+        except Exception as exc_info:
+            DL_LOGGER.error(
+                "Cannot renew lease on job %s: %r", job.id, exc_info
+            )
+            if time.monotonic() - renewed.get(job.id, claimed) > YDL_LEASE:
+                DL_LOGGER.warning("Lease on job %s expired", job.id)
+                lost.set()
+            continue
+        if held:
+            renewed[job.id] = sent
+        else:
+            DL_LOGGER.warning("Lost lease on job %s", job.id)
+            lost.set()
+
+
+def send_heartbeats(queue, worker, active):
+    """Renew the leases of `worker` on the `active` jobs in the shared
+    `queue` every YDL_HEARTBEAT seconds (see :func:`renew_leases`).
+
+    This is the main function of the heartbeat thread of a worker process.
+    """
+    renewed = {}  # job id => time.monotonic() of the last renewal
+    while True:
+        time.sleep(YDL_HEARTBEAT)
+        renew_leases(queue, worker, active, renewed)
+
+
+def run_worker():
+    """Run a worker process, downloading jobs from the shared queue.
+
+    This is the main function for ``youtube-dl-server.py worker``. The
+    process runs YDL_WORKERS download threads. It takes jobs directly from
+    the YDL_JOBS_DB, or, if YDL_WORKER_SERVER is set, from the server at that
+    url (see :class:`HttpQueue`). The output directories of YDL_USERS must be
+    the same as for the server (e.g., on a shared file system).
+    """
+    if YDL_WORKER_SERVER:
+        queue = HttpQueue(YDL_WORKER_SERVER, YDL_WORKER_TOKEN)
+    else:
+        queue = SQLiteQueue(
+            YDL_JOBS_DB,
+            lease=YDL_LEASE,
+            max_active=YDL_MAX_ACTIVE,
+            max_per_user=YDL_MAX_ACTIVE_PER_USER,
+            offpeak=OFFPEAK_WINDOW,
+        )
+    worker = '%s:%d' % (socket.gethostname(), os.getpid())
+    active = {}  # job id => (job, lost, claimed)
+    threads = [
+        Thread(
+            target=queue_worker,
+            args=(queue, worker, active),
+            name='queue_worker-%d' % i,
+        )
+        for i in range(YDL_WORKERS)
+    ]
+    for thread in threads:
+        thread.start()
+    Thread(target=auto_update, name='auto_update', daemon=True).start()
+    Thread(
+        target=send_heartbeats,
+        args=(queue, worker, active),
+        name='heartbeats',
+        daemon=True,
+    ).start()
+    MAIN_LOGGER.info(
+        "Worker %s started %d download threads for %s",
+        worker,
+        len(threads),
+        YDL_WORKER_SERVER or YDL_JOBS_DB,
+    )
+    signal.signal(signal.SIGTERM, lambda signum, frame: STOPPING.set())
+    try:
+        while not STOPPING.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        MAIN_LOGGER.info("Shutting down worker (%s)", YDL_SHUTDOWN_MODE)
+        STOPPING.set()
+        if YDL_SHUTDOWN_MODE == 'cancel':
+            SHUTDOWN.set()
+        for thread in threads:
+            thread.join()
+        queue.close()
 
 
 def main():
@@ -572,22 +5298,84 @@ def main():
 
     This is the main function for the main thread.
     """
-    dl_thread = Thread(target=dl_worker)
-    dl_thread.start()
-    MAIN_LOGGER.info("Started download thread")
+    dl_threads = []
+    if WORKER_QUEUE is None:
+        dl_threads = [
+            Thread(target=dl_worker, name='dl_worker-%d' % i)
+            for i in range(YDL_WORKERS)
+        ]
+        for dl_thread in dl_threads:
+            dl_thread.start()
+        MAIN_LOGGER.info("Started %d download threads", len(dl_threads))
+    else:
+        Thread(target=sync_workers, name='sync_workers', daemon=True).start()
+        MAIN_LOGGER.info("Leaving downloads to worker processes")
+    JOBS.store.compact()
+    if YDL_INFO_CACHE_FILE and Path(YDL_INFO_CACHE_FILE).is_file():
+        try:
+            INFO_CACHE.load(YDL_INFO_CACHE_FILE)
+        except (OSError, ValueError) as exc_info:
+            MAIN_LOGGER.error("Cannot load info cache: %r", exc_info)
+    Thread(target=resume_jobs, name='resume_jobs', daemon=True).start()
+    Thread(target=index_refresher, name='index_refresher', daemon=True).start()
+    if YDL_SWEEP_INTERVAL > 0 and RETENTION.active:
+        Thread(
+            target=retention_sweeper, name='retention_sweeper', daemon=True
+        ).start()
+    Thread(target=RETRIES.run, name='retries', daemon=True).start()
 
-    MAIN_LOGGER.info("Updating youtube-dl to the newest version")
-    updateResult = _update()
-    MAIN_LOGGER.info(updateResult["output"].strip())
-    MAIN_LOGGER.info(updateResult["error"].strip())
-    MAIN_LOGGER.info("Serving on %s:%s" % (YDL_SERVER_HOST, YDL_SERVER_PORT))
-    APP.run(
-        host=YDL_SERVER_HOST, port=YDL_SERVER_PORT, quiet=True,
+    Thread(target=auto_update, name='auto_update', daemon=True).start()
+    MAIN_LOGGER.info(
+        "Serving on %s:%s (%s)"
+        % (YDL_SERVER_HOST, YDL_SERVER_PORT, YDL_SERVER_BACKEND)
     )
-    MAIN_LOGGER.info("Shutting down")
-    DL_Q.put((None, None))  # poison pill for download thread
-    dl_thread.join()
+    server = make_server_adapter()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_server(server))
+    try:
+        APP.run(server=server, quiet=True)
+    finally:
+        MAIN_LOGGER.info("Shutting down (%s)", YDL_SHUTDOWN_MODE)
+        STOPPING.set()
+        JOBS.notify()
+        RETRIES.close()
+        EXPANDER.shutdown(wait=True, cancel_futures=True)
+        if YDL_SHUTDOWN_MODE == 'cancel':
+            SHUTDOWN.set()
+            EXTRACTOR.shutdown(wait=True, cancel_futures=True)
+            for (username, job) in DL_Q.close(cancel=True):
+                MAIN_LOGGER.info(
+                    "Postponed download of %r for %s until restart",
+                    job.url,
+                    username,
+                )
+        else:
+            EXTRACTOR.shutdown(wait=True)
+            DL_Q.close()
+        for dl_thread in dl_threads:
+            dl_thread.join()
+        POSTPROCESSOR.shutdown(
+            wait=True, cancel_futures=(YDL_SHUTDOWN_MODE == 'cancel')
+        )
+        for (username, job) in DL_Q.close(cancel=True):  # held jobs
+            MAIN_LOGGER.info(
+                "Postponed download of %r for %s until restart",
+                job.url,
+                username,
+            )
+        JOBS.store.close()
+        RETENTION.close()
+        if WORKER_QUEUE is not None:
+            WORKER_QUEUE.close()
+        MAIN_LOGGER.info("Info cache: %s", INFO_CACHE.stats())
+        if YDL_INFO_CACHE_FILE:
+            try:
+                INFO_CACHE.save(YDL_INFO_CACHE_FILE)
+            except OSError as exc_info:
+                MAIN_LOGGER.error("Cannot save info cache: %r", exc_info)
 
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ['worker']:
+        run_worker()
+    else:
+        main()